@@ -4,30 +4,86 @@ import string
 from collections import defaultdict, Counter
 from urllib.parse import unquote
 
-import pandas as pd
-
 import configs
 import init
+import metrics
+import profiling
+import watcher
 
 # This should be the first line in the file. It initializes the app.
 init.init()
 
 from configs import COMMON_WORDS_FOR_USER_STATS, USER
 from provider.base_provider import MediaType, MemoryProvider
+from serving import PersistentLoopFlask
 from utils import add_caching_to_response
 
 import mimetypes
 
 import aiofiles
 
+import time
 from datetime import datetime, timezone, timedelta
 
-from flask import Flask, render_template, request, send_file, make_response, jsonify, abort
+from flask import render_template, request, send_file, make_response, jsonify, abort, g, Response
 
 from common import MemoryAggregator
 from profile import get_user_dp, get_profile_json, get_user_profile_from_name, get_all_display_name_regexes_mapping
 
-app = Flask(__name__)
+# Async views share one long-lived event loop, see serving.py
+app = PersistentLoopFlask(__name__)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.before_request
+def start_watching_sources():
+    watcher.start_source_watcher(MemoryAggregator.get_instance().providers)
+
+
+@app.before_request
+def start_request_profile():
+    endpoint = request.url_rule.rule if request.url_rule else None
+    if endpoint and profiling.should_profile(endpoint, request.headers, init.DEBUG):
+        g.request_profile = profiling.RequestProfile.start(endpoint, request.args.to_dict(flat=False))
+
+
+@app.after_request
+def write_request_profile(response):
+    if g.get('request_profile'):
+        report_path = g.pop('request_profile').stop(response.status_code)
+        response.headers['X-Memory-Profile-Report'] = report_path
+    return response
+
+
+@app.after_request
+def record_request_time(response):
+    if 'request_start' in g:
+        # The rule rather than the path, so that asset ids and names don't become labels
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.pop('request_start'), endpoint,
+                                        str(response.status_code))
+    return response
+
+
+@app.teardown_request
+def record_failed_request_time(exception):
+    # Errors that propagate out of the app skip after_request
+    if exception is not None and 'request_start' in g:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.pop('request_start'), endpoint, '500')
+    if g.get('request_profile'):
+        g.pop('request_profile').stop(500)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    response = make_response(metrics.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
 
 
 @app.route('/', methods=['GET'])
@@ -88,10 +144,12 @@ async def status_data():
 
     async def gather_provider_info(provider, instance):
         try:
-            start_date, end_date = await instance.get_start_end_date()
+            metadata = await instance.get_metadata()
             return provider, {
-                "start_date": start_date,
-                "end_date": end_date,
+                "start_date": metadata["start_date"],
+                "end_date": metadata["end_date"],
+                "message_count": metadata["message_count"],
+                "last_modified": metadata["last_modified"],
                 "available": instance.is_working(),
                 "logo": instance.get_logo()
             }
@@ -100,6 +158,8 @@ async def status_data():
             return provider, {
                 "start_date": None,
                 "end_date": None,
+                "message_count": None,
+                "last_modified": None,
                 "available": False,
                 "logo": instance.get_logo(),
                 "error": str(e)
@@ -156,6 +216,9 @@ def circles_page():
 
 @app.route("/circle_data")
 async def circle_data():
+    # pandas is slow to import and only needed here
+    import pandas as pd
+
     start_date = request.args.get("start_date")
     end_date = request.args.get("end_date")
 
@@ -372,7 +435,12 @@ async def asset(provider, file_id):
     asset, mime_type = await MemoryAggregator.get_instance().get_asset(provider, file_id)
     if not asset:
         return "Asset not found", 404
-    response = make_response(asset)
+    if isinstance(asset, (bytes, bytearray)):
+        response = make_response(asset)
+    else:
+        # Streamed from an export zip file
+        response = Response(iter(asset))
+        response.headers['Content-Length'] = str(len(asset))
     response.headers['Content-Type'] = mime_type
     # with open('test_image.webp', 'wb') as f:
     #     f.write(asset)
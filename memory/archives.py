@@ -0,0 +1,275 @@
+import io
+import os
+import struct
+import time
+import zipfile
+from threading import Lock
+from typing import Dict, List, Optional, Tuple, Iterator, BinaryIO, Set
+
+ARCHIVE_EXTENSION = '.zip'
+# Chunks of streamed archive members
+STREAM_CHUNK_SIZE = 256 * 1024
+# Signature and size of a zip local file header. The name and extra field lengths are its last two fields
+_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+_LOCAL_HEADER_SIGNATURE = b'PK\003\004'
+
+
+class ZipArchive:
+    """
+    An export zip file read in place. The central directory is read once into an index of the members and folders,
+    and members are only decompressed when they are opened.
+
+    Paths inside an archive are written as if the zip was a folder, e.g.
+    `data/whatsapp/ios/WhatsApp Chat - Friend.zip/_chat.txt`, so the providers join and split them like other paths.
+    """
+
+    def __init__(self, path: str, fingerprint: List[int]):
+        self.path = path
+        self.fingerprint = fingerprint
+        self._zip = zipfile.ZipFile(path)
+        # Member name ('/' separated) to its entry. Folders aren't members
+        self.members: Dict[str, zipfile.ZipInfo] = {}
+        # Folder ('' for the root) to the names in it
+        self._folders: Dict[str, Set[str]] = {'': set()}
+        for info in self._zip.infolist():
+            name = info.filename.rstrip('/')
+            if not info.is_dir():
+                self.members[name] = info
+            parts = name.split('/')
+            for i in range(len(parts)):
+                self._folders.setdefault('/'.join(parts[:i]), set()).add(parts[i])
+            if info.is_dir():
+                self._folders.setdefault(name, set())
+
+    def close(self):
+        self._zip.close()
+
+    def isdir(self, member: str) -> bool:
+        return member in self._folders
+
+    def isfile(self, member: str) -> bool:
+        return member in self.members
+
+    def listdir(self, member: str) -> List[str]:
+        if member not in self._folders:
+            raise FileNotFoundError(f"{os.path.join(self.path, member)} is not a folder")
+        return list(self._folders[member])
+
+    def member_fingerprint(self, member: str) -> Optional[List[int]]:
+        """
+        [mtime in ns, size, CRC] of a member, like utils.file_fingerprint with the CRC to tell apart members which
+        changed within the 2 seconds precision of zip times.
+        """
+        info = self.members.get(member)
+        if info is None:
+            return None
+        # Zip times are local times
+        mtime = int(time.mktime(info.date_time + (0, 0, -1))) * 1_000_000_000
+        return [mtime, info.file_size, info.CRC]
+
+    def getsize(self, member: str) -> int:
+        return self._get_info(member).file_size
+
+    def open(self, member: str) -> BinaryIO:
+        return self._zip.open(self._get_info(member))
+
+    def read(self, member: str) -> bytes:
+        return self._zip.read(self._get_info(member))
+
+    def stream(self, member: str) -> 'MemberStream':
+        return MemberStream(self, self._get_info(member))
+
+    def _get_info(self, member: str) -> zipfile.ZipInfo:
+        info = self.members.get(member)
+        if info is None:
+            raise FileNotFoundError(f"{os.path.join(self.path, member)} does not exist")
+        return info
+
+    def stored_data_offset(self, info: zipfile.ZipInfo) -> Optional[int]:
+        """
+        Offset of the bytes of a member stored without compression or encryption, so they can be passed through.
+        :return: The offset, or None if the member has to go through zipfile
+        """
+        if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+            return None
+        with open(self.path, 'rb') as f:
+            f.seek(info.header_offset)
+            header = f.read(_LOCAL_HEADER.size)
+        if len(header) != _LOCAL_HEADER.size:
+            return None
+        fields = _LOCAL_HEADER.unpack(header)
+        if fields[0] != _LOCAL_HEADER_SIGNATURE:
+            return None
+        return info.header_offset + _LOCAL_HEADER.size + fields[-2] + fields[-1]
+
+
+class MemberStream:
+    """
+    The bytes of an archive member read chunk by chunk while the response is sent. Members stored without compression
+    (which is how the apps store photos and videos) are read straight from the zip file.
+    """
+
+    def __init__(self, archive: ZipArchive, info: zipfile.ZipInfo):
+        self.archive = archive
+        self.info = info
+
+    def __len__(self) -> int:
+        return self.info.file_size
+
+    def __iter__(self) -> Iterator[bytes]:
+        offset = self.archive.stored_data_offset(self.info)
+        if offset is None:
+            with self.archive.open(self.info.filename) as f:
+                while chunk := f.read(STREAM_CHUNK_SIZE):
+                    yield chunk
+            return
+
+        remaining = self.info.file_size
+        with open(self.archive.path, 'rb') as f:
+            f.seek(offset)
+            while remaining > 0:
+                chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+# Archive path to the opened archive. An archive is indexed again when the zip file changes
+_archives: Dict[str, ZipArchive] = {}
+_archives_lock = Lock()
+
+
+def is_archive(path: str) -> bool:
+    return path.lower().endswith(ARCHIVE_EXTENSION) and os.path.isfile(path)
+
+
+def strip_archive_extension(name: str) -> str:
+    return name[:-len(ARCHIVE_EXTENSION)] if name.lower().endswith(ARCHIVE_EXTENSION) else name
+
+
+def split_archive_path(path: str) -> Optional[Tuple[str, str]]:
+    """
+    Split a path inside a zip file.
+    :return: The path of the zip file and the '/' separated member ('' for the zip itself), or None if the path isn't
+    in an archive
+    """
+    lower = path.lower()
+    start = 0
+    while (index := lower.find(ARCHIVE_EXTENSION, start)) != -1:
+        end = index + len(ARCHIVE_EXTENSION)
+        start = end
+        if end < len(path) and path[end] not in (os.sep, os.altsep or os.sep):
+            continue
+        if os.path.isfile(path[:end]):
+            member = path[end + 1:]
+            return path[:end], member.replace(os.sep, '/') if os.sep != '/' else member
+    return None
+
+
+def get_archive(path: str) -> ZipArchive:
+    """
+    The index of a zip file, read again when the file changes.
+    """
+    stat = os.stat(path)
+    fingerprint = [stat.st_mtime_ns, stat.st_size]
+    archive = _archives.get(path)
+    if archive is not None and archive.fingerprint == fingerprint:
+        return archive
+    with _archives_lock:
+        archive = _archives.get(path)
+        if archive is None or archive.fingerprint != fingerprint:
+            if archive is not None:
+                archive.close()
+            archive = ZipArchive(path, fingerprint)
+            _archives[path] = archive
+    return archive
+
+
+def listdir(path: str) -> List[str]:
+    """
+    os.listdir that also lists the folders of zip files.
+    """
+    split = split_archive_path(path)
+    if split is None:
+        return os.listdir(path)
+    archive_path, member = split
+    return get_archive(archive_path).listdir(member)
+
+
+def isdir(path: str) -> bool:
+    """
+    os.path.isdir where zip files and their folders are folders too.
+    """
+    split = split_archive_path(path)
+    if split is None:
+        return os.path.isdir(path)
+    archive_path, member = split
+    return get_archive(archive_path).isdir(member)
+
+
+def exists(path: str) -> bool:
+    split = split_archive_path(path)
+    if split is None:
+        return os.path.exists(path)
+    archive_path, member = split
+    archive = get_archive(archive_path)
+    return archive.isdir(member) or archive.isfile(member)
+
+
+def member_fingerprint(path: str) -> Optional[List[int]]:
+    """
+    Fingerprint of a file in a zip file, see ZipArchive.member_fingerprint.
+    :return: The fingerprint, None if the member doesn't exist or if the path isn't in an archive
+    """
+    split = split_archive_path(path)
+    if split is None or not split[1]:
+        return None
+    archive_path, member = split
+    return get_archive(archive_path).member_fingerprint(member)
+
+
+def getsize(path: str) -> int:
+    split = split_archive_path(path)
+    if split is None:
+        return os.path.getsize(path)
+    archive_path, member = split
+    return get_archive(archive_path).getsize(member)
+
+
+def open_binary(path: str) -> BinaryIO:
+    split = split_archive_path(path)
+    if split is None:
+        return open(path, 'rb')
+    archive_path, member = split
+    return get_archive(archive_path).open(member)
+
+
+def open_text(path: str, encoding: str = 'utf-8'):
+    """
+    open(path, 'r') for files that may be in a zip file, with the same newline handling.
+    """
+    split = split_archive_path(path)
+    if split is None:
+        return open(path, 'r', encoding=encoding)
+    return io.TextIOWrapper(open_binary(path), encoding=encoding)
+
+
+def read_bytes(path: str) -> bytes:
+    split = split_archive_path(path)
+    if split is None:
+        with open(path, 'rb') as f:
+            return f.read()
+    archive_path, member = split
+    return get_archive(archive_path).read(member)
+
+
+def stream(path: str) -> MemberStream:
+    """
+    A member of a zip file to be streamed in a response.
+    """
+    split = split_archive_path(path)
+    if split is None or not split[1]:
+        raise ValueError(f"{path} isn't in an archive")
+    archive_path, member = split
+    return get_archive(archive_path).stream(member)
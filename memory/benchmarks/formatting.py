@@ -0,0 +1,227 @@
+"""
+Differential check and throughput of WhatsAppProvider.detect_formatting.
+
+The current implementation is compared with the previous character by character one (kept below as the reference) on
+synthetic WhatsApp messages, hand picked edge cases and random strings of formatting characters. Any difference is
+printed and makes the script exit with 1.
+
+    python benchmarks/formatting.py
+    python benchmarks/formatting.py --messages 200000 --fuzz 100000
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+from typing import Tuple, List, Dict, Any
+
+MEMORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, MEMORY_PATH)
+
+from benchmarks.generators import _formatted_sentence, NAMES
+from provider.base_provider import FormattingType
+from provider.whatsapp_provider import WhatsAppProvider
+
+EDGE_CASES = [
+    '', ' ', '*', '**', '***', '*a*', '* a*', '*a *', 'a*b*c', '*bold* _italic_ ~strike~ `code`',
+    '*nested _italic_ bold*', '_a_b_', '(*a*)', '"_quoted_"', '*a*.', 'x *a*, y', '*multi\nline*',
+    '@John hello', 'hi @John_Doe_', '@⁨Ritik Surname⁩ hello', '*@⁨Ritik⁩*',
+    '@⁨unterminated', '⁨not a mention⁩', '~~double~~', '`a` `b`', '*unclosed', 'closed*',
+    'a_b_c_d', '_ _', '*⁨*', 'email@example.com *x*', '@', '@@a', '  *padded*  ',
+]
+
+
+def reference_detect_formatting(text: str) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    detect_formatting before it was rewritten to a single pass
+    """
+    if not text:
+        return "", []
+
+    # Supported WhatsApp delimiters and their entity types
+    delimiters = {
+        '_': FormattingType.ITALIC.value,
+        '*': FormattingType.BOLD.value,
+        '~': FormattingType.STRIKETHROUGH.value,
+        '`': FormattingType.CODE.value,
+    }
+
+    if not any(char in text for char in delimiters) and not '@' in text:
+        return text, []
+
+    # Keep track of active formatting spans we are building
+    raw_spans = []
+
+    # A stack to match delimiters
+    stacks = {char: [] for char in delimiters}
+
+    # Track which characters are formatting delimiters to be stripped
+    chars_to_strip = set()
+
+    # 1. Identify Mentions (Bidi-wrapped and normal) in the raw string first
+    mention_pattern = re.compile(
+        rf'@([{WhatsAppProvider.BIDI_CHARS_CLASS}])[^{WhatsAppProvider.BIDI_CHARS_CLASS}@*~_`\n]+([{WhatsAppProvider.BIDI_CHARS_CLASS}])|@\w+'
+    )
+
+    for m in mention_pattern.finditer(text):
+        start_idx, end_idx = m.span()
+        # matched_str = m.group(0)
+
+        # Record bidi override chars inside this mention for removal
+        for char_pos in range(start_idx, end_idx):
+            if text[char_pos] in '\u2066\u2067\u2068\u2069\u200e\u200f':
+                chars_to_strip.add(char_pos)
+
+        # Extract username for resolving if needed
+        # clean_mention_str = re.sub(rf'[{WhatsAppProvider.BIDI_CHARS_CLASS}]', '', matched_str)
+        # username = clean_mention_str[1:]  # Strip '@'
+
+        # Add raw span entry
+        span_entry = {
+            "type": "mention",
+            "start_raw": start_idx,
+            "end_raw": end_idx
+        }
+
+        raw_spans.append(span_entry)
+
+    # 2. Match standard typography decorators while avoiding formatting characters
+    i = 0
+    n = len(text)
+    while i < n:
+        char = text[i]
+        if char in delimiters:
+            # Check WhatsApp's spacing & word boundary rules:
+            # Can close if there's an open matching tag, preceding char is not space,
+            # and succeeding char is a boundary (space, punctuation, or end of string).
+            can_close = (
+                    len(stacks[char]) > 0 and
+                    i > 0 and
+                    not text[i - 1].isspace() and
+                    (i + 1 == n or text[i + 1].isspace() or text[i + 1] in ".,!?;:()[]{}<>\"'/\\")
+            )
+
+            # Can open if succeeding char is not space, and preceding char is a boundary
+            can_open = (
+                    i + 1 < n and
+                    not text[i + 1].isspace() and
+                    (i == 0 or text[i - 1].isspace() or text[i - 1] in ".,!?;:()[]{}<>\"'/\\")
+            )
+
+            if can_close:
+                start_idx = stacks[char].pop()
+                raw_spans.append({
+                    "type": delimiters[char],
+                    "start_raw": start_idx,
+                    "end_raw": i
+                })
+                # Mark both delimiters for removal
+                chars_to_strip.add(start_idx)
+                chars_to_strip.add(i)
+            elif can_open:
+                stacks[char].append(i)
+
+        i += 1
+
+    # 3. Construct the clean string and map raw positions to clean positions
+    clean_chars = []
+    raw_to_clean = {}
+
+    clean_idx = 0
+    for raw_idx in range(n):
+        if raw_idx in chars_to_strip:
+            # This char is stripped, so it maps to the current clean position
+            raw_to_clean[raw_idx] = clean_idx
+        else:
+            clean_chars.append(text[raw_idx])
+            raw_to_clean[raw_idx] = clean_idx
+            clean_idx += 1
+
+    # Mapping edge case for trailing bounds mapping
+    raw_to_clean[n] = clean_idx
+
+    clean_text = "".join(clean_chars)
+
+    # 4. Translate raw offsets to clean offsets
+    entities = []
+    for span in raw_spans:
+        is_mention = span["type"] == FormattingType.MENTION.value
+
+        # If it's a mention, we preserve the "@" prefix (start_raw is preserved)
+        # If it's standard formatting, bounds are exclusive of delimiters (start_raw + 1)
+        start_raw = span["start_raw"] if is_mention else span["start_raw"] + 1
+        end_raw = span["end_raw"]
+
+        clean_start = raw_to_clean.get(start_raw, 0)
+        clean_end = raw_to_clean.get(end_raw, 0)
+
+        length = clean_end - clean_start
+        if length > 0:
+            entity = {
+                "type": span["type"],
+                "offset": clean_start,
+                "length": length
+            }
+            if "userId" in span:
+                entity["userId"] = span["userId"]
+            entities.append(entity)
+
+    # Sort entities by offset for consistency
+    entities.sort(key=lambda x: (x["offset"], -x["length"]))
+
+    return clean_text, entities
+
+
+def _corpus(messages: int, fuzz: int, seed: int) -> List[str]:
+    rng = random.Random(seed)
+    members = list(NAMES[:6])
+    texts = list(EDGE_CASES)
+    texts.extend(_formatted_sentence(rng, members) for _ in range(messages))
+    # Random strings of formatting characters, spaces and boundaries find the corner cases of the delimiter rules
+    alphabet = 'ab *_~`@.,( \n\u2068\u2069'
+    texts.extend(''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 16))) for _ in range(fuzz))
+    return texts
+
+
+def _throughput(fn, texts: List[str], repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in texts:
+            fn(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(texts) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare detect_formatting with the reference implementation')
+    parser.add_argument('--messages', type=int, default=50000, help='Synthetic WhatsApp messages')
+    parser.add_argument('--fuzz', type=int, default=50000, help='Random strings of formatting characters')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--repeat', type=int, default=3, help='Timed passes, the best one is reported')
+    args = parser.parse_args()
+
+    texts = _corpus(args.messages, args.fuzz, args.seed)
+    mismatches = 0
+    for text in texts:
+        expected = reference_detect_formatting(text)
+        actual = WhatsAppProvider.detect_formatting(text)
+        if actual != expected:
+            mismatches += 1
+            if mismatches <= 10:
+                print(f"Mismatch for {text!r}:\n  expected {expected}\n  actual   {actual}")
+    print(f"{len(texts)} texts, {mismatches} mismatches")
+
+    # Throughput on the realistic messages only, the fuzz strings are all formatting characters
+    realistic = texts[:len(EDGE_CASES) + args.messages]
+    before = _throughput(reference_detect_formatting, realistic, args.repeat)
+    after = _throughput(WhatsAppProvider.detect_formatting, realistic, args.repeat)
+    print(f"reference {before:>12,.0f} msgs/s")
+    print(f"current   {after:>12,.0f} msgs/s ({after / before:.1f}x)")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
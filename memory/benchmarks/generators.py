@@ -0,0 +1,482 @@
+"""
+Generators of large synthetic exports, in the same formats as the real exports read by the providers.
+
+    python benchmarks/generators.py --out /tmp/memory-bench --scale 1
+
+The output folder is laid out like the memory folder (data/..., diary/...) so that the providers can be pointed at it
+by running from it. Generation is seeded, so the same arguments always give the same exports.
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict
+
+USER = 'Ritik'
+INSTAGRAM_USER = 'Ritik Kumar'
+START = datetime(2016, 1, 1)
+END = datetime(2025, 12, 31)
+
+WORDS = ('hey', 'what', 'are', 'you', 'doing', 'today', 'lunch', 'tomorrow', 'call', 'me', 'when', 'free', 'haha',
+         'okay', 'sure', 'see', 'the', 'movie', 'was', 'great', 'bhai', 'kya', 'scene', 'office', 'late', 'again',
+         'weekend', 'plan', 'trip', 'goa', 'photos', 'send', 'please', 'thanks', 'good', 'night', 'morning')
+# Non-ASCII text, which Instagram writes as mojibake
+UNICODE_WORDS = ('café', 'naïve', 'पागल', 'ಸರಿ', '😂', '❤️', '🔥', 'über')
+NAMES = ('Aarav', 'Vivaan', 'Aditya', 'Diya', 'Ananya', 'Ishaan', 'Kabir', 'Meera', 'Riya', 'Sara', 'Zoya', 'Arjun',
+         'Kavya', 'Rohan', 'Tara', 'Neel', 'Myra', 'Dev', 'Isha', 'Veer')
+PLACE_TYPES = ('Home', 'Work', 'Unknown', 'Restaurant', 'Gym', 'Cafe')
+ACTIVITY_TYPES = ('walking', 'in passenger vehicle', 'cycling', 'in bus', 'flying')
+CITIES = ('Bangalore', 'Mumbai', 'Delhi', 'Goa')
+
+
+def _sentence(rng: random.Random, unicode: bool = False) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(1, 14))]
+    if unicode and rng.random() < 0.3:
+        words.insert(rng.randrange(len(words) + 1), rng.choice(UNICODE_WORDS))
+    return ' '.join(words)
+
+
+def _formatted_sentence(rng: random.Random, members: List[str]) -> str:
+    """
+    WhatsApp text with the formatting and mentions handled by WhatsAppProvider.detect_formatting
+    """
+    text = _sentence(rng)
+    roll = rng.random()
+    if roll < 0.05:
+        return f'*{text}*'
+    if roll < 0.08:
+        return f'{text} _{rng.choice(WORDS)}_'
+    if roll < 0.10:
+        return f'~{text}~ {rng.choice(WORDS)}'
+    if roll < 0.11:
+        return f'`{text}`'
+    if roll < 0.14 and members:
+        return f'@⁨{rng.choice(members)}⁩ {text}'
+    return text
+
+
+def _timestamps(rng: random.Random, count: int, start: datetime = START, end: datetime = END) -> List[datetime]:
+    """
+    Sorted timestamps between start and end, bursty like real conversations
+    """
+    span = (end - start).total_seconds()
+    timestamps = []
+    while len(timestamps) < count:
+        burst_start = start + timedelta(seconds=rng.random() * span)
+        for _ in range(min(rng.randint(1, 40), count - len(timestamps))):
+            burst_start += timedelta(seconds=rng.randint(5, 900))
+            timestamps.append(burst_start)
+    timestamps.sort()
+    return timestamps
+
+
+def generate_whatsapp_android(root: str, chats: int, messages_per_chat: int, rng: random.Random):
+    base_path = os.path.join(root, 'data', 'whatsapp', 'android')
+    os.makedirs(base_path, exist_ok=True)
+    for chat in range(chats):
+        is_group = chat % 5 == 0
+        name = f'{NAMES[chat % len(NAMES)]} Android {chat}' if not is_group else f'Group Android {chat}'
+        members = [USER, name] if not is_group else [USER] + rng.sample(NAMES, 6)
+        lines = ['01/01/2016, 00:00 - Messages and calls are end-to-end encrypted. No one outside of this chat, '
+                 'including WhatsApp, can read or listen to them. Tap to learn more.']
+        if is_group:
+            lines.append(f'01/01/2016, 00:01 - {members[1]} created group "{name}"')
+        for dt in _timestamps(rng, messages_per_chat):
+            sender = rng.choice(members)
+            roll = rng.random()
+            if roll < 0.05:
+                text = '<Media omitted>'
+            elif roll < 0.07:
+                text = 'This message was deleted'
+            elif roll < 0.09:
+                text = f'{_sentence(rng)} <This message was edited>'
+            elif roll < 0.12:
+                # Multi line message
+                text = '\n'.join(_sentence(rng) for _ in range(rng.randint(2, 4)))
+            else:
+                text = _formatted_sentence(rng, members)
+            lines.append(f'{dt.strftime("%d/%m/%Y, %H:%M")} - {sender}: {text}')
+        with open(os.path.join(base_path, f'WhatsApp Chat with {name}.txt'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+def generate_whatsapp_ios(root: str, chats: int, messages_per_chat: int, rng: random.Random):
+    base_path = os.path.join(root, 'data', 'whatsapp', 'ios')
+    for chat in range(chats):
+        is_group = chat % 5 == 0
+        name = f'{NAMES[chat % len(NAMES)]} iOS {chat}' if not is_group else f'Group iOS {chat}'
+        members = [USER, name] if not is_group else [USER] + rng.sample(NAMES, 6)
+        folder_path = os.path.join(base_path, f'WhatsApp Chat - {name}')
+        os.makedirs(folder_path, exist_ok=True)
+        lines = [f'[01/01/16, 12:00:00 AM] {name}: ‎Messages and calls are end-to-end encrypted. '
+                 f'No one outside of this chat, not even WhatsApp, can read or listen to them.']
+        if is_group:
+            lines.append(f'[01/01/16, 12:00:01 AM] {name}: ‎{members[1]} created this group')
+        for dt in _timestamps(rng, messages_per_chat):
+            sender = rng.choice(members)
+            roll = rng.random()
+            if roll < 0.04:
+                text = '‎image omitted'
+            elif roll < 0.06:
+                text = f'‎<attached: {rng.randint(0, 99999):08d}-PHOTO-{dt.strftime("%Y-%m-%d-%H-%M-%S")}.jpg>'
+            elif roll < 0.07:
+                text = f'‎Voice call, ‎{rng.randint(1, 59)} min'
+            elif roll < 0.09:
+                text = f'{_sentence(rng)} ‎<This message was edited>'
+            else:
+                text = _formatted_sentence(rng, members)
+            # iOS puts a narrow no-break space before AM/PM
+            lines.append(f'[{dt.strftime("%d/%m/%y, %I:%M:%S")}\u202f{dt.strftime("%p")}] {sender}: {text}')
+        with open(os.path.join(folder_path, '_chat.txt'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+def _mojibake_json(data) -> str:
+    """
+    Instagram escapes every UTF-8 byte of non-ASCII text as its own \\u00XX
+    """
+
+    def encode(value):
+        if isinstance(value, str):
+            return value.encode('utf-8').decode('latin-1')
+        if isinstance(value, list):
+            return [encode(item) for item in value]
+        if isinstance(value, dict):
+            return {key: encode(item) for key, item in value.items()}
+        return value
+
+    return json.dumps(encode(data), indent=2)
+
+
+def generate_instagram(root: str, conversations: int, messages_per_conversation: int, rng: random.Random,
+                       messages_per_part: int = 10000):
+    base_path = os.path.join(root, 'data', 'instagram', 'messages')
+    for conversation in range(conversations):
+        is_group = conversation % 7 == 0
+        name = f'{NAMES[conversation % len(NAMES)]} Insta {conversation}'
+        members = [INSTAGRAM_USER, name] if not is_group else [INSTAGRAM_USER] + rng.sample(NAMES, 5)
+        folder_path = os.path.join(base_path, f'{name.lower().replace(" ", "")}_{1000000 + conversation}')
+        os.makedirs(folder_path, exist_ok=True)
+
+        messages = []
+        for dt in _timestamps(rng, messages_per_conversation):
+            message = {
+                'sender_name': rng.choice(members),
+                'timestamp_ms': int(dt.timestamp() * 1000),
+                'is_geoblocked_for_viewer': False,
+            }
+            roll = rng.random()
+            if roll < 0.04:
+                message['share'] = {'link': f'https://www.instagram.com/reel/{rng.getrandbits(40):x}/'}
+            elif roll < 0.06:
+                message['content'] = 'Liked a message'
+            elif roll < 0.07:
+                message['content'] = f'{_sentence(rng)} (edited)'
+            else:
+                message['content'] = _sentence(rng, unicode=True)
+            messages.append(message)
+
+        # Newest first, split in parts of messages_per_part. message_1.json has the newest messages
+        messages.reverse()
+        for part, offset in enumerate(range(0, len(messages), messages_per_part), start=1):
+            data = {
+                'participants': [{'name': member} for member in members],
+                'messages': messages[offset:offset + messages_per_part],
+                'title': name,
+                'is_still_participant': True,
+                'thread_path': f'inbox/{os.path.basename(folder_path)}',
+            }
+            with open(os.path.join(folder_path, f'message_{part}.json'), 'w', encoding='utf-8') as f:
+                f.write(_mojibake_json(data))
+
+
+def _attributed_body(text: str) -> bytes:
+    """
+    NSAttributedString typedstream blob as read by IMessageProvider._decode_attributed_body
+    """
+    encoded = text.encode('utf-8')
+    header = bytearray(b'\x04\x0bstreamtyped\x81\xe8\x03\x84\x01@\x84\x84\x84')
+    header += bytes(22 - len(header))
+    header += b'\x12'  # NSAttributedString
+    header += bytes(73 - len(header))
+    if len(encoded) <= 0x7F:
+        length = bytes([len(encoded)])
+    else:
+        length = bytes([0x81, len(encoded) % 256, len(encoded) // 256])
+    return bytes(header) + length + encoded + b'\x86\x84\x02iI\x01'
+
+
+def generate_imessage(root: str, chats: int, messages_per_chat: int, rng: random.Random) -> Dict[str, List[str]]:
+    """
+    :return: chat identifiers by display name, for profile.json
+    """
+    base_path = os.path.join(root, 'data', 'imessage')
+    os.makedirs(base_path, exist_ok=True)
+    db_path = os.path.join(base_path, 'sms.db')
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    conn = sqlite3.connect(db_path)
+    conn.executescript('''
+        CREATE TABLE handle (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT, service TEXT);
+        CREATE TABLE chat (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, guid TEXT, style INTEGER, chat_identifier TEXT,
+                           service_name TEXT, display_name TEXT);
+        CREATE TABLE message (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, guid TEXT, text TEXT, attributedBody BLOB,
+                              handle_id INTEGER, date INTEGER, account TEXT, is_from_me INTEGER, service TEXT,
+                              cache_has_attachments INTEGER);
+        CREATE TABLE attachment (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, guid TEXT, filename TEXT, mime_type TEXT,
+                                 transfer_name TEXT, total_bytes INTEGER);
+        CREATE TABLE chat_message_join (chat_id INTEGER, message_id INTEGER, message_date INTEGER);
+        CREATE TABLE chat_handle_join (chat_id INTEGER, handle_id INTEGER);
+        CREATE TABLE message_attachment_join (message_id INTEGER, attachment_id INTEGER);
+        CREATE INDEX chat_message_join_idx ON chat_message_join (chat_id, message_id);
+        CREATE INDEX message_date_idx ON message (date);
+    ''')
+
+    apple_epoch = datetime(2001, 1, 1)
+    chat_identifiers = {}
+    message_guid = 0
+    for chat in range(chats):
+        name = f'{NAMES[chat % len(NAMES)]} iMessage {chat}'
+        identifier = f'+9198{chat:08d}'
+        chat_identifiers[name] = [identifier]
+        handle_id = conn.execute("INSERT INTO handle (id, service) VALUES (?, 'iMessage')", (identifier,)).lastrowid
+        chat_id = conn.execute("INSERT INTO chat (guid, style, chat_identifier, service_name, display_name) "
+                               "VALUES (?, 45, ?, 'iMessage', '')", (f'iMessage;-;{identifier}', identifier)).lastrowid
+        conn.execute("INSERT INTO chat_handle_join (chat_id, handle_id) VALUES (?, ?)", (chat_id, handle_id))
+
+        rows = []
+        attachments = []
+        for dt in _timestamps(rng, messages_per_chat):
+            message_guid += 1
+            date = int((dt - apple_epoch).total_seconds() * 1_000_000_000)
+            is_from_me = rng.random() < 0.5
+            text = _sentence(rng, unicode=True)
+            has_attachment = rng.random() < 0.03
+            # Newer macOS versions only fill attributedBody
+            if rng.random() < 0.6:
+                rows.append((message_guid, None, _attributed_body(text), 0 if is_from_me else handle_id, date,
+                             int(is_from_me), int(has_attachment)))
+            else:
+                rows.append((message_guid, text, None, 0 if is_from_me else handle_id, date, int(is_from_me),
+                             int(has_attachment)))
+            if has_attachment:
+                attachments.append((message_guid,
+                                    f'~/Library/SMS/Attachments/{message_guid % 256:02x}/{message_guid:02d}/'
+                                    f'IMG_{message_guid}.jpeg'))
+
+        conn.executemany("INSERT INTO message (ROWID, guid, text, attributedBody, handle_id, date, account, is_from_me, "
+                         "service, cache_has_attachments) VALUES (?, ?, ?, ?, ?, ?, 'e:', ?, 'iMessage', ?)",
+                         [(row[0], f'GUID-{row[0]}', *row[1:]) for row in rows])
+        conn.executemany("INSERT INTO chat_message_join (chat_id, message_id, message_date) VALUES (?, ?, ?)",
+                         [(chat_id, row[0], row[4]) for row in rows])
+        for message_id, filename in attachments:
+            attachment_id = conn.execute("INSERT INTO attachment (guid, filename, mime_type, transfer_name, total_bytes) "
+                                         "VALUES (?, ?, 'image/jpeg', ?, ?)",
+                                         (f'ATT-{message_id}', filename, os.path.basename(filename),
+                                          rng.randint(10_000, 5_000_000))).lastrowid
+            conn.execute("INSERT INTO message_attachment_join (message_id, attachment_id) VALUES (?, ?)",
+                         (message_id, attachment_id))
+    conn.commit()
+    conn.close()
+    return chat_identifiers
+
+
+def _geo(rng: random.Random) -> str:
+    return f'geo:{12.9 + rng.random() / 5:.6f},{77.5 + rng.random() / 5:.6f}'
+
+
+def generate_google_maps(root: str, entries: int, rng: random.Random):
+    base_path = os.path.join(root, 'data', 'google_maps')
+    os.makedirs(base_path, exist_ok=True)
+    ist = timezone(timedelta(hours=5, minutes=30))
+    data = []
+    for dt in _timestamps(rng, entries):
+        start = dt.replace(tzinfo=ist)
+        end = start + timedelta(minutes=rng.randint(5, 300))
+        entry = {
+            'startTime': start.isoformat(timespec='milliseconds'),
+            'endTime': end.isoformat(timespec='milliseconds'),
+        }
+        roll = rng.random()
+        if roll < 0.45:
+            entry['visit'] = {
+                'hierarchyLevel': str(rng.randint(0, 2)),
+                'probability': f'{rng.random():.6f}',
+                'topCandidate': {
+                    'probability': f'{rng.random():.6f}',
+                    'semanticType': rng.choice(PLACE_TYPES),
+                    'placeID': f'ChIJ{rng.getrandbits(60):x}',
+                    'placeLocation': _geo(rng),
+                },
+            }
+            entry['hierarchyLevel'] = rng.randint(0, 2)
+        elif roll < 0.8:
+            entry['activity'] = {
+                'start': _geo(rng),
+                'end': _geo(rng),
+                'distanceMeters': f'{rng.random() * 20000:.1f}',
+                'topCandidate': {'type': rng.choice(ACTIVITY_TYPES), 'probability': f'{rng.random():.6f}'},
+            }
+        elif roll < 0.98:
+            entry['timelinePath'] = [{'point': _geo(rng), 'durationMinutesOffsetFromStartTime': str(offset)}
+                                     for offset in sorted(rng.sample(range(0, 120), rng.randint(2, 12)))]
+        else:
+            entry['timelineMemory'] = {'destinations': [{'identifier': f'{rng.getrandbits(60):x}'}],
+                                       'distanceFromOriginKms': str(rng.randint(1, 2000))}
+        data.append(entry)
+    with open(os.path.join(base_path, 'location-history.json'), 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+
+
+UBER_COLUMNS = ('city_name', 'product_type_name', 'status', 'is_completed', 'is_airport_trip',
+                'request_timestamp_local', 'begintrip_timestamp_local', 'begintrip_lat', 'begintrip_lng',
+                'begintrip_address', 'dropoff_timestamp_local', 'dropoff_lat', 'dropoff_lng', 'dropoff_address',
+                'trip_distance_miles', 'trip_duration_seconds', 'fare_amount', 'currency_code')
+
+
+def generate_uber(root: str, trips: int, rng: random.Random):
+    base_path = os.path.join(root, 'data', 'uber')
+    os.makedirs(base_path, exist_ok=True)
+    with open(os.path.join(base_path, 'trips_data-0.csv'), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=UBER_COLUMNS)
+        writer.writeheader()
+        for dt in _timestamps(rng, trips):
+            completed = rng.random() < 0.85
+            duration = rng.randint(300, 5400)
+            requested = dt.replace(tzinfo=timezone(timedelta(hours=5, minutes=30)))
+            started = requested + timedelta(minutes=rng.randint(2, 15))
+            writer.writerow({
+                'city_name': rng.choice(CITIES),
+                'product_type_name': rng.choice(('UberGo', 'Premier', 'Auto', 'UberXL')),
+                'status': 'completed' if completed else 'rider_canceled',
+                'is_completed': 'true' if completed else 'false',
+                'is_airport_trip': 'true' if rng.random() < 0.05 else 'false',
+                'request_timestamp_local': requested.isoformat(),
+                'begintrip_timestamp_local': started.isoformat() if completed else '',
+                'begintrip_lat': f'{12.9 + rng.random() / 5:.6f}' if completed else '',
+                'begintrip_lng': f'{77.5 + rng.random() / 5:.6f}' if completed else '',
+                'begintrip_address': f'{rng.randint(1, 999)}, {rng.choice(WORDS).title()} Road',
+                'dropoff_timestamp_local': (started + timedelta(seconds=duration)).isoformat() if completed else '',
+                'dropoff_lat': f'{12.9 + rng.random() / 5:.6f}' if completed else '',
+                'dropoff_lng': f'{77.5 + rng.random() / 5:.6f}' if completed else '',
+                'dropoff_address': f'{rng.randint(1, 999)}, {rng.choice(WORDS).title()} Road',
+                'trip_distance_miles': f'{rng.random() * 30:.2f}',
+                'trip_duration_seconds': str(duration),
+                'fare_amount': f'{rng.random() * 1500:.2f}',
+                'currency_code': 'INR',
+            })
+
+
+def generate_diary(root: str, entries_per_day: float, rng: random.Random):
+    """
+    One CSV per year, as read by DiaryProvider. Point DIARY_PATH to <root>/diary
+    """
+    base_path = os.path.join(root, 'diary')
+    os.makedirs(base_path, exist_ok=True)
+    for year in range(START.year, END.year + 1):
+        lines = []
+        day = datetime(year, 1, 1)
+        while day.year == year:
+            for _ in range(int(entries_per_day) + (rng.random() < entries_per_day % 1)):
+                roll = rng.random()
+                if roll < 0.03:
+                    date_str = '~'
+                else:
+                    date_str = day.strftime('%d/%m/%Y')
+                text = ' >> '.join(_sentence(rng) for _ in range(rng.randint(1, 5)))
+                lines.append(f'{date_str},"{text}"')
+            day += timedelta(days=1)
+        with open(os.path.join(base_path, f'Diary {year}.csv'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+def generate_hinge(root: str, matches: int, rng: random.Random) -> Dict[str, str]:
+    """
+    :return: Match times by display name, for profile.json
+    """
+    base_path = os.path.join(root, 'data', 'hinge')
+    os.makedirs(base_path, exist_ok=True)
+    data = []
+    match_times = {}
+    for index, dt in enumerate(_timestamps(rng, matches, start=datetime(2021, 1, 1))):
+        entry = {}
+        if rng.random() < 0.7:
+            entry['like'] = [{
+                'timestamp': dt.strftime('%Y-%m-%d %H:%M:%S'),
+                'like': [{'timestamp': dt.strftime('%Y-%m-%d %H:%M:%S'),
+                          'comment': _sentence(rng) if rng.random() < 0.4 else ''}],
+            }]
+        if rng.random() < 0.3:
+            match_dt = dt + timedelta(hours=rng.randint(1, 200))
+            match_time = match_dt.strftime('%Y-%m-%d %H:%M:%S')
+            entry['match'] = [{'timestamp': match_time}]
+            chats = []
+            chat_dt = match_dt
+            for _ in range(rng.randint(0, 60)):
+                chat_dt += timedelta(minutes=rng.randint(1, 600))
+                chats.append({'body': _sentence(rng), 'timestamp': chat_dt.strftime('%Y-%m-%d %H:%M:%S')})
+            entry['chats'] = chats
+            if index % 10 == 0:
+                match_times[f'{NAMES[index % len(NAMES)]} Hinge {index}'] = match_time
+        data.append(entry)
+    with open(os.path.join(base_path, 'matches.json'), 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    return match_times
+
+
+def generate_profile(root: str, imessage_chat_identifiers: Dict[str, List[str]], hinge_match_times: Dict[str, str]):
+    profiles = [{'display_name': USER, 'name_regex': f'(?i)^{USER}', 'provider_details': {}}]
+    for name in sorted(set(imessage_chat_identifiers) | set(hinge_match_times)):
+        provider_details = {}
+        if name in imessage_chat_identifiers:
+            provider_details['imessage'] = {'chat_identifier': imessage_chat_identifiers[name]}
+        if name in hinge_match_times:
+            provider_details['hinge'] = {'match_time': hinge_match_times[name]}
+        profiles.append({'display_name': name, 'name_regex': f'(?i){name}', 'provider_details': provider_details})
+    for name in NAMES:
+        profiles.append({'display_name': name, 'name_regex': f'(?i)^{name}', 'provider_details': {}})
+    with open(os.path.join(root, 'data', 'profile.json'), 'w', encoding='utf-8') as f:
+        json.dump(profiles, f, indent=2)
+
+
+def generate_all(root: str, scale: float = 1.0, seed: int = 7):
+    """
+    Generate the exports of every provider. At scale 1 there are about a million WhatsApp messages, 500k Instagram
+    and iMessage messages, 100k location entries, 5k Uber trips, 10 years of diary and 5k Hinge matches.
+    :param root: Output folder
+    :param scale: Multiplier of the sizes
+    :param seed: Random seed
+    """
+    rng = random.Random(seed)
+
+    def scaled(value: int) -> int:
+        return max(1, int(value * scale))
+
+    print(f"Generating synthetic exports in {root} at scale {scale}")
+    generate_whatsapp_android(root, chats=scaled(60), messages_per_chat=10000, rng=rng)
+    generate_whatsapp_ios(root, chats=scaled(40), messages_per_chat=10000, rng=rng)
+    generate_instagram(root, conversations=scaled(50), messages_per_conversation=10000, rng=rng)
+    imessage_chat_identifiers = generate_imessage(root, chats=scaled(50), messages_per_chat=10000, rng=rng)
+    generate_google_maps(root, entries=scaled(100000), rng=rng)
+    generate_uber(root, trips=scaled(5000), rng=rng)
+    generate_diary(root, entries_per_day=min(3.0, scale), rng=rng)
+    hinge_match_times = generate_hinge(root, matches=scaled(5000), rng=rng)
+    generate_profile(root, imessage_chat_identifiers, hinge_match_times)
+    print("Done generating synthetic exports")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic exports for every provider')
+    parser.add_argument('--out', required=True, help='Output folder')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplier of the export sizes')
+    parser.add_argument('--seed', type=int, default=7, help='Random seed')
+    args = parser.parse_args()
+    generate_all(args.out, args.scale, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Cold start budget for the app and the CLI.
+
+Every module is imported in a fresh interpreter with all providers enabled, so the numbers include everything that
+runs at import time. Run it from the memory folder:
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --budget 1.5 --top 15
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+MEMORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, MEMORY_PATH)
+
+from configs import PROVIDER_REGISTRY
+
+MODULES = ['app', 'cli']
+IMPORT_TIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$')
+
+
+def measure(module: str, runs: int) -> float:
+    """
+    Import the module in a new interpreter and return the best wall time of all runs.
+    :param module: Module to import
+    :param runs: Number of runs
+    :return: Seconds
+    """
+    env = {**os.environ, 'ENABLED_PROVIDERS': ','.join(PROVIDER_REGISTRY.keys())}
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', f'import {module}'], cwd=MEMORY_PATH, env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def slowest_imports(module: str, top: int) -> list:
+    """
+    Get the top level imports that take the longest, using python -X importtime.
+    :param module: Module to import
+    :param top: Number of imports to return
+    :return: List of (cumulative microseconds, imported module)
+    """
+    env = {**os.environ, 'ENABLED_PROVIDERS': ','.join(PROVIDER_REGISTRY.keys())}
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=MEMORY_PATH, env=env,
+                            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_RE.match(line)
+        # Only the modules imported directly by the measured module. Nested ones are included in their time
+        if match and len(match.group(3)) <= 3:
+            imports.append((int(match.group(2)), match.group(4)))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cold start time of the app and the CLI')
+    parser.add_argument('--budget', type=float, default=2.0, help='Maximum import time in seconds')
+    parser.add_argument('--runs', type=int, default=3, help='Runs per module, the best one is reported')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest imports to show')
+    args = parser.parse_args()
+
+    over_budget = False
+    for module in MODULES:
+        elapsed = measure(module, args.runs)
+        status = 'OK' if elapsed <= args.budget else 'OVER BUDGET'
+        over_budget = over_budget or elapsed > args.budget
+        print(f'{module}: {elapsed:.3f}s (budget {args.budget:.3f}s) {status}')
+        for microseconds, name in slowest_imports(module, args.top):
+            print(f'    {microseconds / 1000:9.1f} ms  {name}')
+
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == '__main__':
+    main()
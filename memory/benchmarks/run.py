@@ -0,0 +1,182 @@
+"""
+Provider parsing benchmarks on synthetic exports.
+
+Every provider and query shape runs in a fresh interpreter, so that the first fetch shows the cold cost and the peak
+RSS is that of a single query. The data folder is generated with benchmarks/generators.py when it doesn't exist.
+
+    python benchmarks/run.py --data /tmp/memory-bench --scale 0.2
+    python benchmarks/run.py --data /tmp/memory-bench --providers Whatsapp,Instagram --shapes day,full
+    python benchmarks/run.py --data /tmp/memory-bench --save-baseline before
+    python benchmarks/run.py --data /tmp/memory-bench --compare before
+
+Baselines are saved in benchmarks/baselines, which is not committed: the timings only compare on the machine and at
+the scale they were taken with. To check a change, save a baseline on the commit before it, then compare on the change.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from datetime import date
+
+MEMORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINES_PATH = os.path.join(MEMORY_PATH, 'benchmarks', 'baselines')
+sys.path.insert(0, MEMORY_PATH)
+
+# Providers that have a synthetic export generator
+PROVIDERS = ['Whatsapp', 'Instagram', 'iMessage', 'Google Maps', 'Uber', 'Diary', 'Hinge']
+
+# fetch() arguments of every query shape
+SHAPES = {
+    'day': {'on_date': date(2021, 6, 15)},
+    'month': {'start_date': date(2021, 6, 1), 'end_date': date(2021, 6, 30)},
+    'year': {'start_date': date(2021, 1, 1), 'end_date': date(2021, 12, 31)},
+    'full': {'start_date': date(2000, 1, 1), 'end_date': date(2050, 1, 1)},
+    'search': {'start_date': date(2000, 1, 1), 'end_date': date(2050, 1, 1), 'search_regex': 'movie'},
+}
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB and macOS reports bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+async def _measure(provider_name: str, shape: str, repeat: int) -> dict:
+    from configs import load_provider_class
+
+    provider = load_provider_class(provider_name)()
+    timings = []
+    messages = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        memories = await provider.fetch(**SHAPES[shape])
+        timings.append(time.perf_counter() - start)
+        messages = len(memories)
+
+    warm = statistics.median(timings[1:]) if len(timings) > 1 else timings[0]
+    return {
+        'first_s': round(timings[0], 4),
+        'warm_s': round(warm, 4),
+        'messages': messages,
+        'throughput_msgs_s': round(messages / warm) if warm else 0,
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+    }
+
+
+def run_worker(provider_name: str, shape: str, repeat: int):
+    """
+    Measure one provider and query shape. Runs in the data folder and prints the result as the last line.
+    """
+    import init
+    init.init()
+    # Keep the providers' own logs out of the result
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        result = asyncio.run(_measure(provider_name, shape, repeat))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    print(json.dumps(result))
+
+
+def run_case(data: str, provider_name: str, shape: str, repeat: int) -> dict:
+    env = {
+        **os.environ,
+        'ENABLED_PROVIDERS': ','.join(PROVIDERS),
+        'DIARY_PATH': os.path.join(data, 'diary'),
+        'PYTHONPATH': os.pathsep.join(filter(None, [MEMORY_PATH, os.environ.get('PYTHONPATH')])),
+    }
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', provider_name, shape,
+                             '--repeat', str(repeat)],
+                            cwd=data, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        return {'error': result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'failed'}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """
+    Print the change of the warm latency and peak RSS against the baseline.
+    :return: True if anything regressed more than the threshold
+    """
+    regressed = False
+    print(f"\n{'case':<24} {'warm':>10} {'baseline':>10} {'change':>8}   {'rss':>8} {'baseline':>8}")
+    for case, result in results.items():
+        before = baseline.get(case)
+        if not before or 'error' in result or 'error' in before:
+            continue
+        change = (result['warm_s'] - before['warm_s']) / before['warm_s'] if before['warm_s'] else 0
+        flag = ''
+        if change > threshold:
+            flag = 'REGRESSION'
+            regressed = True
+        elif change < -threshold:
+            flag = 'faster'
+        print(f"{case:<24} {result['warm_s']:>9.3f}s {before['warm_s']:>9.3f}s {change:>+7.0%}   "
+              f"{result['peak_rss_mb']:>6.0f}MB {before['peak_rss_mb']:>6.0f}MB {flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark provider fetches on synthetic exports')
+    parser.add_argument('--data', default='/tmp/memory-bench', help='Folder of the synthetic exports')
+    parser.add_argument('--scale', type=float, default=0.2, help='Scale of the exports, if they are generated')
+    parser.add_argument('--providers', default=','.join(PROVIDERS), help='Comma separated providers')
+    parser.add_argument('--shapes', default=','.join(SHAPES), help='Comma separated query shapes')
+    parser.add_argument('--repeat', type=int, default=3, help='Fetches per case, the first one is reported apart')
+    parser.add_argument('--save-baseline', help='Save the results as this baseline')
+    parser.add_argument('--compare', help='Compare the results with this baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Slowdown reported as a regression')
+    parser.add_argument('--worker', nargs=2, metavar=('PROVIDER', 'SHAPE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(*args.worker, args.repeat)
+        return
+
+    baseline = None
+    if args.compare:
+        # Checked before the run, which can take minutes
+        baseline_path = os.path.join(BASELINES_PATH, f'{args.compare}.json')
+        if not os.path.exists(baseline_path):
+            print(f"No baseline {args.compare}, save one first with --save-baseline {args.compare}")
+            sys.exit(2)
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+    data = os.path.abspath(args.data)
+    if not os.path.exists(data):
+        from benchmarks.generators import generate_all
+        generate_all(data, args.scale)
+
+    results = {}
+    print(f"{'case':<24} {'first':>9} {'warm':>9} {'messages':>9} {'msgs/s':>10} {'rss':>8}")
+    for provider_name in args.providers.split(','):
+        for shape in args.shapes.split(','):
+            case = f'{provider_name}/{shape}'
+            result = run_case(data, provider_name, shape, args.repeat)
+            results[case] = result
+            if 'error' in result:
+                print(f"{case:<24} error: {result['error']}")
+                continue
+            print(f"{case:<24} {result['first_s']:>8.3f}s {result['warm_s']:>8.3f}s {result['messages']:>9} "
+                  f"{result['throughput_msgs_s']:>10} {result['peak_rss_mb']:>6.0f}MB")
+
+    if args.save_baseline:
+        os.makedirs(BASELINES_PATH, exist_ok=True)
+        with open(os.path.join(BASELINES_PATH, f'{args.save_baseline}.json'), 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Saved baseline {args.save_baseline}")
+
+    if args.compare:
+        sys.exit(1 if compare(results, baseline, args.threshold) else 0)
+
+
+if __name__ == '__main__':
+    main()
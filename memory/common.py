@@ -1,14 +1,56 @@
 import asyncio
+import time
 from collections import defaultdict
 from datetime import date
 from threading import Lock
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Mapping, Iterator
 
-from configs import get_available_providers
+import metrics
+from configs import get_available_providers, load_provider_class
 from profile import get_display_name_from_name
+from profiling import get_current_profile
 from provider.base_provider import MemoryProvider, Message, MediaType
 
 
+class LazyProviders(Mapping):
+    """
+    Mapping of provider name to provider instance. A provider's module is imported and the provider is constructed
+    the first time it is looked up, so startup does not pay for providers that are never used.
+    """
+
+    def __init__(self, names: List[str]):
+        self._names = names
+        self._instances: Dict[str, MemoryProvider] = {}
+        self._lock = Lock()
+
+    def __getitem__(self, name: str) -> MemoryProvider:
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+        if name not in self._names:
+            raise KeyError(name)
+        with self._lock:
+            if name not in self._instances:
+                print(f"Loading provider {name}")
+                self._instances[name] = load_provider_class(name)()
+        return self._instances[name]
+
+    def __contains__(self, name) -> bool:
+        return name in self._names
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._names)
+
+    def loaded(self) -> Dict[str, MemoryProvider]:
+        """
+        Get the providers constructed so far, without loading the others.
+        """
+        return dict(self._instances)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+
 class MemoryAggregator:
     _instance = None
     _lock = Lock()
@@ -16,10 +58,7 @@ class MemoryAggregator:
     def __init__(self):
         if hasattr(self, '_initialized') and self._initialized:
             return
-        self.providers: Dict[str, MemoryProvider] = {}
-
-        for provider in get_available_providers():
-            self.providers[provider.NAME] = provider()
+        self.providers: Mapping[str, MemoryProvider] = LazyProviders(get_available_providers())
         self._initialized = True
 
     @classmethod
@@ -29,16 +68,39 @@ class MemoryAggregator:
                 cls._instance = cls()
         return cls._instance
 
+    async def _fetch(self, provider: str, **kwargs) -> List[Message]:
+        """
+        Fetch from a provider, recording its latency, the messages it returned and its errors, also in the request's
+        profile when it is profiled.
+        """
+        request_profile = get_current_profile()
+        start = time.perf_counter()
+        try:
+            with metrics.track_errors(provider, 'fetch'):
+                messages = await self.providers[provider].fetch(**kwargs)
+        except Exception as e:
+            if request_profile:
+                request_profile.record_provider(provider, time.perf_counter() - start, error=repr(e))
+            raise
+        elapsed = time.perf_counter() - start
+        metrics.PROVIDER_FETCH_SECONDS.observe(elapsed, provider)
+        metrics.PROVIDER_MESSAGES.inc(provider, amount=len(messages))
+        if request_profile:
+            request_profile.record_provider(provider, elapsed, len(messages))
+        return messages
+
     async def aggregate(self, on_date: date,
                         ignore_groups: bool = False,
                         exclude_system_messages: bool = True) -> List[Message]:
         tasks = [
-            provider.fetch(on_date=on_date,
-                           ignore_groups=ignore_groups,
-                           exclude_system_messages=exclude_system_messages)
-            for provider in self.providers.values()
+            self._fetch(name,
+                        on_date=on_date,
+                        ignore_groups=ignore_groups,
+                        exclude_system_messages=exclude_system_messages)
+            for name in self.providers
         ]
-        results = await asyncio.gather(*tasks)
+        with metrics.AGGREGATE_SECONDS.time('date'):
+            results = await asyncio.gather(*tasks)
 
         events = [event for sublist in results for event in sublist if not event.is_hidden()]
         events.sort(key=lambda x: x.datetime)
@@ -50,11 +112,12 @@ class MemoryAggregator:
         available_providers = providers or self.providers.keys()
         senders = [senders] if senders and isinstance(senders, str) else senders
         tasks = [
-            self.providers.get(provider).fetch(start_date=start_date, end_date=end_date, ignore_groups=ignore_groups,
-                                               exclude_system_messages=exclude_system_messages,
-                                               senders=senders, search_regex=search) for provider in available_providers
+            self._fetch(provider, start_date=start_date, end_date=end_date, ignore_groups=ignore_groups,
+                        exclude_system_messages=exclude_system_messages,
+                        senders=senders, search_regex=search) for provider in available_providers
         ]
-        providers_events_list = await asyncio.gather(*tasks)
+        with metrics.AGGREGATE_SECONDS.time('dates'):
+            providers_events_list = await asyncio.gather(*tasks)
 
         all_events: List[Message] = []
         for events_by_provider in providers_events_list:
@@ -143,4 +206,8 @@ class MemoryAggregator:
     async def get_asset(self, provider: str, asset_id: str) -> Optional[List[str]]:
         if provider not in self.providers:
             return None
-        return await self.providers[provider].get_asset(asset_id)
+        with metrics.track_errors(provider, 'asset'), metrics.ASSET_SECONDS.time(provider):
+            asset = await self.providers[provider].get_asset(asset_id)
+        if asset and asset[0]:
+            metrics.ASSET_BYTES.inc(provider, amount=len(asset[0]))
+        return asset
@@ -1,40 +1,49 @@
 # This file has all the customizations for setups
+import importlib
 import os
 
 USER = "Ritik"
 
 
-def get_available_providers() -> list:
-    from provider.diary_provider import DiaryProvider
-    from provider.google_photos_provider import GooglePhotosProvider
-    from provider.immich_provider import ImmichProvider
-    from provider.instagram_provider import InstagramProvider
-    from provider.whatsapp_provider import WhatsAppProvider
-    from provider.imessage_provider import IMessageProvider
-    from provider.hinge_provider import HingeProvider
-    from provider.google_maps_provider import GoogleMapsProvider
-    from provider.uber_provider import UberProvider
+# Provider name to the class implementing it. Modules are only imported when the provider is first used
+PROVIDER_REGISTRY = {
+    "Whatsapp": "provider.whatsapp_provider.WhatsAppProvider",
+    "Instagram": "provider.instagram_provider.InstagramProvider",
+    "Diary": "provider.diary_provider.DiaryProvider",
+    "Immich": "provider.immich_provider.ImmichProvider",
+    "Google Photos": "provider.google_photos_provider.GooglePhotosProvider",
+    "iMessage": "provider.imessage_provider.IMessageProvider",
+    "Hinge": "provider.hinge_provider.HingeProvider",
+    "Google Maps": "provider.google_maps_provider.GoogleMapsProvider",
+    "Uber": "provider.uber_provider.UberProvider",
+}
+
 
+def get_available_providers() -> list:
+    """
+    Get the names of the providers enabled in .env, without importing them.
+    :return: List of provider names, in PROVIDER_REGISTRY order
+    """
     # Only get providers that are in .env
     enabled_providers = os.environ.get('ENABLED_PROVIDERS', '').split(',')
     enabled_providers = [provider.strip().lower() for provider in enabled_providers]
 
-    all_providers = [
-        WhatsAppProvider,
-        InstagramProvider,
-        DiaryProvider,
-        ImmichProvider,
-        GooglePhotosProvider,
-        IMessageProvider,
-        HingeProvider,
-        GoogleMapsProvider,
-        UberProvider,
-    ]
+    all_providers = list(PROVIDER_REGISTRY.keys())
 
     if not enabled_providers:
         return all_providers
 
-    return [provider for provider in all_providers if provider.NAME.lower() in enabled_providers]
+    return [provider for provider in all_providers if provider.lower() in enabled_providers]
+
+
+def load_provider_class(name: str):
+    """
+    Import the module of a provider and return its class.
+    :param name: Provider name from PROVIDER_REGISTRY
+    :return: The provider class
+    """
+    module_name, class_name = PROVIDER_REGISTRY[name].rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
 
 
 # These are the words that are removed from the most common words list
@@ -0,0 +1,136 @@
+import time
+import zipfile
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from typing import Dict, Tuple, List, Iterator
+
+import archives
+
+# Seconds. Covers a cached lookup up to a full history parse
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = Lock()
+
+
+def _format_labels(label_names: Tuple[str, ...], label_values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        with _lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for label_values, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{_format_labels(self.label_names, label_values)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        # Per label values: count of each bucket (not cumulative, the last one is +Inf), sum and count
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *label_values):
+        with _lock:
+            counts, total = self._values.setdefault(label_values, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, *label_values) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for label_values, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.label_names, label_values, f'le="{bucket}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{self.name}_bucket{_format_labels(self.label_names, label_values, 'le="+Inf"')} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, label_values)} {total[0]}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, label_values)} {cumulative}')
+        return lines
+
+
+PROVIDER_FETCH_SECONDS = Histogram('memory_provider_fetch_seconds', 'Time taken by a provider fetch',
+                                   ('provider',))
+PROVIDER_MESSAGES = Counter('memory_provider_messages_total', 'Messages returned by provider fetches', ('provider',))
+PROVIDER_ERRORS = Counter('memory_provider_errors_total', 'Failed provider calls', ('provider', 'operation'))
+PROVIDER_BYTES_READ = Counter('memory_provider_bytes_read_total', 'Bytes of exports and caches read by providers',
+                              ('provider',))
+PROVIDER_CACHE = Counter('memory_provider_cache_total', 'Provider cache lookups', ('provider', 'cache', 'result'))
+ASSET_SECONDS = Histogram('memory_asset_seconds', 'Time taken to get an asset from a provider', ('provider',))
+ASSET_BYTES = Counter('memory_asset_bytes_total', 'Bytes of assets served', ('provider',))
+AGGREGATE_SECONDS = Histogram('memory_aggregate_seconds', 'Time taken to aggregate the providers', ('operation',))
+REQUEST_SECONDS = Histogram('memory_request_seconds', 'Time taken to serve a request', ('endpoint', 'status'))
+
+ALL_METRICS = [PROVIDER_FETCH_SECONDS, PROVIDER_MESSAGES, PROVIDER_ERRORS, PROVIDER_BYTES_READ, PROVIDER_CACHE,
+               ASSET_SECONDS, ASSET_BYTES, AGGREGATE_SECONDS, REQUEST_SECONDS]
+
+
+def add_bytes_read(provider: str, amount: int):
+    PROVIDER_BYTES_READ.inc(provider, amount=amount)
+
+
+def add_files_read(provider: str, paths: List[str]):
+    """
+    Count the sizes of files a provider parsed, for reads that happen in parse workers.
+    """
+    total = 0
+    for path in paths:
+        try:
+            total += archives.getsize(path)
+        except (OSError, zipfile.BadZipFile):
+            pass
+    add_bytes_read(provider, total)
+
+
+def cache_lookup(provider: str, cache: str, hit: bool):
+    PROVIDER_CACHE.inc(provider, cache, 'hit' if hit else 'miss')
+
+
+@contextmanager
+def track_errors(provider: str, operation: str) -> Iterator[None]:
+    try:
+        yield
+    except Exception:
+        PROVIDER_ERRORS.inc(provider, operation)
+        raise
+
+
+def render() -> str:
+    """
+    All the metrics in the Prometheus text format
+    """
+    with _lock:
+        lines = [line for metric in ALL_METRICS for line in metric.render()]
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,75 @@
+import asyncio
+import atexit
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Iterable, List, Any, Optional
+from weakref import WeakKeyDictionary
+
+# Parsing exports is CPU bound. The jobs run in a pool of processes so that they can use more than one core.
+# Set PARSE_WORKERS=0 to parse in the server process instead.
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', os.cpu_count() or 1))
+# Maximum number of jobs submitted at once, per event loop. This bounds the results held in memory
+PARSE_CONCURRENCY = int(os.getenv('PARSE_CONCURRENCY', max(PARSE_WORKERS, 1) * 2))
+
+_executor: Optional[ProcessPoolExecutor] = None
+# Flask runs every async view in a new event loop and a semaphore can only be used in one
+_semaphores: WeakKeyDictionary = WeakKeyDictionary()
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        print(f"Starting parse pool with {PARSE_WORKERS} workers")
+        # Forking a threaded server is unsafe, spawn works the same on every platform
+        _executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+atexit.register(shutdown_executor)
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(PARSE_CONCURRENCY)
+    return semaphore
+
+
+async def run_parse_job(fn: Callable, *args) -> Any:
+    """
+    Run a parse job in the process pool.
+    :param fn: Module level function or static method, so that it can be pickled. Its arguments and result must be
+    picklable as well, prefer plain tuples over objects for the result.
+    :param args: Positional arguments of fn
+    :return: Result of fn
+    """
+    if PARSE_WORKERS <= 0:
+        return fn(*args)
+
+    async with _get_semaphore():
+        try:
+            return await asyncio.get_running_loop().run_in_executor(get_executor(), fn, *args)
+        except BrokenProcessPool:
+            # A worker died. Start a new pool for the next jobs
+            shutdown_executor()
+            raise
+
+
+async def run_parse_jobs(fn: Callable, jobs: Iterable[tuple]) -> List[Any]:
+    """
+    Run a parse job for every argument tuple in the process pool.
+    :param fn: See run_parse_job
+    :param jobs: Positional arguments of fn for every job
+    :return: Results in the order of the jobs
+    """
+    return await asyncio.gather(*[run_parse_job(fn, *job) for job in jobs])
@@ -0,0 +1,158 @@
+import importlib.util
+import io
+import json
+import os
+import pstats
+import re
+import sys
+import sysconfig
+import time
+import tracemalloc
+from contextvars import ContextVar
+from datetime import datetime
+from threading import Lock
+from typing import Optional, Dict
+
+# Comma separated endpoints (URL rules) profiled on every request, e.g. PROFILE_ENDPOINTS=/chat_data,/circle_data
+PROFILE_ENDPOINTS = {endpoint.strip() for endpoint in os.getenv('PROFILE_ENDPOINTS', '').split(',') if endpoint.strip()}
+# Requests with this header are profiled when the server runs with DEBUG=True
+PROFILE_HEADER = 'X-Memory-Profile'
+PROFILES_PATH = 'data/profiles'
+# Frames kept for each allocation in the tracemalloc snapshot
+TRACEMALLOC_FRAMES = int(os.getenv('PROFILE_TRACEMALLOC_FRAMES', 5))
+TOP_FUNCTIONS = 60
+TOP_ALLOCATIONS = 30
+
+# cProfile and tracemalloc are process wide, so one request is profiled at a time
+_profile_lock = Lock()
+_current_profile: ContextVar[Optional['RequestProfile']] = ContextVar('current_profile', default=None)
+_cprofile = None
+
+
+def _load_cprofile():
+    """
+    Import cProfile. It imports the standard library's profile module, which our profile.py shadows, so the standard
+    one is put in sys.modules while cProfile is imported.
+    """
+    global _cprofile
+    if _cprofile is not None:
+        return _cprofile
+    spec = importlib.util.spec_from_file_location('profile', os.path.join(sysconfig.get_path('stdlib'), 'profile.py'))
+    stdlib_profile = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(stdlib_profile)
+    app_profile = sys.modules.get('profile')
+    sys.modules['profile'] = stdlib_profile
+    try:
+        import cProfile
+    finally:
+        if app_profile is not None:
+            sys.modules['profile'] = app_profile
+        else:
+            del sys.modules['profile']
+    _cprofile = cProfile
+    return _cprofile
+
+
+def should_profile(endpoint: str, headers, debug: bool) -> bool:
+    if endpoint in PROFILE_ENDPOINTS:
+        return True
+    return debug and headers.get(PROFILE_HEADER, '').lower() in ('1', 'true', 'yes')
+
+
+class RequestProfile:
+    """
+    cProfile and tracemalloc capture of one request, with the time each provider took to fetch.
+
+    Async views run on the persistent event loop's thread. From Python 3.12 cProfile observes every thread, so the
+    view's coroutine is captured too, along with anything else the server ran at the same time. Work done in the parse
+    workers shows up as waiting on their results.
+    """
+
+    def __init__(self, endpoint: str, params: dict):
+        self.endpoint = endpoint
+        self.params = params
+        self.providers: Dict[str, dict] = {}
+        self._profiler = _load_cprofile().Profile()
+        self._start = None
+        self._started_tracemalloc = False
+
+    @staticmethod
+    def start(endpoint: str, params: dict) -> Optional['RequestProfile']:
+        """
+        Start profiling the current request.
+        :return: The profile, or None if another request is being profiled
+        """
+        if not _profile_lock.acquire(blocking=False):
+            print(f"Not profiling {endpoint}, another request is being profiled")
+            return None
+        profile = RequestProfile(endpoint, params)
+        _current_profile.set(profile)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            profile._started_tracemalloc = True
+        tracemalloc.reset_peak()
+        profile._start = time.perf_counter()
+        profile._profiler.enable()
+        return profile
+
+    def record_provider(self, provider: str, seconds: float, messages: int = None, error: str = None):
+        entry = self.providers.setdefault(provider, {"calls": 0, "seconds": 0.0, "messages": 0, "errors": []})
+        entry["calls"] += 1
+        entry["seconds"] += seconds
+        entry["messages"] += messages or 0
+        if error:
+            entry["errors"].append(error)
+
+    def stop(self, status: int) -> str:
+        """
+        Stop profiling and write the report.
+        :param status: Status code of the response
+        :return: Path of the report
+        """
+        try:
+            self._profiler.disable()
+            duration = time.perf_counter() - self._start
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+            _current_profile.set(None)
+            return self._write(status, duration, peak, snapshot)
+        finally:
+            _profile_lock.release()
+
+    def _write(self, status: int, duration: float, peak: int, snapshot: tracemalloc.Snapshot) -> str:
+        os.makedirs(PROFILES_PATH, exist_ok=True)
+        name = re.sub(r'[^A-Za-z0-9]+', '_', self.endpoint).strip('_') or 'root'
+        base_path = os.path.join(PROFILES_PATH, f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}_{name}")
+
+        # Raw stats, for snakeviz or pstats
+        self._profiler.dump_stats(f'{base_path}.prof')
+        stats_output = io.StringIO()
+        pstats.Stats(self._profiler, stream=stats_output).sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        allocations = [
+            {"size_kb": round(stat.size / 1024, 1), "count": stat.count, "traceback": stat.traceback.format()}
+            for stat in snapshot.statistics('traceback')[:TOP_ALLOCATIONS]
+        ]
+
+        report = {
+            "endpoint": self.endpoint,
+            "params": self.params,
+            "status": status,
+            "duration_s": round(duration, 4),
+            "peak_traced_memory_mb": round(peak / (1024 * 1024), 2),
+            "providers": {provider: {**entry, "seconds": round(entry["seconds"], 4)}
+                          for provider, entry in sorted(self.providers.items(), key=lambda x: -x[1]["seconds"])},
+            "allocations": allocations,
+            "functions": stats_output.getvalue().splitlines(),
+        }
+        with open(f'{base_path}.json', 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+        print(f"Profiled {self.endpoint} in {duration:.2f}s, report at {base_path}.json")
+        return f'{base_path}.json'
+
+
+def get_current_profile() -> Optional[RequestProfile]:
+    return _current_profile.get()
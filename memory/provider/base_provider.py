@@ -1,15 +1,19 @@
 import asyncio
+import json
 import os
 import re
 import tempfile
 from abc import ABC, abstractmethod
+from collections import deque, defaultdict
 from datetime import datetime, timedelta, date
 from enum import Enum
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Tuple, Optional, AsyncIterator, Callable
 
 import aiofiles
 
+import metrics
 from privacy import is_hidden
+from utils import file_fingerprint
 
 
 class MessageType(Enum):
@@ -37,22 +41,61 @@ class Compressions(Enum):
     NO_VIDEO = "NO_VIDEO"
 
 
+class FetchGranularity(Enum):
+    # Widest date range a provider's fetch() can answer in one call
+    DAY = 'day'
+    MONTH = 'month'
+    RANGE = 'range'
+
+
 class Message:
     def __init__(self, _datetime: datetime, message_type: MessageType = None, message: Optional[str] = '', sender='',
                  provider=None, context: dict = None, chat_name=None, is_group: bool = False,
-                 media_type: MediaType = MediaType.TEXT, formatting: List[dict] = None
+                 media_type: MediaType = MediaType.TEXT, formatting: List[dict] = None,
+                 formatter: Callable[[str], Tuple[str, List[dict]]] = None
                  ):
+        """
+        :param formatter: Gives the clean text and the formatting of the raw message. It runs the first time the
+        message or its formatting is read, so messages that are only counted or filtered by date never pay for it.
+        It has to be picklable, like a static method, to send the message back from the parse workers.
+        """
 
         self.datetime = _datetime
         self.message_type = message_type
-        self.message = message or ''
+        self._message = message or ''
         self.sender = sender
         self.provider = provider
         self.context = context
         self.chat_name = chat_name
         self.is_group = is_group
         self.media_type = media_type
-        self.formatting = formatting or []
+        self._formatting = formatting or []
+        self._formatter = formatter
+
+    def _apply_formatter(self):
+        formatter, self._formatter = self._formatter, None
+        self._message, self._formatting = formatter(self._message)
+
+    @property
+    def message(self) -> str:
+        if self._formatter is not None:
+            self._apply_formatter()
+        return self._message
+
+    @message.setter
+    def message(self, value: str):
+        self._message = value
+        self._formatter = None
+
+    @property
+    def formatting(self) -> List[dict]:
+        if self._formatter is not None:
+            self._apply_formatter()
+        return self._formatting
+
+    @formatting.setter
+    def formatting(self, value: List[dict]):
+        self._formatting = value
 
     def to_dict(self):
         return {
@@ -68,6 +111,31 @@ class Message:
             'formatting': self.formatting
         }
 
+    def to_row(self) -> tuple:
+        """
+        Compact form of the message, cheap to pickle. Used to send messages back from the parse workers.
+        """
+        # The raw message and its formatter, so the formatting stays lazy
+        return (self.datetime, self.message_type.value if self.message_type else None, self._message, self.sender,
+                self.provider, self.context, self.chat_name, self.is_group, self.media_type.value, self._formatting,
+                self._formatter)
+
+    @staticmethod
+    def from_row(row: tuple) -> 'Message':
+        (_datetime, message_type, message, sender, provider, context, chat_name, is_group, media_type, formatting,
+         formatter) = row
+        return Message(_datetime,
+                       message_type=MessageType(message_type) if message_type else None,
+                       message=message,
+                       sender=sender,
+                       provider=provider,
+                       context=context,
+                       chat_name=chat_name,
+                       is_group=is_group,
+                       media_type=MediaType(media_type),
+                       formatting=formatting,
+                       formatter=formatter)
+
     def is_hidden(self):
         return is_hidden(self)
 
@@ -81,12 +149,28 @@ class Message:
     def __str__(self):
         return f"{self.datetime} - {self.sender}: {self.message}"
 
+# Persisted metadata manifests by provider name
+_PROVIDER_MANIFESTS: Dict[str, dict] = {}
+
+
 class MemoryProvider(ABC):
     NAME = None
     SYSTEM = 'system'
     UNKNOWN = 'unknown'
     MINIMUM_DATE = datetime(2000, 1, 1)
     MAXIMUM_DATE = datetime(2050, 1, 1)
+    MANIFESTS_PATH = 'data/manifests'
+    # Providers that only answer fetch(on_date) keep DAY. Set MONTH or RANGE when fetch() handles start_date/end_date
+    FETCH_GRANULARITY = FetchGranularity.DAY
+    # Number of planned fetches run at the same time
+    FETCH_CONCURRENCY = 8
+    # Set when _compute_source_metadata is implemented, so that only the source files that changed are read again
+    PER_SOURCE_METADATA = False
+    # Bump when _compute_source_metadata returns something new, so that the sources are read again once
+    SOURCE_METADATA_VERSION = 1
+    # Monotonic time at which the source watcher took its first snapshot of the provider's source files. Every change
+    # after it is passed to on_sources_changed. None while the sources aren't watched
+    sources_watched_since: Optional[float] = None
 
     @staticmethod
     def _sender_matched(sender, allowed_senders: List[str]):
@@ -151,8 +235,8 @@ class MemoryProvider(ABC):
                                             senders=senders, search_regex=search_regex)
         else:
             all_messages = await self.fetch_dates(
-                start_date=start_date,
-                end_date=end_date,
+                start_date=start_date or MemoryProvider.MINIMUM_DATE.date(),
+                end_date=end_date or MemoryProvider.MAXIMUM_DATE.date(),
                 ignore_groups=ignore_groups,
                 exclude_system_messages=exclude_system_messages,
                 senders=senders,
@@ -179,23 +263,100 @@ class MemoryProvider(ABC):
         :param exclude_system_messages: Exclude system messages
         :param senders: Only fetch messages from these senders
         :param search_regex: search_regex for this string in message content
-        :return: Dict of dates and messages for each date
+        :return: Dict of dates and messages for each date that has messages
         """
-        tasks = []
-        dates = []
-
+        results = defaultdict(list)
+        async for message in self.stream(start_date, end_date,
+                                         ignore_groups=ignore_groups,
+                                         exclude_system_messages=exclude_system_messages,
+                                         senders=senders, search_regex=search_regex):
+            results[message.datetime.date()].append(message)
+        return results
+
+    def _plan_fetch(self, start_date: date, end_date: date) -> List[Tuple[date, date]]:
+        """
+        Split the date range into the windows the provider is fetched with, based on FETCH_GRANULARITY.
+        The range is first clamped to the known extents of the provider's data, so days outside it are never read.
+        :param start_date: Smaller date (inclusive)
+        :param end_date: Larger date (inclusive)
+        :return: Ordered, non-overlapping list of (start_date, end_date) windows
+        """
+        # Only the persisted extents are used, if the source files didn't change since. Computing them here would
+        # recurse through fetch()
+        manifest = self._load_manifest()
+        if manifest and manifest['sources'] == {path: file_fingerprint(path) for path in self.get_source_paths()}:
+            metadata = manifest['metadata']
+            if metadata['start_date'] is None:
+                return []
+            start_date = max(start_date, date.fromisoformat(metadata['start_date']))
+            end_date = min(end_date, date.fromisoformat(metadata['end_date']))
+
+        if start_date > end_date:
+            return []
+
+        if self.FETCH_GRANULARITY == FetchGranularity.RANGE:
+            return [(start_date, end_date)]
+
+        windows = []
         current = start_date
         while current <= end_date:
-            tasks.append(self.fetch(current, ignore_groups=ignore_groups,
-                                    exclude_system_messages=exclude_system_messages,
-                                    senders=senders, search_regex=search_regex))
-            dates.append(current)
-            current += timedelta(days=1)
+            if self.FETCH_GRANULARITY == FetchGranularity.MONTH:
+                next_month = (current.replace(day=1) + timedelta(days=32)).replace(day=1)
+                window_end = min(next_month - timedelta(days=1), end_date)
+            else:
+                window_end = current
+            windows.append((current, window_end))
+            current = window_end + timedelta(days=1)
+        return windows
+
+    async def _fetch_window(self, start_date: date, end_date: date, **kwargs) -> List[Message]:
+        if self.FETCH_GRANULARITY == FetchGranularity.DAY:
+            messages = await self.fetch(on_date=start_date, **kwargs)
+        else:
+            messages = await self._fetch_range(start_date, end_date, **kwargs)
+        return sorted(messages, key=lambda m: m.datetime)
 
-        results = await asyncio.gather(*tasks)
-        return dict(zip(dates, results))
+    async def _fetch_range(self, start_date: date, end_date: date, **kwargs) -> List[Message]:
+        """
+        Fetch one window planned for a MONTH or RANGE provider. By default, this calls fetch() with the window, for
+        providers whose fetch() reads ranges. Providers that leave range queries of fetch() to the planner read the
+        window here instead.
+        :param start_date: Smaller date (inclusive)
+        :param end_date: Larger date (inclusive)
+        :param kwargs: Filters passed on to fetch()
+        :return: Messages of the window
+        """
+        return await self.fetch(start_date=start_date, end_date=end_date, **kwargs)
+
+    async def stream(self, start_date: date, end_date: date, **kwargs) -> AsyncIterator[Message]:
+        """
+        Stream all messages between start_date and end_date, time sorted.
+        The range is fetched in the windows from _plan_fetch(), at most FETCH_CONCURRENCY at a time. Windows do not
+        overlap, so yielding them in order keeps the stream sorted.
+        :param start_date: Smaller date (inclusive)
+        :param end_date: Larger date (inclusive)
+        :param kwargs: Filters passed on to fetch()
+        :return: Async iterator of messages
+        """
+        pending = deque()
+        try:
+            for window_start, window_end in self._plan_fetch(start_date, end_date):
+                pending.append(asyncio.ensure_future(self._fetch_window(window_start, window_end, **kwargs)))
+                if len(pending) >= self.FETCH_CONCURRENCY:
+                    for message in await pending.popleft():
+                        yield message
+
+            while pending:
+                for message in await pending.popleft():
+                    yield message
+        finally:
+            for task in pending:
+                task.cancel()
 
     async def get_asset(self, image_id: str) -> Tuple[bytes, str]:
+        """
+        :return: The asset and its MIME type. Assets in export zip files are an archives.MemberStream instead of bytes
+        """
         pass
 
     @abstractmethod
@@ -209,12 +370,172 @@ class MemoryProvider(ABC):
         # Override this method to allow specific functions to be exposed to the user. By default, no functions are exposed.
         return []
 
-    async def get_start_end_date(self) -> Tuple[date | None, date | None]:
-        # This is not the most efficient way to do this, but it's the easiest for now.
+    def get_source_paths(self) -> List[str]:
+        """
+        Files the memories are read from. Override this to let the metadata be cached till any of these change.
+        :return: List of file paths
+        """
+        return []
+
+    async def _compute_metadata(self) -> dict:
+        """
+        Compute the metadata from scratch. By default, this fetches all the memories. Override this if the provider has
+        a cheaper way.
+        :return: Dict with start_date, end_date and message_count
+        """
         all_memories = await self.fetch(on_date=None, ignore_groups=False)
-        start_date = min(all_memories, key=lambda m: m.datetime).datetime.date()
-        end_date = max(all_memories, key=lambda m: m.datetime).datetime.date()
-        return start_date, end_date
+        if not all_memories:
+            return {"start_date": None, "end_date": None, "message_count": 0}
+
+        return {
+            "start_date": min(all_memories, key=lambda m: m.datetime).datetime.date(),
+            "end_date": max(all_memories, key=lambda m: m.datetime).datetime.date(),
+            "message_count": len(all_memories),
+        }
+
+    async def _compute_source_metadata(self, path: str) -> dict:
+        """
+        Compute the metadata of one source file, for providers with PER_SOURCE_METADATA.
+        :param path: One of get_source_paths()
+        :return: Dict with start_date, end_date and message_count of the file. Other JSON values are kept as is
+        """
+        raise NotImplementedError
+
+    async def _update_source_metadata(self, sources: Dict[str, Optional[List[int]]], manifest: dict) -> Dict[str, dict]:
+        """
+        Bring the per source metadata of the manifest in line with the sources. The metadata of unchanged files is kept,
+        that of removed files is dropped and only new or changed files are read.
+        :return: Source path to its metadata, with dates in ISO format
+        """
+        previous_sources = manifest.get('sources') or {}
+        previous_metadata = manifest.get('source_metadata') or {}
+        if manifest.get('source_metadata_version', 1) != self.SOURCE_METADATA_VERSION:
+            previous_metadata = {}
+        source_metadata = {path: previous_metadata[path] for path, fingerprint in sources.items()
+                           if path in previous_metadata and previous_sources.get(path) == fingerprint}
+        stale = [path for path, fingerprint in sources.items() if path not in source_metadata and fingerprint]
+        if stale:
+            print(f"Computing metadata of {len(stale)} {self.NAME} sources")
+            for path, metadata in zip(stale, await asyncio.gather(*[self._compute_source_metadata(path)
+                                                                      for path in stale])):
+                source_metadata[path] = {
+                    **metadata,
+                    "start_date": metadata["start_date"].isoformat() if metadata["start_date"] else None,
+                    "end_date": metadata["end_date"].isoformat() if metadata["end_date"] else None,
+                }
+        return source_metadata
+
+    @staticmethod
+    def _rollup_source_metadata(source_metadata: Dict[str, dict]) -> dict:
+        start_dates = [metadata["start_date"] for metadata in source_metadata.values() if metadata["start_date"]]
+        end_dates = [metadata["end_date"] for metadata in source_metadata.values() if metadata["end_date"]]
+        return {
+            # ISO dates sort like the dates
+            "start_date": date.fromisoformat(min(start_dates)) if start_dates else None,
+            "end_date": date.fromisoformat(max(end_dates)) if end_dates else None,
+            "message_count": sum(metadata["message_count"] for metadata in source_metadata.values()),
+        }
+
+    def _load_manifest(self) -> Optional[dict]:
+        """
+        Get the manifest of the provider, reading it from disk if it isn't loaded yet. Nothing is computed, so the
+        manifest may be out of date with the source files.
+        :return: The manifest, or None if there is none yet
+        """
+        manifest = _PROVIDER_MANIFESTS.get(self.NAME)
+        if manifest is None:
+            try:
+                with open(os.path.join(MemoryProvider.MANIFESTS_PATH, f'{self.NAME}.json'), 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                return None
+            _PROVIDER_MANIFESTS[self.NAME] = manifest
+        return manifest
+
+    def get_cached_source_metadata(self, path: str) -> Optional[dict]:
+        """
+        Get the metadata of a source file from the loaded manifest, without computing anything.
+        :return: The metadata (start_date, end_date, message_count and what the provider adds), or None if it isn't
+        known or the file changed since
+        """
+        manifest = _PROVIDER_MANIFESTS.get(self.NAME)
+        if not manifest or path not in manifest.get('source_metadata', {}):
+            return None
+        if manifest['sources'].get(path) != file_fingerprint(path):
+            return None
+        metadata = manifest['source_metadata'][path]
+        return {
+            **metadata,
+            "start_date": date.fromisoformat(metadata["start_date"]) if metadata["start_date"] else None,
+            "end_date": date.fromisoformat(metadata["end_date"]) if metadata["end_date"] else None,
+        }
+
+    async def on_sources_changed(self, changed: List[str], removed: List[str]):
+        """
+        Called by the source watcher once the source files settled after a change. Re-ingest what changed here so that
+        the next query doesn't pay for it. By default, the metadata is refreshed.
+        :param changed: Source files that were added or modified
+        :param removed: Source files that were deleted
+        """
+        await self.get_metadata()
+
+    async def get_metadata(self) -> dict:
+        """
+        Get the extents, the number of messages and the last modified time of the provider's data.
+        The metadata is persisted in a per-provider manifest and only computed again when the source files change,
+        which takes a stat() per source file. With PER_SOURCE_METADATA only the changed files are read again.
+        :return: Dict with start_date, end_date, message_count and last_modified
+        """
+        source_paths = self.get_source_paths()
+        if not source_paths:
+            metadata = await self._compute_metadata()
+            return {**metadata, "last_modified": None}
+
+        sources = {path: file_fingerprint(path) for path in source_paths}
+        manifest = self._load_manifest() or {}
+        manifest_path = os.path.join(MemoryProvider.MANIFESTS_PATH, f'{self.NAME}.json')
+
+        # Manifests written before the provider had PER_SOURCE_METADATA, or its current version of it, are computed again
+        fresh = manifest.get('sources') == sources and (not self.PER_SOURCE_METADATA or (
+                'source_metadata' in manifest
+                and manifest.get('source_metadata_version', 1) == self.SOURCE_METADATA_VERSION))
+        metrics.cache_lookup(self.NAME, 'manifest', fresh)
+        if not fresh:
+            source_metadata = None
+            if self.PER_SOURCE_METADATA:
+                source_metadata = await self._update_source_metadata(sources, manifest)
+                metadata = self._rollup_source_metadata(source_metadata)
+            else:
+                print(f"Computing metadata for {self.NAME}")
+                metadata = await self._compute_metadata()
+            mtimes = [fingerprint[0] for fingerprint in sources.values() if fingerprint]
+            manifest = {
+                "sources": sources,
+                "metadata": {
+                    "start_date": metadata["start_date"].isoformat() if metadata["start_date"] else None,
+                    "end_date": metadata["end_date"].isoformat() if metadata["end_date"] else None,
+                    "message_count": metadata["message_count"],
+                    "last_modified": datetime.fromtimestamp(max(mtimes) / 1e9).isoformat() if mtimes else None,
+                }
+            }
+            if source_metadata is not None:
+                manifest["source_metadata"] = source_metadata
+                manifest["source_metadata_version"] = self.SOURCE_METADATA_VERSION
+            os.makedirs(MemoryProvider.MANIFESTS_PATH, exist_ok=True)
+            async with aiofiles.open(manifest_path, 'w', encoding='utf-8') as f:
+                await f.write(json.dumps(manifest))
+        _PROVIDER_MANIFESTS[self.NAME] = manifest
+
+        metadata = manifest['metadata']
+        return {
+            **metadata,
+            "start_date": date.fromisoformat(metadata["start_date"]) if metadata["start_date"] else None,
+            "end_date": date.fromisoformat(metadata["end_date"]) if metadata["end_date"] else None,
+        }
+
+    async def get_start_end_date(self) -> Tuple[date | None, date | None]:
+        metadata = await self.get_metadata()
+        return metadata["start_date"], metadata["end_date"]
 
     def get_logo(self):
         return f'/asset/{self.NAME}/logo.png'
@@ -1,22 +1,27 @@
-import asyncio
 import os
 import re
 import string
+from collections import defaultdict
 from datetime import datetime, timedelta, date, timezone
 from pathlib import Path
-from typing import List, Optional, Dict
+from typing import List, Optional
 
 import aiofiles
-from black.trans import defaultdict
 
 import configs
-from provider.base_provider import MemoryProvider, MessageType, Message
+import metrics
+from parsing import run_parse_job, run_parse_jobs
+from provider.base_provider import MemoryProvider, MessageType, Message, FetchGranularity
 from utils import load_dictionary, is_valid_word, str_to_bool
 
 
 class DiaryProvider(MemoryProvider):
     NAME = "Diary"
     WORKING = True
+    # Range queries go through the base planner, which clamps them to the years in the diary, see _fetch_range
+    FETCH_GRANULARITY = FetchGranularity.RANGE
+    # Each year file is read again only when it changes
+    PER_SOURCE_METADATA = True
 
     def __init__(self):
         super().__init__()
@@ -39,23 +44,40 @@ class DiaryProvider(MemoryProvider):
     def get_allowed_exposed_functions(self) -> List[str]:
         return ['get_most_word_written']
 
+    def get_source_paths(self) -> List[str]:
+        if not self.WORKING:
+            return []
+        return [os.path.join(self.diary_folder, filename) for filename in os.listdir(self.diary_folder)]
+
+    async def _compute_source_metadata(self, path: str) -> dict:
+        try:
+            rows = await run_parse_job(DiaryProvider.parse_diary_file_rows, path,
+                                       MemoryProvider.MINIMUM_DATE.date(), MemoryProvider.MAXIMUM_DATE.date())
+        except (UnicodeDecodeError, OSError):
+            # Not a diary file
+            rows = []
+        dates = [Message.from_row(row).datetime.date() for _, row in rows]
+        return {
+            "start_date": min(dates) if dates else None,
+            "end_date": max(dates) if dates else None,
+            "message_count": len(dates),
+        }
+
     def supports_home(self) -> bool:
         return self.is_working()
 
     async def _get_all_diary_words(self, pre_transform_fn, filter_fn, hide_personal_entry: bool = True):
-        all_memories = self.fetch_dates(MemoryProvider.MINIMUM_DATE.date(),
-                                        MemoryProvider.MAXIMUM_DATE.date(),
-                                        hide_personal_entry=hide_personal_entry)
         word_count = defaultdict(int)
-        for memories in (await all_memories).values():
-            for memory in memories:
-                try:
-                    for word in memory.message.split():
-                        word = pre_transform_fn(word)
-                        if filter_fn(word):
-                            word_count[word] += 1
-                except Exception as e:
-                    print(f"Error processing memory: {e}")
+        async for memory in self.stream(MemoryProvider.MINIMUM_DATE.date(),
+                                        MemoryProvider.MAXIMUM_DATE.date(),
+                                        hide_personal_entry=hide_personal_entry):
+            try:
+                for word in memory.message.split():
+                    word = pre_transform_fn(word)
+                    if filter_fn(word):
+                        word_count[word] += 1
+            except Exception as e:
+                print(f"Error processing memory: {e}")
         return word_count
 
     async def get_most_word_written(self, min_word_length=1,
@@ -105,8 +127,8 @@ class DiaryProvider(MemoryProvider):
         most_common = sorted(word_count.items(), key=lambda x: x[1], reverse=True)[:40]
         return most_common
 
-    def _get_diary_filepath_for_year(self, year: int):
-        for filename in os.listdir(self.diary_folder):
+    def _get_diary_filepath_for_year(self, year: int, filenames: List[str] = None):
+        for filename in filenames if filenames is not None else os.listdir(self.diary_folder):
             if f"{year}" in filename:
                 return os.path.join(self.diary_folder, filename)
         return None
@@ -217,15 +239,63 @@ class DiaryProvider(MemoryProvider):
         print("Done fetching from Diary")
         return results
 
-    async def fetch_dates(self,
-                          start_date: date,
-                          end_date: date,
-                          senders: List[str] = None,
-                          search_regex: str = None,
-                          hide_personal_entry: bool = False,
-                          **kwargs
-                          ) -> Dict[date, List[Message]]:
-        results: Dict[date, List[Message]] = defaultdict(list)
+    @staticmethod
+    def parse_diary_file_rows(diary_filepath: str,
+                              start_date: date,
+                              end_date: date,
+                              search_regex: str = None,
+                              hide_personal_entry: bool = False) -> List[tuple]:
+        """
+        Parse the entries of a diary file between start_date and end_date in a parse worker.
+        :return: Pairs of the entry date and the message as a row, see Message.to_row()
+        """
+        rows = []
+        pattern = re.compile(search_regex) if search_regex else None
+        dt = None
+
+        with open(diary_filepath, "r", encoding="utf-8") as f:
+            for line in f:
+                _dt, text = DiaryProvider._get_date_and_memory_from_text(line.strip(),
+                                                                         hide_personal_entry=hide_personal_entry)
+
+                # If the date is not available, use the previous date (approximate)
+                # TODO: improve this logic
+                dt = _dt or dt
+
+                if not dt:
+                    continue
+
+                # Assuming lines are sorted ascending, we can stop reading
+                curr_date = dt.date()
+                if curr_date < start_date:
+                    continue
+                if curr_date > end_date:
+                    break
+
+                if pattern and pattern.search(text) is None:
+                    continue
+
+                rows.append((
+                    curr_date,
+                    Message(
+                        _datetime=dt.astimezone(timezone.utc).replace(tzinfo=None),
+                        message=text,
+                        message_type=MessageType.SENT,
+                        provider=DiaryProvider.NAME,
+                        sender=configs.USER
+                    ).to_row()
+                ))
+        return rows
+
+    async def _fetch_range(self,
+                           start_date: date,
+                           end_date: date,
+                           senders: List[str] = None,
+                           search_regex: str = None,
+                           hide_personal_entry: bool = False,
+                           **kwargs
+                           ) -> List[Message]:
+        results: List[Message] = []
         if not self.WORKING:
             return results
 
@@ -237,96 +307,22 @@ class DiaryProvider(MemoryProvider):
             if senders[0].lower() != configs.USER.lower():
                 return results
 
+        jobs = []
+        filenames = os.listdir(self.diary_folder)
         for year in range(start_date.year, end_date.year + 1):
-            diary_filepath = self._get_diary_filepath_for_year(year)
+            diary_filepath = self._get_diary_filepath_for_year(year, filenames)
 
+            # Years without a file are skipped quietly, an open range spans many of them
             if diary_filepath is None:
-                print(f"No diary file found for {year}")
                 continue
 
-            pattern = re.compile(search_regex) if search_regex else None
-            dt = None
-
-            async with aiofiles.open(diary_filepath, "r", encoding="utf-8") as f:
-                async for line in f:
-                    _dt, text = DiaryProvider._get_date_and_memory_from_text(line.strip(),
-                                                                             hide_personal_entry=hide_personal_entry)
-
-                    # If the date is not available, use the previous date (approximate)
-                    # TODO: improve this logic
-                    dt = _dt or dt
-
-                    if not dt:
-                        continue
-
-                    # Assuming lines are sorted ascending, we can stop reading
-                    curr_date = dt.date()
-                    if curr_date < start_date:
-                        continue
-                    if curr_date > end_date:
-                        break
-
-                    if pattern and pattern.search(text) is None:
-                        continue
-
-                    results[curr_date].append(
-                        Message(
-                            _datetime=dt.astimezone(timezone.utc).replace(tzinfo=None),
-                            message=text,
-                            message_type=MessageType.SENT,
-                            provider=self.NAME,
-                            sender=configs.USER
-                        )
-                    )
+            jobs.append((diary_filepath, start_date, end_date, search_regex, hide_personal_entry))
+
+        # Every year is in its own file, parse them on all cores
+        for rows in await run_parse_jobs(DiaryProvider.parse_diary_file_rows, jobs):
+            for _, row in rows:
+                results.append(Message.from_row(row))
+        metrics.add_files_read(self.NAME, [job[0] for job in jobs])
 
         print(f"Done fetching diary entries from {start_date=} to {end_date=}")
         return results
-
-    @staticmethod
-    async def _get_start_end_dates_for_file(filepath) -> tuple[date, date]:
-        """Read one diary file asynchronously and return (start_date, end_date)."""
-        start_date, end_date = None, None
-        async with aiofiles.open(filepath, "r", encoding="utf-8") as f:
-            async for line in f:
-                _dt, _ = DiaryProvider._get_date_and_memory_from_text(line.strip())
-                if not _dt:
-                    continue
-                start_date = min(start_date, _dt) if start_date else _dt
-                end_date = max(end_date, _dt) if end_date else _dt
-        return start_date, end_date
-
-    async def get_start_end_date(self):
-        start_date = None
-        end_date = None
-
-        if not self.WORKING:
-            return start_date, end_date
-
-        print("Starting to fetch from Diary")
-
-        if not (diary_folder := os.getenv("DIARY_PATH")):
-            self.WORKING = False
-            print("Diary folder not found")
-            return start_date, end_date
-
-        diary_folder = Path(diary_folder)
-        if not diary_folder.exists():
-            self.WORKING = False
-            print("Diary folder not found")
-            return start_date, end_date
-
-        tasks = []
-        for filename in os.listdir(diary_folder):
-            diary_filepath = os.path.join(diary_folder, filename)
-            if os.path.isfile(diary_filepath):
-                tasks.append(DiaryProvider._get_start_end_dates_for_file(diary_filepath))
-
-        results = await asyncio.gather(*tasks)
-
-        # combine all start/end dates
-        all_starts = [s for s, _ in results if s]
-        all_ends = [e for _, e in results if e]
-        start_date = min(all_starts) if all_starts else None
-        end_date = max(all_ends) if all_ends else None
-
-        return start_date.date(), end_date.date()
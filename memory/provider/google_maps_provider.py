@@ -5,12 +5,13 @@ from typing import List, Optional, Tuple
 
 import aiofiles
 
-from provider.base_provider import MemoryProvider, MessageType, Message, MediaType
+from provider.base_provider import MemoryProvider, MessageType, Message, MediaType, FetchGranularity
 from utils import human_duration
 
 
 class GoogleMapsProvider(MemoryProvider):
     NAME = "Google Maps"
+    FETCH_GRANULARITY = FetchGranularity.RANGE
     WORKING = True
     GOOGLE_MAPS_PATH = 'data/google_maps'
     LOCATIONS_PATH = f'{GOOGLE_MAPS_PATH}/location-history.json'
@@ -29,6 +30,9 @@ class GoogleMapsProvider(MemoryProvider):
     def get_allowed_exposed_functions(self) -> List[str]:
         return ['get_location_clustering']
 
+    def get_source_paths(self) -> List[str]:
+        return [self.LOCATIONS_PATH] if self.WORKING else []
+
     def supports_home(self) -> bool:
         return self.is_working()
 
@@ -240,21 +244,3 @@ class GoogleMapsProvider(MemoryProvider):
         messages.sort(key=lambda memory: memory.datetime)
         print("Done fetching from Google Maps")
         return messages
-
-    async def get_start_end_date(self):
-        if not self.WORKING:
-            return None, None
-
-        async with aiofiles.open(self.LOCATIONS_PATH, "r", encoding="utf-8") as f:
-            data = json.loads(await f.read())
-
-        dates = []
-        for entry in data:
-            parsed = GoogleMapsProvider.parse_timeline_entry(entry)
-            if parsed and parsed[0]:
-                dates.append(parsed[0])
-
-        if not dates:
-            return None, None
-
-        return min(dates).date(), max(dates).date()
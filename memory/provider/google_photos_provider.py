@@ -3,19 +3,18 @@ import mimetypes
 import os
 import pickle
 import webbrowser
+from bisect import bisect_left
 from collections import defaultdict
-from datetime import date, datetime, timedelta, timezone
+from datetime import date, datetime, time, timedelta, timezone
 from typing import List, Dict, Optional
+from zoneinfo import ZoneInfo
 
 import aiofiles
-import httpx
-import pytz
 from anyio import sleep
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
 
 from provider.base_provider import MemoryProvider, MediaType, Compressions, Message
-from utils import post_with_retries, AsyncDownloadManager
+from serving import http_client
+from utils import post_with_retries, StreamingDownloadManager, DownloadJob
 
 
 class GooglePhotosProvider(MemoryProvider):
@@ -31,9 +30,16 @@ class GooglePhotosProvider(MemoryProvider):
         if not self.WORKING:
             return
         self.token = None
-        self.metadata_context_by_dates = defaultdict(set)
         self.metadata_context_by_id = defaultdict(dict)
+        # Items sorted by their local createTime so that date ranges can be bisected
+        self._sorted_create_times: List[datetime] = []
+        self._sorted_ids: List[str] = []
+        # Rows of the messages (see Message.to_row), built once per item. Every fetch gets new Messages from them, since
+        # the aggregator and the privacy layer change the messages they are given
+        self._rows_by_id: Dict[str, tuple] = {}
         self.session_ids = {}
+        # index.json is parsed on first use so that constructing the provider stays cheap
+        self._index_loaded = False
         os.makedirs(self.GOOGLE_PHOTOS_PATH, exist_ok=True)
         if not os.path.exists(os.path.join(self.GOOGLE_PHOTOS_PATH, "index.json")):
             print("No index.json file found")
@@ -42,14 +48,18 @@ class GooglePhotosProvider(MemoryProvider):
                     "sessions": [],
                     "mediaItems": {}
                 }, f)
-        else:
-            with open(os.path.join(self.GOOGLE_PHOTOS_PATH, "index.json")) as f:
-                d = json.load(f)
-                self.metadata_context_by_id = d.get('mediaItems', {})
-                for _id, item in self.metadata_context_by_id.items():
-                    item['createTime'] = datetime.fromisoformat(item.get('createTime'))
-                    self.metadata_context_by_dates[item['createTime'].date()].add(_id)
-                self.session_ids = d.get('sessions', {}) if d else {}
+
+    def _load_index(self):
+        if self._index_loaded:
+            return
+        with open(os.path.join(self.GOOGLE_PHOTOS_PATH, "index.json")) as f:
+            d = json.load(f)
+            self.metadata_context_by_id = d.get('mediaItems', {})
+            for _id, item in self.metadata_context_by_id.items():
+                item['createTime'] = datetime.fromisoformat(item.get('createTime'))
+            self.session_ids = d.get('sessions', {}) if d else {}
+        self._rebuild_date_index()
+        self._index_loaded = True
 
     def is_working(self):
         return self.WORKING
@@ -61,6 +71,7 @@ class GooglePhotosProvider(MemoryProvider):
         :param compressions: A list of supported compressions. Defaults to None.
         :return:
         """
+        self._load_index()
         self.token = self.get_gphotos_token()
         if create_new_session:
             session_id = await self.start_session(self.token)
@@ -76,6 +87,10 @@ class GooglePhotosProvider(MemoryProvider):
 
     @staticmethod
     def get_gphotos_token():
+        # The OAuth libraries are slow to import and only needed while setting up
+        from google.auth.transport.requests import Request
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
         creds = None
         token_file = os.path.join(GooglePhotosProvider.GOOGLE_PHOTOS_PATH, "token.pkl")
 
@@ -113,7 +128,7 @@ class GooglePhotosProvider(MemoryProvider):
             'Authorization': f'Bearer {token}'
         }
 
-        async with httpx.AsyncClient() as client:
+        async with http_client() as client:
             response = await client.get(url, headers=headers)
 
         if response.status_code != 200:
@@ -162,7 +177,7 @@ class GooglePhotosProvider(MemoryProvider):
         media_items = []
         page_token = None
 
-        async with httpx.AsyncClient() as client:
+        async with http_client() as client:
             while True:
                 params = {
                     "sessionId": session_id,
@@ -199,7 +214,7 @@ class GooglePhotosProvider(MemoryProvider):
             print(f"No media available for session {session_id}")
             return False
         media = await self.get_media_items_for_session(self.token, session_id)
-        manager = AsyncDownloadManager(max_concurrent=10)
+        ist_timezone = ZoneInfo('Asia/Kolkata')
 
         for media_item in media:
             _id = media_item.get('id')
@@ -208,20 +223,7 @@ class GooglePhotosProvider(MemoryProvider):
             file_name = media_item.get('mediaFile').get('filename')
             file_name = f'{_id}___{file_name}'
             utc_dt = datetime.fromisoformat(media_item.get('createTime').replace('Z', '+00:00'))
-            ist_timezone = pytz.timezone('Asia/Kolkata')
             ist_dt = utc_dt.astimezone(ist_timezone)
-            _type = media_item.get('type')
-
-            # schedule fetch with concurrency manager
-            manager.add(
-                self.fetch_asset(
-                    self.token,
-                    base_url,
-                    os.path.join(self.GOOGLE_PHOTOS_PATH, file_name),
-                    _type,
-                    compressions
-                )
-            )
 
             self.metadata_context_by_id[_id] = {
                 "base_url": base_url,
@@ -229,10 +231,24 @@ class GooglePhotosProvider(MemoryProvider):
                 "mime_type": mime_type,
                 "createTime": ist_dt
             }
-            self.metadata_context_by_dates[ist_dt.date()].add(_id)
+            self._rows_by_id.pop(_id, None)
+
+        self._rebuild_date_index()
 
-        # Run downloads in parallel (max 10 at a time)
-        results = await manager.run()
+        def download_jobs():
+            for _media_item in media:
+                job = self.get_download_job(self.token,
+                                            _media_item.get('mediaFile').get('baseUrl'),
+                                            os.path.join(self.GOOGLE_PHOTOS_PATH,
+                                                         self.metadata_context_by_id[_media_item.get('id')]['file_name']),
+                                            _media_item.get('type'),
+                                            compressions)
+                if job:
+                    yield job
+
+        # Stream downloads through a bounded queue (max 10 at a time)
+        manager = StreamingDownloadManager(max_concurrent=10)
+        results = await manager.run(download_jobs(), total=len(media))
 
         # Handle any errors
         for result in results:
@@ -241,24 +257,43 @@ class GooglePhotosProvider(MemoryProvider):
 
         return True
 
+    def _rebuild_date_index(self):
+        # createTime is kept in the local timezone of the item. Drop the tzinfo so that the dates match the local dates
+        index = sorted((item['createTime'].replace(tzinfo=None), _id) for _id, item in self.metadata_context_by_id.items())
+        self._sorted_create_times = [create_time for create_time, _ in index]
+        self._sorted_ids = [_id for _, _id in index]
+
+    def _get_message(self, item_id: str) -> Message:
+        row = self._rows_by_id.get(item_id)
+        if row is None:
+            item = self.metadata_context_by_id[item_id]
+            row = Message(_datetime=item.get('createTime').astimezone(timezone.utc).replace(tzinfo=None),
+                          media_type=MediaType.NON_TEXT,
+                          provider=self.NAME,
+                          context={
+                              "asset_name": item.get('file_name'),
+                              "asset_id": item_id,
+                              "mime_type": item.get('mime_type'),
+                              "new_tab_url": f'/asset/{GooglePhotosProvider.NAME}/{item_id}'
+                          }).to_row()
+            self._rows_by_id[item_id] = row
+
+        message = Message.from_row(row)
+        # The context is a dict of the row, it is copied too
+        message.context = dict(message.context)
+        return message
+
     def _save_index_file(self):
+        # Serialize a copy so that the in memory items keep their datetime
+        media_items = {}
         for k, v in self.metadata_context_by_id.items():
-            if isinstance(v['createTime'], datetime):
-                v['createTime'] = v['createTime'].isoformat()
-            else:
-                print(f"Invalid date format type (String) for {k}, converting to ISO string format...")
-                try:
-                    # Use datetime.fromisoformat() since your string already matches the standard ISO format perfectly
-                    dt_obj = datetime.fromisoformat(v['createTime'])
-                    v['createTime'] = dt_obj.isoformat()
-                except ValueError:
-                    # Fallback if it's a completely different or broken string format
-                    print(f"Could not parse string format for {k}: {v['createTime']}")
+            create_time = v['createTime']
+            media_items[k] = {**v, 'createTime': create_time.isoformat() if isinstance(create_time, datetime) else create_time}
 
         with open(os.path.join(self.GOOGLE_PHOTOS_PATH, "index.json"), "w") as f:
             json.dump({
                 "sessions": self.session_ids,
-                "mediaItems": self.metadata_context_by_id
+                "mediaItems": media_items
             }, f)
 
     async def fetch_dates(self,
@@ -280,25 +315,12 @@ class GooglePhotosProvider(MemoryProvider):
         if search_regex:
             return results
 
-        current_date = start_date
-        while current_date <= end_date:
-            item_ids = self.metadata_context_by_dates.get(current_date, set())
-            for item_id in item_ids:
-                item = self.metadata_context_by_id.get(item_id)
-                if not item:
-                    continue
-                _date = item.get('createTime')
-                results[current_date].append(Message(_datetime=_date.astimezone(timezone.utc).replace(tzinfo=None),
-                                                     media_type=MediaType.NON_TEXT,
-                                                     provider=self.NAME,
-                                                     context={
-                                                         "asset_name": item.get('file_name'),
-                                                         "asset_id": item_id,
-                                                         "mime_type": item.get('mime_type'),
-                                                         "new_tab_url": f'/asset/{GooglePhotosProvider.NAME}/{item_id}'
-                                                     })
-                                             )
-            current_date += timedelta(days=1)
+        self._load_index()
+        # O(log n) to find the range and O(k) to collect the items in it
+        low = bisect_left(self._sorted_create_times, datetime.combine(start_date, time.min))
+        high = bisect_left(self._sorted_create_times, datetime.combine(end_date + timedelta(days=1), time.min))
+        for index in range(low, high):
+            results[self._sorted_create_times[index].date()].append(self._get_message(self._sorted_ids[index]))
 
         print("Done fetching from Google Photos")
         return results
@@ -321,16 +343,16 @@ class GooglePhotosProvider(MemoryProvider):
         return date_assets.get(on_date, []) if date_assets else []
 
     @staticmethod
-    async def fetch_asset(token: str,
-                          url: str,
-                          file_name: str,
-                          _type,
-                          compressions: List[Compressions] = None) -> bool:
+    def get_download_job(token: str,
+                         url: str,
+                         file_name: str,
+                         _type,
+                         compressions: List[Compressions] = None) -> Optional[DownloadJob]:
         # Base URLs remain active for 60 minutes: https://developers.google.com/photos/library/guides/access-media-items#base-urls
 
         if compressions and Compressions.NO_VIDEO.value in compressions and _type == 'VIDEO':
             # TODO: Instead download the thumbnail of the video
-            return False
+            return None
 
         headers = {
             'Authorization': f'Bearer {token}',
@@ -341,37 +363,26 @@ class GooglePhotosProvider(MemoryProvider):
         elif _type == 'VIDEO':
             url += '=dv'
 
-        if os.path.exists(file_name):
-            # The file is already downloaded
-            return False
-
-        print(f"Downloading {url} to {file_name}")
-        async with httpx.AsyncClient(timeout=30) as client:
-            response = await client.get(url, headers=headers)
+        return DownloadJob(url, file_name, headers=headers)
 
-            # Handle redirect manually
-            if response.status_code in (301, 302, 303, 307, 308):
-                redirect_url = response.headers.get("Location")
-                if not redirect_url:
-                    raise Exception("Redirect response but no Location header")
-                # Follow the redirect explicitly
-                response = await client.get(redirect_url, headers=headers)
+    def get_source_paths(self) -> List[str]:
+        return [os.path.join(self.GOOGLE_PHOTOS_PATH, "index.json")] if self.WORKING else []
 
-        if response.status_code != 200:
-            raise Exception(response.status_code, response.text)
-
-        with open(file_name, "wb") as f:
-            f.write(response.content)
-            return True
-
-    async def get_start_end_date(self):
-        all_available_dates = list(self.metadata_context_by_dates.keys())
-        return min(all_available_dates), max(all_available_dates)
+    async def _compute_metadata(self) -> dict:
+        self._load_index()
+        if not self._sorted_create_times:
+            return {"start_date": None, "end_date": None, "message_count": 0}
+        return {
+            "start_date": self._sorted_create_times[0].date(),
+            "end_date": self._sorted_create_times[-1].date(),
+            "message_count": len(self._sorted_create_times),
+        }
 
     async def get_asset(self, asset_id: str) -> List[str] or None:
         if not self.WORKING:
             return None, None
 
+        self._load_index()
         if asset_id not in self.metadata_context_by_id:
             print(f"No metadata found for asset {asset_id}")
             return None, None
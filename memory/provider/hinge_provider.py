@@ -1,19 +1,62 @@
 import json
 import re
 import statistics
-from datetime import date, timezone
-from typing import List, Optional
+from bisect import bisect_left
+from datetime import date, datetime, time, timedelta, timezone
+from typing import List, Optional, Tuple
 
 import aiofiles
-from dateutil import parser
 
 import configs
+import metrics
 from profile import get_all_hinge_match_times
-from provider.base_provider import MemoryProvider, Message, MediaType, MessageType
+from provider.base_provider import MemoryProvider, Message, MediaType, MessageType, FetchGranularity
+from utils import file_fingerprint
+
+
+class HingeMatch:
+    """
+    A match (or an unmatched like) from matches.json with the timestamps parsed and the events sorted by time.
+    """
+
+    def __init__(self, data: dict, like_number: int, match_number: int):
+        # (timestamp, comments) for every like sent
+        self.likes: List[Tuple[datetime, List[str]]] = [
+            (HingeProvider.parse_timestamp(like_data.get('timestamp')),
+             [like.get('comment', '') for like in like_data.get('like', [])])
+            for like_data in data.get('like', [])
+        ]
+        # Raw timestamps are kept as the chats are named by them in profile.json
+        self.match_timestamps: List[str] = [match_data.get('timestamp') for match_data in data.get('match', [])]
+        self.match_datetimes: List[datetime] = [HingeProvider.parse_timestamp(timestamp)
+                                                for timestamp in self.match_timestamps]
+        self.match_data_length = sum(len(match_data) for match_data in data.get('match', []))
+        self.chats: List[Tuple[datetime, str]] = [(HingeProvider.parse_timestamp(chat_data.get('timestamp')),
+                                                   chat_data.get('body'))
+                                                  for chat_data in data.get('chats', [])]
+
+        # Running count of likes and matches, used to name the chats
+        self.like_number = like_number
+        self.match_number = match_number
+
+        events = [(_dt, (comments[0] if comments else None) or 'Liked') for _dt, comments in self.likes]
+        events.extend((_dt, 'Matched') for _dt in self.match_datetimes)
+        events.extend(self.chats)
+        events.sort(key=lambda event: event[0].replace(tzinfo=None))
+        self.events: List[Tuple[datetime, str]] = events
+
+    @property
+    def liked(self) -> bool:
+        return len(self.likes) > 0
+
+    @property
+    def matched(self) -> bool:
+        return len(self.match_timestamps) > 0
 
 
 class HingeProvider(MemoryProvider):
     NAME = "Hinge"
+    FETCH_GRANULARITY = FetchGranularity.RANGE
 
     HINGE_PATH = 'data/hinge'
     WORKING = True
@@ -22,17 +65,39 @@ class HingeProvider(MemoryProvider):
         if not self.WORKING:
             return
 
+        # Parsed matches.json along with the fingerprint of the file it was read from
+        self._matches: Optional[Tuple[List[int], List[HingeMatch]]] = None
+        self._stats: Optional[Tuple[List[int], dict]] = None
+
     def is_working(self):
         return self.WORKING
 
     def get_allowed_exposed_functions(self) -> List[str]:
         return ['get_stats']
 
+    def get_source_paths(self) -> List[str]:
+        return [f'{HingeProvider.HINGE_PATH}/matches.json']
+
+    async def on_sources_changed(self, changed: List[str], removed: List[str]):
+        await self._get_matches()
+        await super().on_sources_changed(changed, removed)
+
     def supports_home(self) -> bool:
         return self.is_working()
 
+    @staticmethod
+    def parse_timestamp(timestamp: str) -> datetime:
+        try:
+            # Hinge timestamps are ISO 8601
+            return datetime.fromisoformat(timestamp)
+        except ValueError:
+            from dateutil import parser
+            return parser.parse(timestamp)
+
     async def get_stats(self, **kwargs) -> dict:
-        all_data = await HingeProvider._read_matches_file()
+        fingerprint, matches = await self._get_matches()
+        if self._stats and self._stats[0] == fingerprint:
+            return self._stats[1]
 
         match_count = 0
         likes_with_message_sent_count = 0
@@ -45,55 +110,43 @@ class HingeProvider(MemoryProvider):
         highest_conversation_length = 0
         likes_by_weekday_hour = [[0 for _ in range(24)] for _ in range(7)]
 
-        for data in all_data:
-            like_dts = []
-            for like_data in data.get('like', []):
-                _dt = parser.parse(like_data.get('timestamp'))
-                if _dt:
-                    like_dts.append(_dt)
-                    _dt_local = _dt.replace(tzinfo=timezone.utc).astimezone()
-                    weekday = _dt_local.weekday()  # Monday = 0
-                    hour = _dt_local.hour  # 0-23
-                    likes_by_weekday_hour[weekday][hour] += 1
-
-                likes = like_data.get('like', [])
-                for like in likes:
-                    if like.get('comment', ''):
+        for match in matches:
+            for _dt, comments in match.likes:
+                _dt_local = _dt.replace(tzinfo=timezone.utc).astimezone()
+                weekday = _dt_local.weekday()  # Monday = 0
+                hour = _dt_local.hour  # 0-23
+                likes_by_weekday_hour[weekday][hour] += 1
+
+                for comment in comments:
+                    if comment:
                         likes_with_message_sent_count += 1
                     else:
                         likes_without_message_sent_count += 1
 
-            match_dt = None
-            for match_data in data.get('match', []):
-                match_time = match_data.get('timestamp')
-                match_dt = parser.parse(match_time) if match_dt is None else match_dt
-                match_count += len(match_data)
+            match_count += match.match_data_length
+            match_dt = match.match_datetimes[0] if match.match_datetimes else None
 
-            if match_dt and like_dts:
+            if match_dt and match.likes:
                 # Calculate all positive differences in seconds
-                pos_diffs = [(match_dt - l_dt).total_seconds() for l_dt in like_dts if match_dt > l_dt]
+                pos_diffs = [(match_dt - l_dt).total_seconds() for l_dt, _ in match.likes if match_dt > l_dt]
 
                 if pos_diffs:
                     match_times.append(min(pos_diffs))
-                first_comment = next(
-                    (like.get('comment') for ld in data.get('like', []) for like in ld.get('like', []) if
-                     like.get('comment')), None)
+                first_comment = next((comment for _, comments in match.likes for comment in comments if comment), None)
                 if first_comment:
                     match_messages.append(first_comment)  # Get the first comment if exists
 
-            if data.get('match', []):
-                if len(data.get('like', [])) > 0:
+            if match.matched:
+                if match.liked:
                     likes_that_matched += 1
                 else:
                     match_without_like_count += 1
 
-            for chat_data in data.get('chats', []):
-                _dt = parser.parse(chat_data.get('timestamp'))
-            total_chats += len(data.get('chats', []))
-            highest_conversation_length = max(highest_conversation_length, len(data.get('chats', [])))
+            total_chats += len(match.chats)
+            highest_conversation_length = max(highest_conversation_length, len(match.chats))
 
         # print(sorted(match_times))
-        return {
+        stats = {
             "total_likes_sent": likes_with_message_sent_count + likes_without_message_sent_count,
             "likes_with_message_sent": likes_with_message_sent_count,
             "likes_that_matched": likes_that_matched,
@@ -106,6 +159,8 @@ class HingeProvider(MemoryProvider):
             "highest_conversation_length": highest_conversation_length,
             "likes_by_weekday_hour": likes_by_weekday_hour
         }
+        self._stats = (fingerprint, stats)
+        return stats
 
 
     async def fetch(self, on_date: Optional[date] = None,
@@ -125,59 +180,31 @@ class HingeProvider(MemoryProvider):
 
         pattern = re.compile(search_regex) if search_regex else None
 
-        matches_data = await HingeProvider._read_matches_file()
+        _, matches = await self._get_matches()
 
         chat_name_match_time = await get_all_hinge_match_times()
         match_time_chat_name = {v: k for k, v in chat_name_match_time.items()}
-        match_count = 0
-        like_count = 0
 
-        for match in matches_data:
-            match_messages = []
-            chat_name = None
-            liked = False
-            matched = False
-
-            for like_data in match.get('like', []):
-                _dt = parser.parse(like_data.get('timestamp'))
-                likes = like_data.get('like', [])
-                message = None
-                if likes:
-                    message = likes[0].get('comment') if len(likes) >= 1 else None
-                message = message if message else 'Liked'
-                match_messages.append((_dt, message))
-                liked = True
-
-            if liked:
-                like_count += 1
-
-            for match_data in match.get('match', []):
-                match_time = match_data.get('timestamp')
-                if match_time in match_time_chat_name:
-                    chat_name = match_time_chat_name[match_time]
-                _dt = parser.parse(match_time)
-                match_messages.append((_dt, 'Matched'))
-                matched = True
+        if on_date:
+            start_date = end_date = on_date
+        low_dt = datetime.combine(start_date, time.min) if start_date else None
+        high_dt = datetime.combine(end_date + timedelta(days=1), time.min) if end_date else None
 
-            if matched:
-                match_count += 1
+        for match in matches:
+            events = match.events
+            if not events:
+                continue
 
-            for chat_data in match.get('chats', []):
-                _dt = parser.parse(chat_data.get('timestamp'))
-                match_messages.append((_dt, chat_data.get('body')))
+            # Events are sorted, so the range can be bisected. Compare naively as the dates were compared before
+            low = bisect_left(events, low_dt, key=lambda event: event[0].replace(tzinfo=None)) if low_dt else 0
+            high = bisect_left(events, high_dt, key=lambda event: event[0].replace(tzinfo=None)) if high_dt else len(events)
+            if low >= high:
+                continue
 
-            for row in match_messages:
-                _dt, text = row
-
-                if on_date and _dt.date() != on_date:
-                    continue
-
-                # Messages are sorted by time descending in Instagram export
-                if start_date and _dt.date() < start_date:
-                    continue
-                elif end_date and _dt.date() > end_date:
-                    continue
+            chat_name = next((match_time_chat_name[match_time] for match_time in match.match_timestamps
+                              if match_time in match_time_chat_name), None)
 
+            for _dt, text in events[low:high]:
                 if not text:
                     continue
 
@@ -192,7 +219,7 @@ class HingeProvider(MemoryProvider):
                         text,
                         sender=configs.USER,
                         provider=HingeProvider.NAME,
-                        chat_name=chat_name or f'Match #{match_count}' if matched else f'Like #{like_count}',
+                        chat_name=chat_name or f'Match #{match.match_number}' if match.matched else f'Like #{match.like_number}',
                         media_type=MediaType.TEXT,
                         context={},
                         is_group=False  # TODO: Fix
@@ -203,6 +230,33 @@ class HingeProvider(MemoryProvider):
         print("Done fetching from Hinge")
         return messages
 
+    async def _get_matches(self) -> Tuple[List[int], List[HingeMatch]]:
+        """
+        Get the parsed matches.json. It is read again only when the file changes.
+        :return: Fingerprint of the file and the matches
+        """
+        matches_path = f'{HingeProvider.HINGE_PATH}/matches.json'
+        fingerprint = file_fingerprint(matches_path)
+        if self._matches and self._matches[0] == fingerprint:
+            metrics.cache_lookup(self.NAME, 'matches', True)
+            return self._matches
+        metrics.cache_lookup(self.NAME, 'matches', False)
+        if fingerprint:
+            metrics.add_bytes_read(self.NAME, fingerprint[1])
+
+        matches = []
+        like_count = 0
+        match_count = 0
+        for data in await HingeProvider._read_matches_file():
+            if data.get('like', []):
+                like_count += 1
+            if data.get('match', []):
+                match_count += 1
+            matches.append(HingeMatch(data, like_number=like_count, match_number=match_count))
+
+        self._matches = (fingerprint, matches)
+        return self._matches
+
     @staticmethod
     async def _read_matches_file() -> List[dict]:
         try:
@@ -1,23 +1,54 @@
+import asyncio
+import hashlib
 import json
 import mimetypes
 import os
 import re
 import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, date
-from typing import List, Tuple, Optional
+from threading import Lock
+from typing import List, Tuple, Optional, Dict, Iterable
 
 import aiofiles
 
 from configs import USER
 from profile import get_all_imessage_chat_ids_from_senders
-from provider.base_provider import MemoryProvider, Message, MediaType, MessageType
+from provider.base_provider import MemoryProvider, Message, MediaType, MessageType, FetchGranularity
+from utils import file_fingerprint
+
+# Database path to its connection and the fingerprint of the file it was opened on. The connections are kept open so
+# that sqlite keeps the prepared statements of the queries, and backup databases are reopened when they are copied over
+_connections: Dict[str, Tuple[Optional[List[int]], sqlite3.Connection]] = {}
+# The filter_values temp table of a connection is filled and read by one query at a time
+_connections_lock = Lock()
+# Store path to the fingerprint of the sms.db it was last synced with
+_store_synced: Dict[str, List[int]] = {}
+# One sync at a time. It writes on its own connection, so the queries keep reading the store meanwhile
+_store_sync_lock = Lock()
+
+# Folder of the iPhone backup (with Manifest.db and the 2 character folders) to extract the attachments from, e.g.
+# ~/Library/Application Support/MobileSync/Backup/00008140-000C482014D1801C
+IMESSAGE_BACKUP_PATH = os.getenv('IMESSAGE_BACKUP_PATH')
+# Attachments copied at once from the backup
+ATTACHMENT_COPY_WORKERS = int(os.getenv('ATTACHMENT_COPY_WORKERS', 8))
+# Seconds between two progress lines of the extraction
+ATTACHMENT_PROGRESS_INTERVAL = 5
+ATTACHMENT_COPY_CHUNK_SIZE = 1024 * 1024
 
 
 class IMessageProvider(MemoryProvider):
     NAME = "iMessage"
+    FETCH_GRANULARITY = FetchGranularity.RANGE
     USER = 'Ritik'
 
     IMESSAGE_PATH = 'data/imessage'
+    # Messages of every sms.db snapshot imported so far, queried instead of the latest sms.db
+    STORE_DB_NAME = 'store.db'
+    # Messages can be edited or unsent up to 15 minutes after they were sent, so the messages of the last 15 minutes of
+    # a chat are read again from the next snapshot
+    EDIT_WINDOW_NS = 15 * 60 * 1_000_000_000
     APPLE_EPOCH = datetime(2001, 1, 1)
     WORKING = True
 
@@ -90,27 +121,287 @@ class IMessageProvider(MemoryProvider):
             raise e
 
     @staticmethod
-    def _list_to_query_string(lst):
-        return f"('{"','".join(lst)}')"
+    def _open_connection(path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("CREATE TEMP TABLE filter_values (value TEXT PRIMARY KEY) WITHOUT ROWID")
+        return conn
 
     @staticmethod
-    def query_db_db(query, params, db_name='sms.db'):
-        conn = sqlite3.connect(f'{IMessageProvider.IMESSAGE_PATH}/{db_name}')
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
+    def _get_connection(db_name: str) -> sqlite3.Connection:
+        if db_name == IMessageProvider.STORE_DB_NAME:
+            return IMessageProvider._get_store_connection()
+        path = f'{IMessageProvider.IMESSAGE_PATH}/{db_name}'
+        fingerprint = file_fingerprint(path)
+        cached = _connections.get(path)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+        if cached:
+            cached[1].close()
+
+        conn = IMessageProvider._open_connection(path)
+        _connections[path] = (fingerprint, conn)
+        return conn
 
-        rows = cur.execute(query, params).fetchall()
-        conn.close()
+    @staticmethod
+    def _get_store_connection() -> sqlite3.Connection:
+        """
+        The store of the messages, see sync_store. Without sms.db, the messages imported from the earlier backups are
+        still served.
+        """
+        store_path = f'{IMessageProvider.IMESSAGE_PATH}/{IMessageProvider.STORE_DB_NAME}'
+        cached = _connections.get(store_path)
+        if cached:
+            return cached[1]
+        conn = IMessageProvider._open_store(store_path)
+        _connections[store_path] = (None, conn)
+        return conn
 
-        return rows
+    @staticmethod
+    def _store_is_synced() -> bool:
+        store_path = f'{IMessageProvider.IMESSAGE_PATH}/{IMessageProvider.STORE_DB_NAME}'
+        snapshot_fingerprint = file_fingerprint(f'{IMessageProvider.IMESSAGE_PATH}/sms.db')
+        return snapshot_fingerprint is None or _store_synced.get(store_path) == snapshot_fingerprint
 
     @staticmethod
-    def query_sms_db(query, params):
-        return IMessageProvider.query_db_db(query, params, 'sms.db')
+    def sync_store():
+        """
+        Import the new and edited messages of sms.db in the store, if a new backup was copied over it since the last
+        sync. This blocks till the import is done, async code awaits _sync_store_in_thread instead.
+        """
+        if IMessageProvider._store_is_synced():
+            return
+        with _store_sync_lock:
+            store_path = f'{IMessageProvider.IMESSAGE_PATH}/{IMessageProvider.STORE_DB_NAME}'
+            snapshot_path = f'{IMessageProvider.IMESSAGE_PATH}/sms.db'
+            snapshot_fingerprint = file_fingerprint(snapshot_path)
+            if snapshot_fingerprint is None or _store_synced.get(store_path) == snapshot_fingerprint:
+                # Synced while waiting for the lock
+                return
+            conn = IMessageProvider._open_store(store_path)
+            try:
+                IMessageProvider._sync_store(conn, snapshot_path, snapshot_fingerprint)
+            finally:
+                conn.close()
+            _store_synced[store_path] = snapshot_fingerprint
 
     @staticmethod
-    def query_manifest_db(query, params):
-        return IMessageProvider.query_db_db(query, params, 'Manifest.db')
+    async def _sync_store_in_thread():
+        """
+        sync_store in a thread, so that the event loop keeps serving other requests during an import.
+        """
+        if not IMessageProvider._store_is_synced():
+            await asyncio.to_thread(IMessageProvider.sync_store)
+
+    @staticmethod
+    def _open_store(path: str) -> sqlite3.Connection:
+        """
+        Open the store, creating its tables. They are the sms.db tables the queries read, with the columns they use, so
+        the queries run the same on the store. Rows are keyed by their guid since ROWIDs aren't kept across backups.
+        """
+        conn = IMessageProvider._open_connection(path)
+        try:
+            IMessageProvider._create_store_tables(conn)
+        except sqlite3.Error:
+            conn.close()
+            raise
+        return conn
+
+    @staticmethod
+    def _create_store_tables(conn: sqlite3.Connection):
+        # WAL lets the queries read the store while a sync writes it
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS chat (ROWID INTEGER PRIMARY KEY, guid TEXT UNIQUE, style INTEGER,
+                                             chat_identifier TEXT, service_name TEXT, display_name TEXT);
+            CREATE TABLE IF NOT EXISTS handle (ROWID INTEGER PRIMARY KEY, id TEXT, service TEXT, UNIQUE (id, service));
+            CREATE TABLE IF NOT EXISTS message (ROWID INTEGER PRIMARY KEY, guid TEXT UNIQUE, text TEXT,
+                                                attributedBody BLOB, handle_id INTEGER, date INTEGER, account TEXT,
+                                                is_from_me INTEGER, service TEXT, cache_has_attachments INTEGER);
+            CREATE TABLE IF NOT EXISTS attachment (ROWID INTEGER PRIMARY KEY, guid TEXT UNIQUE, filename TEXT,
+                                                   mime_type TEXT, transfer_name TEXT);
+            CREATE TABLE IF NOT EXISTS chat_message_join (chat_id INTEGER, message_id INTEGER,
+                                                          PRIMARY KEY (chat_id, message_id)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS chat_handle_join (chat_id INTEGER, handle_id INTEGER,
+                                                         PRIMARY KEY (chat_id, handle_id)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS message_attachment_join (message_id INTEGER, attachment_id INTEGER,
+                                                                PRIMARY KEY (message_id, attachment_id)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS message_date_idx ON message (date);
+            -- High-water mark of every chat in the last snapshot: its last message (ROWID, guid and date) and the
+            -- ROWID after which the next snapshot is read, which is before the messages that could still be edited
+            CREATE TABLE IF NOT EXISTS sync_state (chat_guid TEXT PRIMARY KEY, last_rowid INTEGER, last_guid TEXT,
+                                                   last_date INTEGER, rewind_rowid INTEGER);
+            CREATE TABLE IF NOT EXISTS snapshots (fingerprint TEXT, synced_at TEXT, messages INTEGER);
+        """)
+        conn.executescript("""
+            CREATE TEMP TABLE sync_chats (chat_id INTEGER PRIMARY KEY, store_chat_id INTEGER, from_rowid INTEGER);
+            CREATE TEMP TABLE pulled (chat_id INTEGER, message_id INTEGER, PRIMARY KEY (chat_id, message_id))
+                WITHOUT ROWID;
+        """)
+
+    @staticmethod
+    def _sync_store(conn: sqlite3.Connection, snapshot_path: str, snapshot_fingerprint: List[int]):
+        """
+        Import the new and edited messages of an sms.db snapshot in the store.
+        Per chat, only the messages after the high-water ROWID are read, through the (chat_id, message_id) index of
+        chat_message_join, so a sync takes time in the number of new messages and not in the size of the database.
+        A chat whose last message isn't at the same ROWID anymore (e.g. a phone restored from another backup) is read
+        in full, its messages already in the store are matched by guid.
+        """
+        fingerprint = json.dumps(snapshot_fingerprint)
+        last = conn.execute("SELECT fingerprint FROM snapshots ORDER BY ROWID DESC LIMIT 1").fetchone()
+        if last and last['fingerprint'] == fingerprint:
+            return
+
+        start = time.perf_counter()
+        conn.execute("ATTACH DATABASE ? AS snapshot", (snapshot_path,))
+        try:
+            with conn:
+                conn.execute("DELETE FROM temp.sync_chats")
+                conn.execute("DELETE FROM temp.pulled")
+                conn.execute("""
+                    INSERT INTO chat (guid, style, chat_identifier, service_name, display_name)
+                    SELECT guid, style, chat_identifier, service_name, display_name
+                    FROM snapshot.chat WHERE guid IS NOT NULL
+                    ON CONFLICT (guid) DO UPDATE SET style = excluded.style,
+                                                     chat_identifier = excluded.chat_identifier,
+                                                     service_name = excluded.service_name,
+                                                     display_name = excluded.display_name
+                """)
+                conn.execute("""
+                    INSERT OR IGNORE INTO handle (id, service)
+                    SELECT id, COALESCE(service, '') FROM snapshot.handle
+                """)
+                conn.execute("""
+                    INSERT OR IGNORE INTO chat_handle_join (chat_id, handle_id)
+                    SELECT c.ROWID, h.ROWID
+                    FROM snapshot.chat_handle_join chj
+                    JOIN snapshot.chat sc ON sc.ROWID = chj.chat_id
+                    JOIN chat c ON c.guid = sc.guid
+                    JOIN snapshot.handle sh ON sh.ROWID = chj.handle_id
+                    JOIN handle h ON h.id = sh.id AND h.service = COALESCE(sh.service, '')
+                """)
+                conn.execute("""
+                    INSERT INTO temp.sync_chats (chat_id, store_chat_id, from_rowid)
+                    SELECT sc.ROWID, c.ROWID,
+                           CASE WHEN (SELECT m.guid FROM snapshot.message m WHERE m.ROWID = s.last_rowid) = s.last_guid
+                                THEN s.rewind_rowid ELSE 0 END
+                    FROM snapshot.chat sc
+                    JOIN chat c ON c.guid = sc.guid
+                    LEFT JOIN sync_state s ON s.chat_guid = sc.guid
+                """)
+                conn.execute("""
+                    INSERT OR IGNORE INTO temp.pulled (chat_id, message_id)
+                    SELECT cmj.chat_id, cmj.message_id
+                    FROM temp.sync_chats s
+                    JOIN snapshot.chat_message_join cmj ON cmj.chat_id = s.chat_id AND cmj.message_id > s.from_rowid
+                """)
+                conn.execute("""
+                    INSERT INTO message (guid, text, attributedBody, handle_id, date, account, is_from_me, service,
+                                         cache_has_attachments)
+                    SELECT m.guid, m.text, m.attributedBody, COALESCE(h.ROWID, 0), m.date, m.account, m.is_from_me,
+                           m.service, m.cache_has_attachments
+                    FROM (SELECT DISTINCT message_id FROM temp.pulled) p
+                    JOIN snapshot.message m ON m.ROWID = p.message_id
+                    LEFT JOIN snapshot.handle sh ON sh.ROWID = m.handle_id
+                    LEFT JOIN handle h ON h.id = sh.id AND h.service = COALESCE(sh.service, '')
+                    WHERE m.guid IS NOT NULL
+                    ORDER BY m.ROWID
+                    ON CONFLICT (guid) DO UPDATE SET text = excluded.text, attributedBody = excluded.attributedBody,
+                                                     handle_id = excluded.handle_id, date = excluded.date,
+                                                     account = excluded.account, is_from_me = excluded.is_from_me,
+                                                     service = excluded.service,
+                                                     cache_has_attachments = excluded.cache_has_attachments
+                """)
+                conn.execute("""
+                    INSERT OR IGNORE INTO chat_message_join (chat_id, message_id)
+                    SELECT s.store_chat_id, msg.ROWID
+                    FROM temp.pulled p
+                    JOIN temp.sync_chats s ON s.chat_id = p.chat_id
+                    JOIN snapshot.message m ON m.ROWID = p.message_id
+                    JOIN message msg ON msg.guid = m.guid
+                """)
+                conn.execute("""
+                    INSERT INTO attachment (guid, filename, mime_type, transfer_name)
+                    SELECT a.guid, a.filename, a.mime_type, a.transfer_name
+                    FROM (SELECT DISTINCT message_id FROM temp.pulled) p
+                    JOIN snapshot.message_attachment_join maj ON maj.message_id = p.message_id
+                    JOIN snapshot.attachment a ON a.ROWID = maj.attachment_id
+                    WHERE a.guid IS NOT NULL
+                    ON CONFLICT (guid) DO UPDATE SET filename = excluded.filename, mime_type = excluded.mime_type,
+                                                     transfer_name = excluded.transfer_name
+                """)
+                conn.execute("""
+                    INSERT OR IGNORE INTO message_attachment_join (message_id, attachment_id)
+                    SELECT msg.ROWID, att.ROWID
+                    FROM (SELECT DISTINCT message_id FROM temp.pulled) p
+                    JOIN snapshot.message m ON m.ROWID = p.message_id
+                    JOIN message msg ON msg.guid = m.guid
+                    JOIN snapshot.message_attachment_join maj ON maj.message_id = p.message_id
+                    JOIN snapshot.attachment a ON a.ROWID = maj.attachment_id
+                    JOIN attachment att ON att.guid = a.guid
+                """)
+                conn.execute("""
+                    WITH last AS (
+                        SELECT p.chat_id, MAX(p.message_id) AS last_rowid, MAX(m.date) AS last_date
+                        FROM temp.pulled p
+                        JOIN snapshot.message m ON m.ROWID = p.message_id
+                        GROUP BY p.chat_id
+                    )
+                    INSERT INTO sync_state (chat_guid, last_rowid, last_guid, last_date, rewind_rowid)
+                    SELECT sc.guid, l.last_rowid,
+                           (SELECT m.guid FROM snapshot.message m WHERE m.ROWID = l.last_rowid),
+                           l.last_date,
+                           (SELECT MIN(p.message_id) - 1
+                            FROM temp.pulled p
+                            JOIN snapshot.message m ON m.ROWID = p.message_id
+                            WHERE p.chat_id = l.chat_id AND m.date >= l.last_date - ?)
+                    FROM last l
+                    JOIN snapshot.chat sc ON sc.ROWID = l.chat_id
+                    WHERE true
+                    ON CONFLICT (chat_guid) DO UPDATE SET last_rowid = excluded.last_rowid,
+                                                          last_guid = excluded.last_guid,
+                                                          last_date = excluded.last_date,
+                                                          rewind_rowid = excluded.rewind_rowid
+                """, (IMessageProvider.EDIT_WINDOW_NS,))
+                pulled = conn.execute("SELECT COUNT(DISTINCT message_id) FROM temp.pulled").fetchone()[0]
+                conn.execute("INSERT INTO snapshots (fingerprint, synced_at, messages) VALUES (?, ?, ?)",
+                             (fingerprint, datetime.now().isoformat(), pulled))
+        finally:
+            conn.execute("DETACH DATABASE snapshot")
+        print(f"Synced {pulled} new or edited iMessage messages from {snapshot_path} in "
+              f"{time.perf_counter() - start:.2f}s")
+
+    @staticmethod
+    def query_db_db(query, params, db_name='sms.db', filter_values: Iterable[str] = None):
+        """
+        Run a query on a database of the backup.
+        :param filter_values: Values loaded in the indexed temp table `filter_values` (column `value`) for the query to
+        join, instead of an IN list
+        """
+        with _connections_lock:
+            conn = IMessageProvider._get_connection(db_name)
+            if filter_values is not None:
+                conn.execute("DELETE FROM temp.filter_values")
+                conn.executemany("INSERT OR IGNORE INTO temp.filter_values (value) VALUES (?)",
+                                 ((value,) for value in filter_values))
+            try:
+                return conn.execute(query, params).fetchall()
+            finally:
+                # Nothing is written to the backup, end the implicit transaction of the inserts
+                conn.rollback()
+
+    @staticmethod
+    def query_sms_db(query, params, filter_values: Iterable[str] = None):
+        """
+        Run a query on the messages of all the sms.db snapshots imported so far. Call sync_store first to import the
+        latest sms.db
+        """
+        return IMessageProvider.query_db_db(query, params, IMessageProvider.STORE_DB_NAME, filter_values)
+
+    @staticmethod
+    def query_manifest_db(query, params, filter_values: Iterable[str] = None):
+        return IMessageProvider.query_db_db(query, params, 'Manifest.db', filter_values)
 
     async def fetch(self, on_date: Optional[date] = None,
                     start_date: Optional[date] = None,
@@ -121,6 +412,10 @@ class IMessageProvider(MemoryProvider):
                     search_regex: str = None) -> List[Message]:
         print("Starting to fetch from iMessage")
         messages = []
+        if on_date:
+            start_date = end_date = on_date
+        start_date = start_date or MemoryProvider.MINIMUM_DATE.date()
+        end_date = end_date or MemoryProvider.MAXIMUM_DATE.date()
         start_ns = self.to_apple_time(datetime.combine(start_date, datetime.min.time()))
         end_ns = self.to_apple_time(datetime.combine(end_date, datetime.max.time()))
 
@@ -149,9 +444,8 @@ class IMessageProvider(MemoryProvider):
 
         if len(chat_identifiers) == 0:
             return []
-        chat_identifiers = IMessageProvider._list_to_query_string(chat_identifiers)
 
-        query = f"""
+        query = """
 WITH attachments AS (
     SELECT
         maj.message_id,
@@ -216,6 +510,8 @@ JOIN chat_message_join cmj
     ON m.ROWID = cmj.message_id
 JOIN chat c
     ON cmj.chat_id = c.ROWID
+JOIN temp.filter_values f
+    ON f.value = c.chat_identifier
 
 LEFT JOIN handle h
     ON m.handle_id = h.ROWID
@@ -227,14 +523,14 @@ LEFT JOIN participants p
     ON c.ROWID = p.chat_id
 
 WHERE
-    c.chat_identifier IN {chat_identifiers}
-    AND m.date BETWEEN {start_ns} AND {end_ns}
+    m.date BETWEEN ? AND ?
 
 ORDER BY
     m.date ASC;
                 """
 
-        rows = IMessageProvider.query_sms_db(query, ())
+        await IMessageProvider._sync_store_in_thread()
+        rows = IMessageProvider.query_sms_db(query, (start_ns, end_ns), filter_values=chat_identifiers)
 
         pattern = re.compile(search_regex) if search_regex else None
 
@@ -323,6 +619,7 @@ ORDER BY
     def _get_all_chats(ignore_companies=True, imessage_only=False):
         imessage_where_clause = "WHERE service_name = 'iMessage'" if imessage_only else ''
         query = f"SELECT ROWID, chat_identifier from chat {imessage_where_clause}"
+        IMessageProvider.sync_store()
         rows = IMessageProvider.query_sms_db(query, ())
         chat_identifiers = []
         for row in rows:
@@ -336,22 +633,24 @@ ORDER BY
             print(row['ROWID'], row['chat_identifier'])
         return chat_identifiers
 
-    async def get_start_end_date(self) -> Tuple[date | None, date | None]:
+    def get_source_paths(self) -> List[str]:
+        # The chats to read are picked from profile.json
+        return [f'{self.IMESSAGE_PATH}/sms.db', 'data/profile.json']
+
+    async def _compute_metadata(self) -> dict:
         sender_chat_identifiers = await get_all_imessage_chat_ids_from_senders()
 
-        # Create a reverse mapping of chat_identifier to sender
         all_chat_identifiers = []
         for sender, chat_identifiers in sender_chat_identifiers.items():
             all_chat_identifiers.extend(chat_identifiers)
 
         if len(all_chat_identifiers) == 0:
-            return None, None
+            return {"start_date": None, "end_date": None, "message_count": 0}
 
-        chat_identifiers = IMessageProvider._list_to_query_string(all_chat_identifiers)
-
-        query = f"""
+        query = """
                 SELECT MIN(timestamp) AS min_timestamp,
-                       MAX(timestamp) AS max_timestamp
+                       MAX(timestamp) AS max_timestamp,
+                       COUNT(*) AS message_count
                 FROM (SELECT datetime(
                                      m.date / 1000000000 + strftime('%s', '2001-01-01'),
                                      'unixepoch'
@@ -360,20 +659,21 @@ ORDER BY
                           JOIN chat_message_join cmj
                       ON cmj.message_id = m.ROWID
                           JOIN chat c ON c.ROWID = cmj.chat_id
-                      WHERE c.chat_identifier IN {chat_identifiers});
+                          JOIN temp.filter_values f ON f.value = c.chat_identifier);
                 """
 
-        rows = IMessageProvider.query_sms_db(query, ())
+        await IMessageProvider._sync_store_in_thread()
+        rows = IMessageProvider.query_sms_db(query, (), filter_values=all_chat_identifiers)
         if not rows or not len(rows) == 1:
-            return None, None
+            return {"start_date": None, "end_date": None, "message_count": 0}
         row = rows[0]
         min_timestamp = row['min_timestamp']
         max_timestamp = row['max_timestamp']
         if min_timestamp and max_timestamp:
             min_date = datetime.strptime(min_timestamp, "%Y-%m-%d %H:%M:%S")
             max_date = datetime.strptime(max_timestamp, "%Y-%m-%d %H:%M:%S")
-            return min_date.date(), max_date.date()
-        return None, None
+            return {"start_date": min_date.date(), "end_date": max_date.date(), "message_count": row['message_count']}
+        return {"start_date": None, "end_date": None, "message_count": 0}
 
     @staticmethod
     def get_serialized_asset_path(asset_path) -> str:
@@ -384,54 +684,74 @@ ORDER BY
         return serialized_asset_path.strip().replace('___', '/').replace('---', ' ')
 
     @staticmethod
-    async def get_script_for_attachment():
+    async def _get_attachment_file_ids() -> Dict[str, str]:
         """
-        Given a list of chat_identifiers, extract attachment relative paths,
-        map them to fileIDs from the iPhone Manifest.db,
-        and generate a copy script to pull attachments into ./attachments/
-
-        Note: If cp fails with `Operation not permitted`, you may need to give full system access to the terminal
+        Map the attachments of the chats in profile.json to the files of the iPhone backup, from Manifest.db
+        :return: Relative path of every attachment (e.g. Library/SMS/Attachments/...) to its fileID in the backup
         """
-
         sender_chat_identifiers = await get_all_imessage_chat_ids_from_senders()
-        BACKUP_ROOT_FOLDER = "00008140-000C482014D1801C"  # Configure
 
-        # Create a reverse mapping of chat_identifier to sender
         all_chat_identifiers = []
         for sender, chat_identifiers in sender_chat_identifiers.items():
             all_chat_identifiers.extend(chat_identifiers)
 
         if len(all_chat_identifiers) == 0:
-            return
+            return {}
 
         # -----------------------------
         # 1. FETCH RELATIVE PATHS FROM sms.db
         # -----------------------------
-        query = f"""
+        query = """
             SELECT a.filename AS rel_path
             FROM message m
             JOIN chat_message_join cmj ON cmj.message_id = m.ROWID
             JOIN chat c2 ON cmj.chat_id = c2.ROWID
+            JOIN temp.filter_values f ON f.value = c2.chat_identifier
             JOIN message_attachment_join maj ON maj.message_id = m.ROWID
             JOIN attachment a ON a.ROWID = maj.attachment_id
-            WHERE c2.chat_identifier IN {IMessageProvider._list_to_query_string(all_chat_identifiers)}
             """
 
-        rel_paths = {row["rel_path"] for row in IMessageProvider.query_sms_db(query, ())}
-        rel_paths = {p[2:] if p.startswith("~/") else p for p in rel_paths}
+        await IMessageProvider._sync_store_in_thread()
+        rel_paths = {row["rel_path"] for row in IMessageProvider.query_sms_db(query, (),
+                                                                                filter_values=all_chat_identifiers)}
+        rel_paths = {p[2:] if p.startswith("~/") else p for p in rel_paths if p}
 
         # -----------------------------
         # 2. MAP RELATIVE PATH → fileID FROM Manifest.db
         # -----------------------------
-        query2 = f"""
-            SELECT fileID, relativePath
+        query2 = """
+            SELECT Files.fileID, Files.relativePath
             FROM Files
-            WHERE relativePath IN {IMessageProvider._list_to_query_string(rel_paths)}
+            JOIN temp.filter_values f ON f.value = Files.relativePath
             """
 
-        rows = IMessageProvider.query_manifest_db(query2, ())
+        rows = IMessageProvider.query_manifest_db(query2, (), filter_values=rel_paths)
+
+        return {row["relativePath"]: row["fileID"] for row in rows}
 
-        mapping = {row["relativePath"]: row["fileID"] for row in rows}
+    @staticmethod
+    def _get_attachment_asset_name(rel_path: str) -> str:
+        """
+        Name of an attachment in the attachments folder, which is its asset_id
+        """
+        dst_rel = rel_path.replace("Library/SMS/Attachments/", "").replace("Library/SMS/StickerCache/", "")
+        return IMessageProvider.get_serialized_asset_path(dst_rel)
+
+    @staticmethod
+    async def get_script_for_attachment():
+        """
+        Given a list of chat_identifiers, extract attachment relative paths,
+        map them to fileIDs from the iPhone Manifest.db,
+        and generate a copy script to pull attachments into ./attachments/
+        Use extract_attachments instead when the backup is on this machine.
+
+        Note: If cp fails with `Operation not permitted`, you may need to give full system access to the terminal
+        """
+        BACKUP_ROOT_FOLDER = "00008140-000C482014D1801C"  # Configure
+
+        mapping = await IMessageProvider._get_attachment_file_ids()
+        if not mapping:
+            return
 
         # -----------------------------
         # 3. WRITE SHELL SCRIPT
@@ -445,14 +765,124 @@ ORDER BY
                 subdir = fid[:2]
                 src = os.path.join(f"~/Library/Application\\ Support/MobileSync/Backup/{BACKUP_ROOT_FOLDER}", subdir,
                                    fid)
-                dst_rel = rel.replace("Library/SMS/Attachments/", "").replace("Library/SMS/StickerCache/", "")
-                dst_rel_serialized = IMessageProvider.get_serialized_asset_path(dst_rel)
-                dst = f"attachments/{dst_rel_serialized}"
+                dst = f"attachments/{IMessageProvider._get_attachment_asset_name(rel)}"
                 f.write(f'cp {src} "{dst}"\n\n')
 
         print(f"Generated {output_shell}")
         print(f"Found {len(mapping)} attachments")
 
+    @staticmethod
+    async def extract_attachments(backup_path: str = None, workers: int = None) -> Dict[str, int]:
+        """
+        Copy the attachments of the chats in profile.json from an iPhone backup into data/imessage/attachments, with a
+        pool of threads. Attachments already extracted with the same size and SHA-1 are skipped. The hashes are kept
+        in data/imessage/attachments.json along with the fingerprints of both files, so the next runs skip unchanged
+        attachments without reading them.
+        Manifest.db is read from data/imessage, like for get_script_for_attachment.
+
+        Note: If reading the backup fails with `Operation not permitted`, you may need to give full disk access to the
+        terminal
+        :param backup_path: Folder of the backup, IMESSAGE_BACKUP_PATH by default
+        :param workers: Attachments copied at once, ATTACHMENT_COPY_WORKERS by default
+        :return: Number of attachments copied, skipped, missing from the backup and failed
+        """
+        backup_path = os.path.expanduser(backup_path or IMESSAGE_BACKUP_PATH or '')
+        if not backup_path or not os.path.isdir(backup_path):
+            raise FileNotFoundError(f"Backup folder '{backup_path}' does not exist, set IMESSAGE_BACKUP_PATH")
+
+        mapping = await IMessageProvider._get_attachment_file_ids()
+        attachments_path = os.path.join(IMessageProvider.IMESSAGE_PATH, 'attachments')
+        jobs = [(os.path.join(backup_path, fid[:2], fid),
+                 os.path.join(attachments_path, IMessageProvider._get_attachment_asset_name(rel)))
+                for rel, fid in mapping.items()]
+        return await asyncio.to_thread(IMessageProvider._copy_attachments, jobs, workers or ATTACHMENT_COPY_WORKERS)
+
+    @staticmethod
+    def _copy_attachments(jobs: List[Tuple[str, str]], workers: int) -> Dict[str, int]:
+        """
+        :param jobs: Source and destination path of every attachment
+        """
+        if not jobs:
+            print("Found 0 attachments")
+            return {"copied": 0, "skipped": 0, "missing": 0, "failed": 0}
+        os.makedirs(os.path.dirname(jobs[0][1]), exist_ok=True)
+        hashes_path = os.path.join(IMessageProvider.IMESSAGE_PATH, 'attachments.json')
+        try:
+            with open(hashes_path, 'r') as f:
+                hashes = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            hashes = {}
+
+        counts = {"copied": 0, "skipped": 0, "missing": 0, "failed": 0}
+        copied_bytes = 0
+        start = last_progress = time.perf_counter()
+
+        def _print_progress():
+            elapsed = time.perf_counter() - start
+            done = sum(counts.values())
+            print(f"Extracted {done}/{len(jobs)} attachments ({counts['copied']} copied, {counts['skipped']} skipped, "
+                  f"{counts['missing']} missing, {counts['failed']} failed), {copied_bytes / (1024 * 1024):.1f}MB in "
+                  f"{elapsed:.1f}s ({done / elapsed if elapsed else 0:.0f} files/s, "
+                  f"{copied_bytes / (1024 * 1024) / elapsed if elapsed else 0:.1f}MB/s)")
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            futures = {executor.submit(IMessageProvider._copy_attachment, src, dst, hashes.get(os.path.basename(dst))):
+                           dst for src, dst in jobs}
+            for future in as_completed(futures):
+                dst = futures[future]
+                try:
+                    status, size, entry = future.result()
+                except OSError as e:
+                    print(f"Could not extract {dst}: {e}")
+                    status, size, entry = "failed", 0, None
+                counts[status] += 1
+                if status == "copied":
+                    copied_bytes += size
+                if entry is not None:
+                    hashes[os.path.basename(dst)] = entry
+                if time.perf_counter() - last_progress >= ATTACHMENT_PROGRESS_INTERVAL:
+                    last_progress = time.perf_counter()
+                    _print_progress()
+
+        with open(hashes_path, 'w') as f:
+            json.dump(hashes, f)
+        _print_progress()
+        return counts
+
+    @staticmethod
+    def _copy_attachment(src: str, dst: str, entry: Optional[dict]) -> Tuple[str, int, Optional[dict]]:
+        """
+        Copy one attachment, unless the destination already has the same size and SHA-1.
+        :param entry: Fingerprints of the source and destination and SHA-1 from the last extraction
+        :return: Status (copied, skipped or missing), bytes copied and the entry to keep
+        """
+        source_fingerprint = file_fingerprint(src)
+        if source_fingerprint is None:
+            return "missing", 0, entry
+        target_fingerprint = file_fingerprint(dst)
+        if entry and target_fingerprint and entry["source"] == source_fingerprint \
+                and entry["target"] == target_fingerprint:
+            return "skipped", 0, entry
+
+        if target_fingerprint and target_fingerprint[1] == source_fingerprint[1]:
+            with open(src, 'rb') as f:
+                source_hash = hashlib.file_digest(f, 'sha1').hexdigest()
+            with open(dst, 'rb') as f:
+                if hashlib.file_digest(f, 'sha1').hexdigest() == source_hash:
+                    return "skipped", 0, {"source": source_fingerprint, "target": target_fingerprint,
+                                          "sha1": source_hash}
+
+        # Copy to a temporary file so that an interrupted copy doesn't look extracted
+        sha1 = hashlib.sha1()
+        temp_path = f'{dst}.part'
+        with open(src, 'rb') as source, open(temp_path, 'wb') as target:
+            while chunk := source.read(ATTACHMENT_COPY_CHUNK_SIZE):
+                sha1.update(chunk)
+                target.write(chunk)
+        os.replace(temp_path, dst)
+        return "copied", source_fingerprint[1], {"source": source_fingerprint, "target": file_fingerprint(dst),
+                                                 "sha1": sha1.hexdigest()}
+
     async def get_asset(self, asset_id: str) -> List[str] or None:
         media_file_path = f'{self.IMESSAGE_PATH}/attachments/{asset_id}'
         if not os.path.exists(media_file_path):
@@ -1,12 +1,11 @@
 import os
 from collections import defaultdict
 from datetime import datetime, timedelta, date
-from typing import Dict, List, Tuple, Any
-
-import httpx
+from typing import Dict, List, Any
 
 from profile import get_immich_ids_from_senders
 from provider.base_provider import MemoryProvider, MediaType, Message
+from serving import http_client
 from utils import post_with_retries
 
 
@@ -79,7 +78,7 @@ class ImmichProvider(MemoryProvider):
         if not self.WORKING:
             return results
 
-        async with httpx.AsyncClient() as client:
+        async with http_client() as client:
             while True:
                 payload = {
                     "takenAfter": start_date.strftime("%Y-%m-%dT%H:%M:%SZ"),
@@ -146,7 +145,7 @@ class ImmichProvider(MemoryProvider):
         if not self.WORKING:
             return {}
 
-        async with httpx.AsyncClient() as client:
+        async with http_client() as client:
             response = await client.get(url, headers=headers)
 
         if response.status_code != 200:
@@ -154,14 +153,18 @@ class ImmichProvider(MemoryProvider):
 
         return response.json()
 
-    async def get_start_end_date(self) -> Tuple[date | None, date | None]:
+    async def get_metadata(self) -> dict:
+        # The data is remote. Immich buckets the timeline itself, which is cheap to ask for
         timeline_bucket = await self.get_timeline_bucket()
         if not timeline_bucket:
-            return None, None
+            return {"start_date": None, "end_date": None, "message_count": 0, "last_modified": None}
 
-        start_date = datetime.fromisoformat(timeline_bucket[-1]['timeBucket']).replace(tzinfo=None)
-        end_date = datetime.fromisoformat(timeline_bucket[0]['timeBucket']).replace(tzinfo=None)
-        return start_date.date(), end_date.date()
+        return {
+            "start_date": datetime.fromisoformat(timeline_bucket[-1]['timeBucket']).date(),
+            "end_date": datetime.fromisoformat(timeline_bucket[0]['timeBucket']).date(),
+            "message_count": sum(bucket.get('count', 0) for bucket in timeline_bucket),
+            "last_modified": None,
+        }
 
     async def get_asset(self, asset_id: str) -> List[str] or None:
         url = f"{self.IMMICH_BASE_URL}/api/assets/{asset_id}/thumbnail"
@@ -173,7 +176,7 @@ class ImmichProvider(MemoryProvider):
         if not self.WORKING:
             return None, None
 
-        async with httpx.AsyncClient() as client:
+        async with http_client() as client:
             response = await client.get(url, headers=headers)
 
         if response.status_code != 200:
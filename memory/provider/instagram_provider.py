@@ -3,24 +3,49 @@ import json
 import mimetypes
 import os
 import re
-from datetime import datetime, date, timezone
+import time as time_module
+from collections import OrderedDict
+from contextlib import aclosing
+from datetime import datetime, date, time, timezone
 from pathlib import Path
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Dict, Any
 
 import aiofiles
 
+import archives
+import metrics
+from parsing import run_parse_job
 from profile import get_regex_from_name
-from provider.base_provider import MemoryProvider, MessageType, MediaType, Message
+from provider.base_provider import MemoryProvider, MessageType, MediaType, Message, FetchGranularity
+from utils import file_fingerprint, stream_json_array, guess_mime_type
+
+# Parsed messages kept in memory across fetches, for the most recently read part files
+INSTAGRAM_CACHED_MESSAGES = int(os.getenv('INSTAGRAM_CACHED_MESSAGES', 100_000))
 
 
 class InstagramProvider(MemoryProvider):
     NAME = "Instagram"
+    FETCH_GRANULARITY = FetchGranularity.RANGE
+    # Each part file is read again only when it changes
+    PER_SOURCE_METADATA = True
 
     USER = 'Ritik Kumar'
     DELETED_USER = 'deleted_user'
     INSTAGRAM_PATH = 'data/instagram'
     INSTAGRAM_MESSAGE_PATH = 'data/instagram/messages'
+    # Folder of the conversations in the export zip files put in INSTAGRAM_PATH, by export version
+    ARCHIVE_INBOX_PATHS = ['your_instagram_activity/messages/inbox', 'messages/inbox']
     INSTAGRAM_FOLLOWER_FOLLOWING_PATH = 'data/instagram/followers_and_following'
+    INSTAGRAM_CACHE_PATH = 'data/instagram/cache'
+    MANIFEST_PATH = 'data/instagram/manifest.json'
+    SNAPSHOTS_PATH = 'data/instagram/snapshots'
+    SNAPSHOT_INDEX_PATH = 'data/instagram/snapshots/index.json'
+    FOLLOWERS = 'followers'
+    FOLLOWING = 'following'
+    FOLLOWERS_PART_RE = re.compile(r'^followers_(\d+)\.json$')
+    # Escaped backslashes or the \u0080-\u00ff escapes which Instagram uses for the individual bytes of UTF-8 text
+    MOJIBAKE_ESCAPE_RE = re.compile(rb'\\\\|\\u00([89a-fA-F][0-9a-fA-F])')
+    MESSAGE_PART_RE = re.compile(r'^message_(\d+)\.json$')
     _working = True
 
     # Instagram adds these in regional language sometimes
@@ -33,8 +58,22 @@ class InstagramProvider(MemoryProvider):
         if not self._working:
             return
 
+        # Decoded followers and following export files by path along with their fingerprint
+        self._export_files: Dict[str, Tuple[List[int], Any]] = {}
+        # Followers and following snapshots. Loaded lazily
+        self._snapshot_index: Optional[Dict[str, dict]] = None
+        self._snapshots: Dict[str, List[str]] = {}
+        # Per conversation participants, timestamp extents and part files. Loaded lazily
+        self._manifest: Optional[Dict[str, dict]] = None
+        # Monotonic time of the last refresh of the manifest
+        self._manifest_refreshed_at: Optional[float] = None
+        # Parsed messages of part files by path, least recently used first, see _get_parsed_part. At most
+        # INSTAGRAM_CACHED_MESSAGES messages are kept
+        self._parsed_parts: OrderedDict[str, dict] = OrderedDict()
+        self._parsed_messages = 0
+
         chat_path = Path(self.INSTAGRAM_MESSAGE_PATH)
-        if not chat_path.exists():
+        if not chat_path.exists() and not self._get_inbox_paths():
             print("Instagram data folder not found")
             self._working = False
             return
@@ -43,7 +82,8 @@ class InstagramProvider(MemoryProvider):
         return self._working
 
     def get_allowed_exposed_functions(self) -> List[str]:
-        return ['get_followers', 'get_following', 'get_close_friends']
+        return ['get_followers', 'get_following', 'get_close_friends', 'get_snapshots', 'get_new_followers',
+                'get_unfollowers', 'get_non_mutuals']
 
     def supports_home(self) -> bool:
         return self._working and self.supports_followers() and self.supports_following() and self.supports_close_friends()
@@ -65,39 +105,232 @@ class InstagramProvider(MemoryProvider):
             return False
         return Path(f'{self.INSTAGRAM_FOLLOWER_FOLLOWING_PATH}/close_friends.json').exists()
 
+    async def _read_export_json(self, path: str):
+        """
+        Read a JSON file of the followers and following export. The decoded data is cached till the file changes.
+        """
+        fingerprint = file_fingerprint(path)
+        cached = self._export_files.get(path)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+
+        async with aiofiles.open(path, 'rb') as f:
+            data = self.load_repaired_json(await f.read())
+        self._export_files[path] = (fingerprint, data)
+        return data
+
+    def _get_follower_paths(self) -> List[str]:
+        # Large accounts get followers_1.json, followers_2.json, ...
+        paths = [os.path.join(self.INSTAGRAM_FOLLOWER_FOLLOWING_PATH, entry)
+                 for entry in os.listdir(self.INSTAGRAM_FOLLOWER_FOLLOWING_PATH)
+                 if self.FOLLOWERS_PART_RE.match(entry)]
+        return sorted(paths, key=lambda path: int(self.FOLLOWERS_PART_RE.match(os.path.basename(path)).group(1)))
+
     async def get_followers(self, **kwargs):
         if not self.supports_followers():
             return {}
-        follower_path = Path(f'{self.INSTAGRAM_FOLLOWER_FOLLOWING_PATH}/followers_1.json')
-        with open(follower_path, 'r', encoding='utf-8') as f:
-            return [follower['string_list_data'] for follower in json.load(f)]
+        followers = []
+        for follower_path in self._get_follower_paths():
+            followers.extend(follower['string_list_data'] for follower in await self._read_export_json(follower_path))
+        return followers
 
     async def get_following(self, **kwargs):
         if not self.supports_following():
             return {}
-        following_path = Path(f'{self.INSTAGRAM_FOLLOWER_FOLLOWING_PATH}/following.json')
-        with open(following_path, 'r', encoding='utf-8') as f:
-            return json.load(f)['relationships_following']
+        following_path = f'{self.INSTAGRAM_FOLLOWER_FOLLOWING_PATH}/following.json'
+        return (await self._read_export_json(following_path))['relationships_following']
 
     async def get_close_friends(self, **kwargs):
         if not self.supports_close_friends():
             return {}
 
-        close_friends_path = Path(f'{self.INSTAGRAM_FOLLOWER_FOLLOWING_PATH}/close_friends.json')
-        with open(close_friends_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        close_friends_path = f'{self.INSTAGRAM_FOLLOWER_FOLLOWING_PATH}/close_friends.json'
+        return await self._read_export_json(close_friends_path)
+
+    @staticmethod
+    def _get_username(entry: dict) -> Optional[str]:
+        # Followers have the username in string_list_data while following has it in the title
+        string_list_data = entry.get('string_list_data') or [{}]
+        return string_list_data[0].get('value') or entry.get('title') or None
+
+    async def _refresh_snapshots(self) -> Dict[str, Dict[str, str]]:
+        """
+        Store every new followers / following export as a dated snapshot: a sorted file with one username per line.
+        The snapshot is dated with the modification date of the export.
+        :return: Snapshot file path by date by kind
+        """
+        if self._snapshot_index is None:
+            try:
+                async with aiofiles.open(self.SNAPSHOT_INDEX_PATH, 'r', encoding='utf-8') as f:
+                    self._snapshot_index = json.loads(await f.read())
+            except (FileNotFoundError, json.JSONDecodeError):
+                self._snapshot_index = {}
+
+        sources = {}
+        if self.supports_followers():
+            sources[self.FOLLOWERS] = self._get_follower_paths()
+        if self.supports_following():
+            sources[self.FOLLOWING] = [f'{self.INSTAGRAM_FOLLOWER_FOLLOWING_PATH}/following.json']
+
+        changed = False
+        for kind, paths in sources.items():
+            fingerprints = [file_fingerprint(path) for path in paths]
+            kind_index = self._snapshot_index.setdefault(kind, {'source_fingerprints': None, 'snapshots': {}})
+            if kind_index['source_fingerprints'] == fingerprints:
+                continue
+
+            usernames = set()
+            for path in paths:
+                data = await self._read_export_json(path)
+                entries = data['relationships_following'] if kind == self.FOLLOWING else data
+                usernames.update(username for username in map(self._get_username, entries) if username)
+
+            snapshot_date = date.fromtimestamp(max(fingerprint[0] for fingerprint in fingerprints) / 1e9).isoformat()
+            snapshot_path = os.path.join(self.SNAPSHOTS_PATH, kind, f'{snapshot_date}.txt')
+            os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+            async with aiofiles.open(snapshot_path, 'w', encoding='utf-8') as f:
+                await f.write('\n'.join(sorted(usernames)))
+
+            self._snapshots.pop(snapshot_path, None)
+            kind_index['source_fingerprints'] = fingerprints
+            kind_index['snapshots'][snapshot_date] = snapshot_path
+            changed = True
+
+        if changed:
+            async with aiofiles.open(self.SNAPSHOT_INDEX_PATH, 'w', encoding='utf-8') as f:
+                await f.write(json.dumps(self._snapshot_index))
+
+        return {kind: kind_index['snapshots'] for kind, kind_index in self._snapshot_index.items()}
+
+    async def _read_snapshot(self, snapshot_path: str) -> List[str]:
+        if snapshot_path not in self._snapshots:
+            async with aiofiles.open(snapshot_path, 'r', encoding='utf-8') as f:
+                self._snapshots[snapshot_path] = (await f.read()).splitlines()
+        return self._snapshots[snapshot_path]
+
+    async def _get_snapshot(self, kind: str, on_or_before: str = None, before: str = None) -> Optional[List[str]]:
+        """
+        Get the latest snapshot of the kind on or before the date (YYYY-MM-DD), or strictly before `before`.
+        """
+        snapshots = (await self._refresh_snapshots()).get(kind, {})
+        dates = sorted(snapshot_date for snapshot_date in snapshots
+                       if (not on_or_before or snapshot_date <= on_or_before) and (not before or snapshot_date < before))
+        if not dates:
+            return None
+        return await self._read_snapshot(snapshots[dates[-1]])
+
+    @staticmethod
+    def _sorted_difference(left: List[str], right: List[str]) -> List[str]:
+        """
+        Items of the sorted list `left` missing in the sorted list `right`, by a merge join.
+        """
+        result = []
+        i, j = 0, 0
+        while i < len(left):
+            if j == len(right) or left[i] < right[j]:
+                result.append(left[i])
+                i += 1
+            elif left[i] > right[j]:
+                j += 1
+            else:
+                i += 1
+                j += 1
+        return result
+
+    async def _get_snapshot_pair(self, kind: str, from_date: str = None, to_date: str = None):
+        # By default, compare the latest snapshot with the one before it
+        current = await self._get_snapshot(kind, on_or_before=to_date)
+        if current is None:
+            return None, None
+        if from_date:
+            previous = await self._get_snapshot(kind, on_or_before=from_date)
+        else:
+            current_date = max(snapshot_date for snapshot_date in (await self._refresh_snapshots())[kind]
+                               if not to_date or snapshot_date <= to_date)
+            previous = await self._get_snapshot(kind, before=current_date)
+        return previous, current
+
+    async def get_snapshots(self, **kwargs) -> Dict[str, List[str]]:
+        """
+        Dates of the available followers and following snapshots.
+        """
+        if not self._working:
+            return {}
+        return {kind: sorted(snapshots) for kind, snapshots in (await self._refresh_snapshots()).items()}
+
+    async def get_new_followers(self, from_date: str = None, to_date: str = None, **kwargs) -> List[str]:
+        """
+        Users following in the `to_date` snapshot but not in the `from_date` one.
+        """
+        previous, current = await self._get_snapshot_pair(self.FOLLOWERS, from_date, to_date)
+        if previous is None:
+            return []
+        return self._sorted_difference(current, previous)
+
+    async def get_unfollowers(self, from_date: str = None, to_date: str = None, **kwargs) -> List[str]:
+        """
+        Users following in the `from_date` snapshot but not in the `to_date` one.
+        """
+        previous, current = await self._get_snapshot_pair(self.FOLLOWERS, from_date, to_date)
+        if previous is None:
+            return []
+        return self._sorted_difference(previous, current)
+
+    async def get_non_mutuals(self, on_date: str = None, **kwargs) -> Dict[str, List[str]]:
+        """
+        Users followed who don't follow back and the other way around, as of the snapshots on or before the date.
+        """
+        followers = await self._get_snapshot(self.FOLLOWERS, on_or_before=on_date) or []
+        following = await self._get_snapshot(self.FOLLOWING, on_or_before=on_date) or []
+        return {
+            "not_following_back": self._sorted_difference(following, followers),
+            "not_followed_back": self._sorted_difference(followers, following),
+        }
 
     @staticmethod
     def fix_mojibake(text: str) -> str:
         # Get the emojis
         try:
             return text.encode("latin1").decode("utf-8")
+        except UnicodeError:
+            # Not mojibake, e.g. it has characters beyond latin1 or isn't UTF-8 bytes. Keep it as it is
+            return text
+
+    @staticmethod
+    def _unescape_mojibake_byte(match: re.Match) -> bytes:
+        if match.group(1) is None:
+            # An escaped backslash, keep it as is
+            return match.group(0)
+        return bytes.fromhex(match.group(1).decode())
+
+    @staticmethod
+    def _fix_mojibake_in_values(value):
+        if isinstance(value, str):
+            return InstagramProvider.fix_mojibake(value)
+        if isinstance(value, list):
+            return [InstagramProvider._fix_mojibake_in_values(item) for item in value]
+        if isinstance(value, dict):
+            return {key: InstagramProvider._fix_mojibake_in_values(item) for key, item in value.items()}
+        return value
+
+    @staticmethod
+    def load_repaired_json(raw: bytes):
+        """
+        Decode an Instagram export JSON while undoing its mojibake.
+        Instagram writes every UTF-8 byte of a non-ASCII character as its own \\u00XX escape. Turning those escapes
+        back into bytes and decoding the whole file once as UTF-8 repairs every string in a single pass.
+        """
+        try:
+            return json.loads(InstagramProvider.MOJIBAKE_ESCAPE_RE.sub(InstagramProvider._unescape_mojibake_byte, raw)
+                              .decode('utf-8'))
         except UnicodeDecodeError:
-            return text  # fallback if it fails
+            # Some strings aren't mojibake. Fix the strings one by one
+            return InstagramProvider._fix_mojibake_in_values(json.loads(raw))
 
     @staticmethod
     def clean_message(message):
-        return InstagramProvider.fix_mojibake(message).strip()
+        # The export is repaired from mojibake when it is ingested
+        return message.strip()
 
     @staticmethod
     def _add_to_contexts(existing_contexts: Optional[list], new_context: dict):
@@ -174,10 +407,9 @@ class InstagramProvider(MemoryProvider):
                     continue
                 dump_asset_id = asset[len('your_instagram_activity/messages/inbox/'):]
                 parsable_asset_id = InstagramProvider.generate_asset_id(dump_asset_id)
-                asset_path = InstagramProvider.get_file_path(file_id=dump_asset_id)
                 contexts.append({
                     "asset_id": parsable_asset_id,
-                    "mime_type": mimetypes.guess_type(asset_path)[0],
+                    "mime_type": guess_mime_type(dump_asset_id),
                     "new_tab_url": f'/asset/{InstagramProvider.NAME}/{parsable_asset_id}'
                 })
 
@@ -224,6 +456,254 @@ class InstagramProvider(MemoryProvider):
         messages.reverse()
         return messages
 
+    def _get_inbox_paths(self) -> List[str]:
+        """
+        Folders of the conversations: the extracted messages folder and the inbox of each export zip file in
+        INSTAGRAM_PATH, oldest first.
+        """
+        paths = [self.INSTAGRAM_MESSAGE_PATH] if os.path.isdir(self.INSTAGRAM_MESSAGE_PATH) else []
+        if not os.path.isdir(self.INSTAGRAM_PATH):
+            return paths
+        archive_paths = [os.path.join(self.INSTAGRAM_PATH, entry) for entry in os.listdir(self.INSTAGRAM_PATH)]
+        for archive_path in sorted(filter(archives.is_archive, archive_paths), key=os.path.getmtime):
+            for inbox_path in self.ARCHIVE_INBOX_PATHS:
+                inbox_path = os.path.join(archive_path, inbox_path)
+                if archives.isdir(inbox_path):
+                    paths.append(inbox_path)
+                    break
+        return paths
+
+    def _get_conversation_paths(self) -> Dict[str, str]:
+        """
+        Folder of each conversation. A conversation in a newer export replaces the one in an older export.
+        """
+        conversation_paths = {}
+        for inbox_path in self._get_inbox_paths():
+            for conversation in archives.listdir(inbox_path):
+                conversation_path = os.path.join(inbox_path, conversation)
+                if archives.isdir(conversation_path):
+                    conversation_paths[conversation] = conversation_path
+        return conversation_paths
+
+    def get_source_paths(self) -> List[str]:
+        if not self._working:
+            return []
+        paths = []
+        for conversation_path in self._get_conversation_paths().values():
+            paths.extend(os.path.join(conversation_path, part) for part in self._get_part_files(conversation_path))
+        return paths
+
+    async def _compute_source_metadata(self, path: str) -> dict:
+        friend = self._get_friend(os.path.basename(os.path.dirname(path)))
+        dates = [message.datetime.date() for message in await self._read_and_parse(filepath=path,
+                                                                                   name_from_file=friend)]
+        return {
+            "start_date": min(dates) if dates else None,
+            "end_date": max(dates) if dates else None,
+            "message_count": len(dates),
+        }
+
+    @staticmethod
+    def _get_friend(conversation: str) -> str:
+        # Conversation folders are named <friend>_<id>
+        friend = '_'.join(conversation.split('_')[:-1])
+        if friend == conversation:
+            return InstagramProvider.DELETED_USER
+        return friend
+
+    async def on_sources_changed(self, changed: List[str], removed: List[str]):
+        # Repairs and caches the changed part files and indexes their conversations
+        await self._refresh_manifest()
+        await super().on_sources_changed(changed, removed)
+
+    @staticmethod
+    def _get_part_files(conversation_path: str) -> List[str]:
+        # Long threads are split in message_1.json, message_2.json, ...
+        parts = [entry for entry in archives.listdir(conversation_path)
+                 if InstagramProvider.MESSAGE_PART_RE.match(entry)]
+        return sorted(parts, key=lambda part: int(InstagramProvider.MESSAGE_PART_RE.match(part).group(1)))
+
+    def _get_cache_path(self, filepath: str) -> str:
+        # <conversation>/<part>, wherever the export is
+        return os.path.join(self.INSTAGRAM_CACHE_PATH, os.path.basename(os.path.dirname(filepath)),
+                            os.path.basename(filepath))
+
+    async def _ingest_part(self, filepath: str, fingerprint: List[int]) -> Optional[dict]:
+        """
+        Read a message part file from the export, repair its mojibake and persist the result in the cache folder
+        along with the fingerprint of the source file. The repair is CPU bound, so it runs in a parse worker.
+        """
+        return await run_parse_job(InstagramProvider.ingest_part_file, filepath, self._get_cache_path(filepath),
+                                   fingerprint)
+
+    @staticmethod
+    def ingest_part_file(filepath: str, cache_path: str, fingerprint: List[int]) -> Optional[dict]:
+        try:
+            raw = InstagramProvider.load_repaired_json(archives.read_bytes(filepath))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        # The fingerprint is written first so that it is known before streaming the messages
+        data = {
+            'source_fingerprint': fingerprint,
+            'participants': raw.get('participants', []),
+            'messages': raw.get('messages', []),
+        }
+
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(f'{cache_path}.tmp', mode='w', encoding='utf-8') as f:
+            f.write(json.dumps(data, ensure_ascii=False))
+        os.replace(f'{cache_path}.tmp', cache_path)
+        return data
+
+    async def _load_part(self, filepath: str, fingerprint: List[int] = None, lower_bound_ms: int = None) -> Optional[dict]:
+        """
+        Read the participants and messages of a message part file from its repaired copy in the cache folder.
+
+        Instagram stores messages newest first, so with a lower bound the file is streamed and reading stops at the
+        first message older than the bound.
+        :param filepath: Path of the part file in the export
+        :param fingerprint: Fingerprint of the file, if already known
+        :param lower_bound_ms: Messages older than this timestamp aren't needed
+        :return: Dict with `participants`, the (possibly partial, newest first) `messages` and whether they are
+        `complete`
+        """
+        fingerprint = fingerprint or file_fingerprint(filepath)
+        cache_path = self._get_cache_path(filepath)
+        data = None
+        complete = True
+        if lower_bound_ms is None:
+            # Everything is needed, decoding the file at once is faster than streaming it
+            try:
+                async with aiofiles.open(cache_path, mode='r', encoding='utf-8') as f:
+                    content = await f.read()
+                metrics.add_bytes_read(self.NAME, len(content))
+                data = json.loads(content)
+            except (FileNotFoundError, json.JSONDecodeError):
+                pass
+            if data and data.get('source_fingerprint') != fingerprint:
+                data = None
+        else:
+            header = {}
+            messages = []
+            try:
+                async with aclosing(stream_json_array(cache_path, 'messages', header)) as stream:
+                    async for message in stream:
+                        if header.get('source_fingerprint') != fingerprint:
+                            break
+                        messages.append(message)
+                        if message.get('timestamp_ms') < lower_bound_ms:
+                            complete = False
+                            break
+                if header.get('source_fingerprint') == fingerprint:
+                    data = {'source_fingerprint': fingerprint,
+                            'participants': header.get('participants', []),
+                            'messages': messages}
+            except (FileNotFoundError, ValueError):
+                # json.JSONDecodeError is a ValueError
+                pass
+
+        metrics.cache_lookup(self.NAME, 'part_disk', data is not None)
+        if data is None:
+            # The export changed or wasn't ingested yet
+            complete = True
+            data = await self._ingest_part(filepath, fingerprint)
+            if fingerprint:
+                metrics.add_bytes_read(self.NAME, fingerprint[1])
+            if data is None:
+                return None
+
+        data['complete'] = complete
+        return data
+
+    async def _build_conversation_manifest(self, conversation_path: str, parts: Dict[str, List[int]]) -> Optional[dict]:
+        all_data = await asyncio.gather(*[self._load_part(os.path.join(conversation_path, part), fingerprint)
+                                          for part, fingerprint in parts.items()])
+
+        participants = None
+        part_extents = {}
+        for part, data in zip(parts.keys(), all_data):
+            if not data:
+                continue
+            participants = participants or [p.get('name', '') for p in data.get('participants', [])]
+            timestamps = [message.get('timestamp_ms') for message in data.get('messages', [])]
+            if timestamps:
+                part_extents[part] = [min(timestamps), max(timestamps)]
+
+        if participants is None:
+            return None
+
+        return {
+            "path": conversation_path,
+            "participants": participants,
+            "min_timestamp_ms": min((extent[0] for extent in part_extents.values()), default=None),
+            "max_timestamp_ms": max((extent[1] for extent in part_extents.values()), default=None),
+            "parts": parts,
+            "part_extents": part_extents,
+        }
+
+    async def _refresh_manifest(self) -> Dict[str, dict]:
+        """
+        Keep the per conversation manifest (participants, timestamp extents and part files) in sync with the export.
+        Only the conversations whose part files changed are read again.
+        """
+        self._manifest_refreshed_at = time_module.monotonic()
+        if self._manifest is None:
+            try:
+                async with aiofiles.open(self.MANIFEST_PATH, 'r', encoding='utf-8') as f:
+                    self._manifest = json.loads(await f.read())
+            except (FileNotFoundError, json.JSONDecodeError):
+                self._manifest = {}
+
+        manifest = {}
+        stale = {}
+        conversation_paths = self._get_conversation_paths()
+        for conversation, conversation_path in conversation_paths.items():
+            parts = {part: file_fingerprint(os.path.join(conversation_path, part))
+                     for part in self._get_part_files(conversation_path)}
+            if not parts:
+                continue
+
+            existing = self._manifest.get(conversation)
+            if existing and existing['parts'] == parts and existing.get('path') == conversation_path:
+                manifest[conversation] = existing
+            else:
+                stale[conversation] = parts
+
+        if stale:
+            print(f"Indexing {len(stale)} Instagram conversations")
+            entries = await asyncio.gather(*[self._build_conversation_manifest(conversation_paths[conversation], parts)
+                                             for conversation, parts in stale.items()])
+            for conversation, entry in zip(stale.keys(), entries):
+                if entry:
+                    manifest[conversation] = entry
+
+        if manifest != self._manifest:
+            self._manifest = manifest
+            async with aiofiles.open(self.MANIFEST_PATH, 'w', encoding='utf-8') as f:
+                await f.write(json.dumps(manifest))
+
+        return self._manifest
+
+    @staticmethod
+    def _extent_in_range(min_timestamp_ms: Optional[int],
+                         max_timestamp_ms: Optional[int],
+                         on_date: Optional[date] = None,
+                         start_date: Optional[date] = None,
+                         end_date: Optional[date] = None) -> bool:
+        if min_timestamp_ms is None or max_timestamp_ms is None:
+            return False
+
+        first_date = datetime.fromtimestamp(min_timestamp_ms / 1000.0).date()
+        last_date = datetime.fromtimestamp(max_timestamp_ms / 1000.0).date()
+        if on_date and (on_date < first_date or on_date > last_date):
+            return False
+        if start_date and start_date > last_date:
+            return False
+        if end_date and end_date < first_date:
+            return False
+        return True
+
     async def fetch(self,
                     on_date: Optional[date] = None,
                     start_date: Optional[date] = None,
@@ -232,31 +712,46 @@ class InstagramProvider(MemoryProvider):
                     exclude_system_messages: bool = True,
                     senders: List[str] = None,
                     search_regex: str = None) -> List[Message]:
+        if not self._working:
+            return []
+
         print(f"Starting to fetch from Instagram {on_date=} {start_date=} {end_date=}")
         sender_regexes = [await get_regex_from_name(sender) for sender in senders] if senders else None
 
         pattern = re.compile(search_regex) if search_regex else None
 
+        manifest = await self._get_manifest()
+
         tasks = []
-        for found in os.listdir(self.INSTAGRAM_MESSAGE_PATH):
-            friend = '_'.join(found.split('_')[:-1])
-            friend_path = Path(os.path.join(os.path.join(self.INSTAGRAM_MESSAGE_PATH, found), 'message_1.json'))
+        for conversation, entry in manifest.items():
+            # Skip the conversations without opening them
+            if not self._extent_in_range(entry['min_timestamp_ms'], entry['max_timestamp_ms'],
+                                         on_date=on_date, start_date=start_date, end_date=end_date):
+                continue
+
+            if ignore_groups and len(entry['participants']) > 2:
+                continue
 
-            if not friend_path.exists():
+            if sender_regexes and not any(MemoryProvider._sender_matched(participant, sender_regexes)
+                                          for participant in entry['participants']):
                 continue
 
-            if friend == found:
-                friend = self.DELETED_USER
+            friend = self._get_friend(conversation)
 
-            tasks.append(
-                self._read_and_parse(filepath=friend_path,
-                                     name_from_file=friend,
-                                     on_date=on_date,
-                                     start_date=start_date,
-                                     end_date=end_date,
-                                     ignore_groups=ignore_groups,
-                                     sender_regexes=sender_regexes,
-                                     pattern=pattern))
+            for part, fingerprint in entry['parts'].items():
+                if not self._extent_in_range(*entry['part_extents'].get(part, (None, None)),
+                                             on_date=on_date, start_date=start_date, end_date=end_date):
+                    continue
+                tasks.append(
+                    self._read_and_parse(filepath=os.path.join(entry['path'], part),
+                                         fingerprint=fingerprint,
+                                         name_from_file=friend,
+                                         on_date=on_date,
+                                         start_date=start_date,
+                                         end_date=end_date,
+                                         ignore_groups=ignore_groups,
+                                         sender_regexes=sender_regexes,
+                                         pattern=pattern))
 
         memories_nested = await asyncio.gather(*tasks)
         memories = [item for sublist in memories_nested for item in sublist]
@@ -264,15 +759,104 @@ class InstagramProvider(MemoryProvider):
         print("Done fetching from Instagram")
         return memories
 
-    async def _read_and_parse(self, filepath: Path, **kwargs):
-        try:
-            async with aiofiles.open(filepath, mode='r', encoding='utf-8') as f:
-                raw = await f.read()
-                data = json.loads(raw)
-                return self.parse_json(data, **kwargs)
-        except (FileNotFoundError, json.JSONDecodeError):
+    async def _get_manifest(self) -> Dict[str, dict]:
+        """
+        The manifest, refreshed first unless the source watcher keeps it in sync: once the watcher has a snapshot of
+        the part files from before the last refresh, every change since reaches on_sources_changed.
+        """
+        if self._manifest is not None and self.sources_watched_since is not None \
+                and self._manifest_refreshed_at >= self.sources_watched_since:
+            return self._manifest
+        return await self._refresh_manifest()
+
+    async def _get_parsed_part(self, filepath: str, fingerprint: List[int], name_from_file: str,
+                               lower_bound_ms: Optional[int]) -> Optional[dict]:
+        """
+        The messages of a part file parsed without filters, as rows (see Message.to_row) with their local date, oldest
+        first. They are kept in a least recently used cache of at most INSTAGRAM_CACHED_MESSAGES messages. A part read
+        down to a lower bound is reused by any query whose lower bound it covers.
+        :return: Dict with `participants`, `entries` ((local date, row) pairs), `oldest_ms` (timestamp of the oldest
+        message read) and `complete`, or None if the file can't be read
+        """
+        parsed = self._parsed_parts.get(filepath)
+        if parsed and parsed['fingerprint'] == fingerprint and (
+                parsed['complete'] or (lower_bound_ms is not None and parsed['oldest_ms'] < lower_bound_ms)):
+            self._parsed_parts.move_to_end(filepath)
+            metrics.cache_lookup(self.NAME, 'part_memory', True)
+            return parsed
+        metrics.cache_lookup(self.NAME, 'part_memory', False)
+
+        data = await self._load_part(filepath, fingerprint, lower_bound_ms=lower_bound_ms)
+        if not data:
+            return None
+        messages = InstagramProvider.parse_json(data, name_from_file)
+        parsed = {
+            'fingerprint': fingerprint,
+            'participants': [p.get('name', '') for p in data['participants']],
+            'entries': [(message.datetime.replace(tzinfo=timezone.utc).astimezone().date(), message.to_row())
+                        for message in messages],
+            'oldest_ms': data['messages'][-1].get('timestamp_ms') if data['messages'] else None,
+            'complete': data['complete'] or not data['messages'],
+        }
+
+        previous = self._parsed_parts.pop(filepath, None)
+        if previous:
+            self._parsed_messages -= len(previous['entries'])
+        if len(parsed['entries']) <= INSTAGRAM_CACHED_MESSAGES:
+            self._parsed_parts[filepath] = parsed
+            self._parsed_messages += len(parsed['entries'])
+            while self._parsed_messages > INSTAGRAM_CACHED_MESSAGES:
+                _, evicted = self._parsed_parts.popitem(last=False)
+                self._parsed_messages -= len(evicted['entries'])
+        return parsed
+
+    @staticmethod
+    def _filter_parsed_part(parsed: dict,
+                            on_date: Optional[date] = None,
+                            start_date: Optional[date] = None,
+                            end_date: Optional[date] = None,
+                            ignore_groups: bool = False,
+                            sender_regexes: List[str] = None,
+                            pattern=None) -> List[Message]:
+        """
+        Apply the filters of parse_json to a parsed part. Every fetch gets new Messages, since the aggregator and the
+        privacy layer change the messages they are given.
+        """
+        if ignore_groups and len(parsed['participants']) > 2:
+            return []
+        if sender_regexes and not any(MemoryProvider._sender_matched(participant, sender_regexes)
+                                      for participant in parsed['participants']):
             return []
 
+        messages = []
+        for local_date, row in parsed['entries']:
+            if on_date and local_date != on_date:
+                continue
+            if start_date and local_date < start_date:
+                continue
+            if end_date and local_date > end_date:
+                continue
+            message = Message.from_row(row)
+            if sender_regexes and not InstagramProvider._sender_matched(message.sender, sender_regexes):
+                continue
+            if pattern and pattern.search(message.message) is None:
+                continue
+            if message.context:
+                message.context = dict(message.context)
+            messages.append(message)
+        return messages
+
+    async def _read_and_parse(self, filepath: str, fingerprint: List[int] = None, name_from_file: str = None,
+                              on_date: Optional[date] = None, start_date: Optional[date] = None, **kwargs):
+        lower_date = on_date or start_date
+        lower_bound_ms = int(datetime.combine(lower_date, time.min).timestamp() * 1000) if lower_date else None
+
+        parsed = await self._get_parsed_part(filepath, fingerprint or file_fingerprint(filepath), name_from_file,
+                                             lower_bound_ms)
+        if not parsed:
+            return []
+        return self._filter_parsed_part(parsed, on_date=on_date, start_date=start_date, **kwargs)
+
     @staticmethod
     def generate_asset_id(file_id) -> str:
         return file_id.replace('/', '___')
@@ -290,15 +874,24 @@ class InstagramProvider(MemoryProvider):
         media_file_path = os.path.join(InstagramProvider.INSTAGRAM_MESSAGE_PATH, file_id)
         return media_file_path
 
-    async def get_asset(self, asset_id: str) -> Tuple[bytes, str]:
+    async def get_asset(self, asset_id: str) -> Tuple[bytes | archives.MemberStream, str]:
         media_file_path = InstagramProvider.get_file_path(asset_id=asset_id)
         if not os.path.exists(media_file_path):
-            raise FileNotFoundError(f"{media_file_path} does not exist")
+            # The conversation may be in an export zip file
+            conversation, _, file_path = self.get_file_id_from_asset_id(asset_id).partition('/')
+            conversation_path = self._get_conversation_paths().get(conversation)
+            if conversation_path is None or not archives.exists(os.path.join(conversation_path, file_path)):
+                raise FileNotFoundError(f"{media_file_path} does not exist")
+            media_file_path = os.path.join(conversation_path, file_path)
 
         mime_type, _ = mimetypes.guess_type(media_file_path)
         if mime_type is None:
             raise ValueError("Could not determine MIME type")
 
+        if archives.split_archive_path(media_file_path):
+            # Sent from the zip file while the response is written
+            return archives.stream(media_file_path), mime_type
+
         async with aiofiles.open(media_file_path, "rb") as media_file:
             media_data = await media_file.read()
         return media_data, mime_type
@@ -3,12 +3,13 @@ import os
 from datetime import date, datetime, timezone
 from typing import List, Optional, Iterable
 
-from provider.base_provider import MemoryProvider, MessageType, Message, MediaType
+from provider.base_provider import MemoryProvider, MessageType, Message, MediaType, FetchGranularity
 from utils import human_duration
 
 
 class UberProvider(MemoryProvider):
     NAME = "Uber"
+    FETCH_GRANULARITY = FetchGranularity.RANGE
     WORKING = True
     UBER_PATH = 'data/uber'
     TRIPS_HISTORY_PATH = f'{UBER_PATH}/trips_data-0.csv'
@@ -24,6 +25,9 @@ class UberProvider(MemoryProvider):
     def is_working(self):
         return self.WORKING
 
+    def get_source_paths(self) -> List[str]:
+        return [self.TRIPS_HISTORY_PATH] if self.WORKING else []
+
     @staticmethod
     def parse_ts(ts: str | None):
         if not ts:
@@ -175,28 +179,3 @@ class UberProvider(MemoryProvider):
         messages.sort(key=lambda memory: memory.datetime)
         print("Done fetching from Uber")
         return messages
-
-    async def get_start_end_date(self):
-        if not self.WORKING:
-            return None, None
-
-        start_dt = None
-        end_dt = None
-
-        for entry in self.iter_csv(self.TRIPS_HISTORY_PATH):
-            parsed = UberProvider.parse_timeline_entry(entry)
-            if not parsed or not parsed[0]:
-                continue
-
-            dt = parsed[0]
-
-            if start_dt is None:
-                start_dt = dt  # first valid entry
-
-            # Assuming the csv in in increasing order of timestamp
-            end_dt = dt  # last valid entry (keeps updating)
-
-        if not start_dt or not end_dt:
-            return None, None
-
-        return start_dt.date(), end_dt.date()
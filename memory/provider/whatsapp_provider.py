@@ -1,23 +1,229 @@
-import asyncio
+import hashlib
 import mimetypes
 import os
 import re
-from datetime import datetime, date, timezone
-from typing import List, Optional, Tuple, Dict, Any
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from datetime import datetime, date, timezone, timedelta
+from typing import List, Optional, Tuple, Dict, Any, FrozenSet
 
 import aiofiles
 
+import archives
+import metrics
+from parsing import run_parse_job, run_parse_jobs
 from profile import get_regex_from_name
-from provider.base_provider import MemoryProvider, MessageType, MediaType, Message, FormattingType
+from provider.base_provider import MemoryProvider, MessageType, MediaType, Message, FormattingType, FetchGranularity
+from utils import guess_mime_type
+
+# strptime directives of the WhatsApp date formats, with the same patterns strptime matches them with
+DATE_DIRECTIVE_PATTERNS = {
+    'd': r'(3[01]|[12]\d|0[1-9]|[1-9]| [1-9])',
+    'm': r'(1[0-2]|0[1-9]|[1-9])',
+    'Y': r'(\d\d\d\d)',
+    'y': r'(\d\d)',
+    'H': r'(2[0-3]|[0-1]\d|\d)',
+    'I': r'(1[0-2]|0[1-9]|[1-9])',
+    'M': r'([0-5]\d|\d)',
+    'S': r'(6[0-1]|[0-5]\d|\d)',
+    'p': r'(am|pm)',
+}
+_compiled_date_formats: Dict[str, Optional[Tuple[re.Pattern, List[str]]]] = {}
+
+
+def compile_date_format(fmt: str) -> Optional[Tuple[re.Pattern, List[str]]]:
+    """
+    Turn a strptime format into a regex matching the same strings, so the captures can build the datetime directly.
+    :return: The regex and the directive of each group, or None if the format has a directive that isn't supported
+    """
+    if fmt in _compiled_date_formats:
+        return _compiled_date_formats[fmt]
+
+    pattern = ''
+    directives = []
+    compiled = None
+    for token in re.findall(r'%.|\s+|.', fmt):
+        if token.startswith('%'):
+            if token[1] not in DATE_DIRECTIVE_PATTERNS:
+                break
+            pattern += DATE_DIRECTIVE_PATTERNS[token[1]]
+            directives.append(token[1])
+        elif token.isspace():
+            # strptime lets any whitespace run match a space
+            pattern += r'\s+'
+        else:
+            pattern += re.escape(token)
+    else:
+        compiled = (re.compile(pattern, re.IGNORECASE), directives)
+    _compiled_date_formats[fmt] = compiled
+    return compiled
+
+
+class ChatDateParser:
+    """
+    Parses the message timestamps of one chat file, giving the same results as trying datetime.strptime with each
+    format in order, and converting the result to the local timezone unless the timestamps are local.
+
+    A chat file uses a single date format. It is detected on the first timestamp and its regex captures build the
+    datetime without strptime. Timestamps are memoized, as every one is parsed twice (indexing and parsing) and
+    messages cluster in the same minutes, and the local timezone is resolved once per hour.
+    """
+
+    def __init__(self, formats: List[str], local: bool):
+        """
+        :param formats: Formats to try, in order
+        :param local: Whether timestamps are kept as naive local times, else they get the local timezone
+        """
+        self.formats = formats
+        self.local = local
+        self.compiled_format = None
+        # Regexes of the formats tried before the detected one. A timestamp matching any of them takes the slow path,
+        # so that the first format that parses it still wins
+        self._earlier_formats: List[re.Pattern] = []
+        self._memo: Dict[str, Optional[datetime]] = {}
+        self._hour_tz: Dict[tuple, Optional[timezone]] = {}
+
+    def parse(self, date_str: str) -> Optional[datetime]:
+        if date_str in self._memo:
+            return self._memo[date_str]
+        dt = self._parse_with_detected_format(date_str)
+        if dt is None:
+            # Not in the detected format, fall back to trying every format
+            dt = self._parse_with_formats(date_str)
+        if dt is not None and not self.local:
+            dt = self.to_local(dt)
+        self._memo[date_str] = dt
+        return dt
+
+    def _parse_with_detected_format(self, date_str: str) -> Optional[datetime]:
+        if self.compiled_format is None:
+            return None
+        regex, directives = self.compiled_format
+        match = regex.fullmatch(date_str)
+        if not match or any(earlier.fullmatch(date_str) for earlier in self._earlier_formats):
+            return None
+        values = dict(zip(directives, match.groups()))
+        if 'Y' in values:
+            year = int(values['Y'])
+        elif 'y' in values:
+            year = int(values['y'])
+            # Same pivot as strptime
+            year += 2000 if year <= 68 else 1900
+        else:
+            year = 1900
+        if 'I' in values:
+            hour = int(values['I']) % 12
+            if values.get('p', '').lower() == 'pm':
+                hour += 12
+        else:
+            hour = int(values.get('H', 0))
+        try:
+            return datetime(year, int(values.get('m', 1)), int(values.get('d', 1)), hour, int(values.get('M', 0)),
+                            int(values.get('S', 0)))
+        except ValueError:
+            return None
+
+    def _parse_with_formats(self, date_str: str) -> Optional[datetime]:
+        for fmt in self.formats:
+            try:
+                dt = datetime.strptime(date_str, fmt)
+            except ValueError:
+                continue
+            if self.compiled_format is None:
+                self._detect_format(fmt)
+            return dt
+        return None
+
+    def _detect_format(self, fmt: str):
+        earlier_formats = [compile_date_format(earlier) for earlier in self.formats[:self.formats.index(fmt)]]
+        if all(earlier_formats):
+            self._earlier_formats = [regex for regex, _ in earlier_formats]
+            self.compiled_format = compile_date_format(fmt)
+
+    def _local_tz(self, dt: datetime) -> Optional[timezone]:
+        """
+        Local timezone of a naive local time, cached per hour. None when the offset changes within the hour.
+        """
+        key = (dt.year, dt.month, dt.day, dt.hour)
+        if key not in self._hour_tz:
+            start = dt.replace(minute=0, second=0, microsecond=0).astimezone(None)
+            end = dt.replace(minute=59, second=59, microsecond=0).astimezone(None)
+            same = start.utcoffset() == end.utcoffset() and start.tzname() == end.tzname()
+            self._hour_tz[key] = start.tzinfo if same else None
+        return self._hour_tz[key]
+
+    def to_local(self, dt: datetime) -> datetime:
+        """
+        Same as dt.astimezone(None) for a naive dt.
+        """
+        tz = self._local_tz(dt)
+        return dt.replace(tzinfo=tz) if tz is not None else dt.astimezone(None)
+
+    def to_utc(self, dt: datetime) -> datetime:
+        """
+        Same as dt.astimezone(timezone.utc).replace(tzinfo=None), naive times being local.
+        """
+        if dt.tzinfo is None:
+            dt = self.to_local(dt)
+        return dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+# Folder path to its mtime and the names in it (and the lowercased names), see ChatFolder.get
+_chat_folder_listings: Dict[str, Tuple[int, FrozenSet[str], FrozenSet[str]]] = {}
+
+
+class ChatFolder:
+    """
+    Names of the files in a chat export folder or zip file, listed once instead of stat()ing each attached file.
+    Listings are cached per process and refreshed when the folder's mtime changes, i.e. when a file is added or removed.
+    """
+
+    def __init__(self, folder_path: str):
+        self.folder_path = folder_path
+        mtime = os.stat(folder_path).st_mtime_ns
+        cached = _chat_folder_listings.get(folder_path)
+        if cached is None or cached[0] != mtime:
+            if archives.is_archive(folder_path):
+                names = archives.listdir(folder_path)
+            else:
+                names = []
+                with os.scandir(folder_path) as entries:
+                    for entry in entries:
+                        # Skip broken links, like os.path.exists does
+                        if not entry.is_symlink() or os.path.exists(entry.path):
+                            names.append(entry.name)
+            cached = (mtime, frozenset(names), frozenset(name.lower() for name in names))
+            _chat_folder_listings[folder_path] = cached
+        _, self.names, self._lower_names = cached
+
+    def has_file(self, name: str) -> bool:
+        """
+        Same as os.path.exists(os.path.join(folder_path, name)), without a system call for the usual names.
+        """
+        if name in self.names:
+            return True
+        if name and os.sep not in name and (not os.altsep or os.altsep not in name) and name not in ('.', '..') \
+                and name.lower() not in self._lower_names:
+            return False
+        # A name differing only in case (case insensitive file systems) or a nested path
+        return archives.exists(os.path.join(self.folder_path, name))
 
 
 class WhatsAppProvider(MemoryProvider):
     NAME = "Whatsapp"
+    FETCH_GRANULARITY = FetchGranularity.RANGE
+    # The extents and participants of each chat are kept in the manifest, fetch() uses them to skip the chats outside
+    # the range or without the senders
+    PER_SOURCE_METADATA = True
+    # 2: chat_name, participants and is_group. 3: start_datetime, end_datetime and first_minute_keys
+    SOURCE_METADATA_VERSION = 3
     USER = 'Ritik'
 
     WHATSAPP_PATH = 'data/whatsapp'
     WHATSAPP_ANDROID_FILE_NAME_PREFIX = 'WhatsApp Chat with '
     WHATSAPP_IOS_FOLDER_NAME_PREFIX = 'WhatsApp Chat - '
+    # Another export of a chat saved next to the first one, e.g. "WhatsApp Chat with Friend (1).txt"
+    COPY_SUFFIX_RE = re.compile(r' \(\d+\)$')
 
     ANDROID = 'android'
     IOS = 'ios'
@@ -62,10 +268,12 @@ class WhatsAppProvider(MemoryProvider):
     # as well as other bidi markers (\u2066, \u2067, \u2068, \u2069, \u200e, \u200f)
     BIDI_CHARS_CLASS = r'\u2066-\u2069\u200e\u200f'
 
+    # Standard mentions or unicode-wrapped bidi mentions: e.g. @\u2068Ritik Surname\u2069 or @John
+    MENTION_PATTERN = rf'@[{BIDI_CHARS_CLASS}][^{BIDI_CHARS_CLASS}@*~_`\n]+[{BIDI_CHARS_CLASS}]|@\w+'
+
     # Regex to capture syntax and entities in a raw string (used in compile)
-    # Group 1 captures standard mentions or unicode-wrapped bidi mentions: e.g. @\u2068Ritik Surname\u2069 or @John
     TOKEN_RE = re.compile(
-        rf'(@[{BIDI_CHARS_CLASS}][^{BIDI_CHARS_CLASS}@*~_`\n]+[{BIDI_CHARS_CLASS}]|@\w+)|'  # Group 1: Mentions
+        rf'({MENTION_PATTERN})|'  # Group 1: Mentions
         r'\*(.*?)\*|'  # Group 2: Bold
         r'_(.*?)_|'  # Group 3: Italic
         r'~(.*?)~|'  # Group 4: Strikethrough
@@ -73,6 +281,20 @@ class WhatsAppProvider(MemoryProvider):
         r'\[(.*?)\]\((.*?)\)'  # Group 6 & 7: Explicit markdown link text and URL
     )
 
+    # Entity type of each WhatsApp formatting delimiter
+    FORMATTING_DELIMITERS = {
+        '_': FormattingType.ITALIC.value,
+        '*': FormattingType.BOLD.value,
+        '~': FormattingType.STRIKETHROUGH.value,
+        '`': FormattingType.CODE.value,
+    }
+    FORMATTING_CHARS_RE = re.compile(r'[*_~`@]')
+    DELIMITER_RE = re.compile(r'[*_~`]')
+    MENTION_RE = re.compile(MENTION_PATTERN)
+    BIDI_RE = re.compile(rf'[{BIDI_CHARS_CLASS}]')
+    # A delimiter opens after and closes before one of these (or a space)
+    FORMATTING_BOUNDARY_CHARS = frozenset(".,!?;:()[]{}<>\"'/\\")
+
     @staticmethod
     def detect_formatting(text: str) -> Tuple[str, List[Dict[str, Any]]]:
         """
@@ -81,137 +303,67 @@ class WhatsAppProvider(MemoryProvider):
 
         Natively supports Unicode bidi mentions (e.g. @\u2068Ritik\u2069) by stripping the hidden
         bidi controls and calculating the clean index shifts seamlessly.
+
+        Only the mentions and delimiters found by the precompiled regexes are visited. Offsets are mapped with the
+        sorted positions of the stripped characters instead of a per character table.
         """
         if not text:
             return "", []
 
-        # Supported WhatsApp delimiters and their entity types
-        delimiters = {
-            '_': FormattingType.ITALIC.value,
-            '*': FormattingType.BOLD.value,
-            '~': FormattingType.STRIKETHROUGH.value,
-            '`': FormattingType.CODE.value,
-        }
-
-        if not any(char in text for char in delimiters) and not '@' in text:
+        if not WhatsAppProvider.FORMATTING_CHARS_RE.search(text):
             return text, []
 
-        # Keep track of active formatting spans we are building
+        # (type, raw start, raw end) of each entity, in the order they are found
         raw_spans = []
+        # Positions of the delimiters and bidi controls to strip
+        stripped = []
 
-        # A stack to match delimiters
-        stacks = {char: [] for char in delimiters}
-
-        # Track which characters are formatting delimiters to be stripped
-        chars_to_strip = set()
-
-        # 1. Identify Mentions (Bidi-wrapped and normal) in the raw string first
-        mention_pattern = re.compile(
-            rf'@([{WhatsAppProvider.BIDI_CHARS_CLASS}])[^{WhatsAppProvider.BIDI_CHARS_CLASS}@*~_`\n]+([{WhatsAppProvider.BIDI_CHARS_CLASS}])|@\w+'
-        )
-
-        for m in mention_pattern.finditer(text):
-            start_idx, end_idx = m.span()
-            # matched_str = m.group(0)
-
-            # Record bidi override chars inside this mention for removal
-            for char_pos in range(start_idx, end_idx):
-                if text[char_pos] in '\u2066\u2067\u2068\u2069\u200e\u200f':
-                    chars_to_strip.add(char_pos)
-
-            # Extract username for resolving if needed
-            # clean_mention_str = re.sub(rf'[{WhatsAppProvider.BIDI_CHARS_CLASS}]', '', matched_str)
-            # username = clean_mention_str[1:]  # Strip '@'
+        # 1. Mentions (bidi wrapped and normal). The bidi controls inside them are stripped
+        for m in WhatsAppProvider.MENTION_RE.finditer(text):
+            start_raw, end_raw = m.span()
+            stripped.extend(bidi.start() for bidi in WhatsAppProvider.BIDI_RE.finditer(text, start_raw, end_raw))
+            raw_spans.append((FormattingType.MENTION.value, start_raw, end_raw))
 
-            # Add raw span entry
-            span_entry = {
-                "type": "mention",
-                "start_raw": start_idx,
-                "end_raw": end_idx
-            }
-
-            raw_spans.append(span_entry)
-
-        # 2. Match standard typography decorators while avoiding formatting characters
-        i = 0
+        # 2. Delimiters, matched with a stack per delimiter following WhatsApp's spacing & word boundary rules.
+        # Formatted text starts after the opening delimiter and ends before the closing one
         n = len(text)
-        while i < n:
-            char = text[i]
-            if char in delimiters:
-                # Check WhatsApp's spacing & word boundary rules:
-                # Can close if there's an open matching tag, preceding char is not space,
-                # and succeeding char is a boundary (space, punctuation, or end of string).
-                can_close = (
-                        len(stacks[char]) > 0 and
-                        i > 0 and
-                        not text[i - 1].isspace() and
-                        (i + 1 == n or text[i + 1].isspace() or text[i + 1] in ".,!?;:()[]{}<>\"'/\\")
-                )
-
-                # Can open if succeeding char is not space, and preceding char is a boundary
-                can_open = (
-                        i + 1 < n and
-                        not text[i + 1].isspace() and
-                        (i == 0 or text[i - 1].isspace() or text[i - 1] in ".,!?;:()[]{}<>\"'/\\")
-                )
-
-                if can_close:
-                    start_idx = stacks[char].pop()
-                    raw_spans.append({
-                        "type": delimiters[char],
-                        "start_raw": start_idx,
-                        "end_raw": i
-                    })
-                    # Mark both delimiters for removal
-                    chars_to_strip.add(start_idx)
-                    chars_to_strip.add(i)
-                elif can_open:
-                    stacks[char].append(i)
-
-            i += 1
-
-        # 3. Construct the clean string and map raw positions to clean positions
-        clean_chars = []
-        raw_to_clean = {}
-
-        clean_idx = 0
-        for raw_idx in range(n):
-            if raw_idx in chars_to_strip:
-                # This char is stripped, so it maps to the current clean position
-                raw_to_clean[raw_idx] = clean_idx
-            else:
-                clean_chars.append(text[raw_idx])
-                raw_to_clean[raw_idx] = clean_idx
-                clean_idx += 1
-
-        # Mapping edge case for trailing bounds mapping
-        raw_to_clean[n] = clean_idx
-
-        clean_text = "".join(clean_chars)
+        boundary = WhatsAppProvider.FORMATTING_BOUNDARY_CHARS
+        stacks = {char: [] for char in WhatsAppProvider.FORMATTING_DELIMITERS}
+        for m in WhatsAppProvider.DELIMITER_RE.finditer(text):
+            i = m.start()
+            stack = stacks[m.group()]
+            # Can close if there's an open matching tag, preceding char is not space,
+            # and succeeding char is a boundary (space, punctuation, or end of string).
+            if (stack and i > 0 and not text[i - 1].isspace()
+                    and (i + 1 == n or text[i + 1].isspace() or text[i + 1] in boundary)):
+                start_idx = stack.pop()
+                raw_spans.append((WhatsAppProvider.FORMATTING_DELIMITERS[m.group()], start_idx + 1, i))
+                stripped.append(start_idx)
+                stripped.append(i)
+            # Can open if succeeding char is not space, and preceding char is a boundary
+            elif (i + 1 < n and not text[i + 1].isspace()
+                  and (i == 0 or text[i - 1].isspace() or text[i - 1] in boundary)):
+                stack.append(i)
+
+        # 3. Clean text, and raw to clean offsets: a raw offset moves left by the stripped chars before it
+        stripped = sorted(set(stripped))
+        if stripped:
+            pieces = []
+            previous = 0
+            for position in stripped:
+                pieces.append(text[previous:position])
+                previous = position + 1
+            pieces.append(text[previous:])
+            clean_text = "".join(pieces)
+        else:
+            clean_text = text
 
-        # 4. Translate raw offsets to clean offsets
         entities = []
-        for span in raw_spans:
-            is_mention = span["type"] == FormattingType.MENTION.value
-
-            # If it's a mention, we preserve the "@" prefix (start_raw is preserved)
-            # If it's standard formatting, bounds are exclusive of delimiters (start_raw + 1)
-            start_raw = span["start_raw"] if is_mention else span["start_raw"] + 1
-            end_raw = span["end_raw"]
-
-            clean_start = raw_to_clean.get(start_raw, 0)
-            clean_end = raw_to_clean.get(end_raw, 0)
-
-            length = clean_end - clean_start
+        for span_type, start_raw, end_raw in raw_spans:
+            clean_start = start_raw - bisect_left(stripped, start_raw)
+            length = end_raw - bisect_left(stripped, end_raw) - clean_start
             if length > 0:
-                entity = {
-                    "type": span["type"],
-                    "offset": clean_start,
-                    "length": length
-                }
-                if "userId" in span:
-                    entity["userId"] = span["userId"]
-                entities.append(entity)
+                entities.append({"type": span_type, "offset": clean_start, "length": length})
 
         # Sort entities by offset for consistency
         entities.sort(key=lambda x: (x["offset"], -x["length"]))
@@ -219,41 +371,44 @@ class WhatsAppProvider(MemoryProvider):
         return clean_text, entities
 
     @staticmethod
-    def try_parse_date(date_str: str, _os: str) -> Optional[datetime]:
-        # Returns datetime in local timezone
-        formats = WhatsAppProvider.DATE_FORMATS_IOS if _os == WhatsAppProvider.IOS else WhatsAppProvider.DATE_FORMATS_ANDROID
-        for fmt in formats:
-            try:
-                dt = datetime.strptime(date_str, fmt)
-                if WhatsAppProvider.BACKUP_TIMESTAMP_LOCAL[_os]:
-                    return dt
-                # If the timestamp is in UTC, we need to convert it to local so that it can be compared with other timestamps
-                return dt.astimezone(None)
+    def format_message(text: str) -> Tuple[str, List[Dict[str, Any]]]:
+        """
+        Formatter of the parsed messages, run when a message's text or formatting is first read.
+        """
+        text, formatting = WhatsAppProvider.detect_formatting(text)
+        return text.strip(), formatting
 
-            except ValueError as e:
-                continue
-        return None
+    @staticmethod
+    def get_date_parser(_os: str) -> ChatDateParser:
+        """
+        Get a timestamp parser for one chat file, see ChatDateParser.
+        """
+        formats = WhatsAppProvider.DATE_FORMATS_IOS if _os == WhatsAppProvider.IOS else WhatsAppProvider.DATE_FORMATS_ANDROID
+        return ChatDateParser(formats, local=WhatsAppProvider.BACKUP_TIMESTAMP_LOCAL[_os])
 
     @staticmethod
-    async def parse_android_chat(file_path: str,
-                                 on_date: Optional[date] = None,
-                                 start_date: Optional[date] = None,
-                                 end_date: Optional[date] = None,
-                                 ignore_groups: bool = False,
-                                 exclude_system_messages: bool = True,
-                                 sender_regexes: List[str] = None,
-                                 pattern=None) -> List[Message]:
+    def parse_android_chat(file_path: str,
+                           on_date: Optional[date] = None,
+                           start_date: Optional[date] = None,
+                           end_date: Optional[date] = None,
+                           ignore_groups: bool = False,
+                           exclude_system_messages: bool = True,
+                           sender_regexes: List[str] = None,
+                           pattern=None) -> List[Message]:
         chat_entries = []
         _os = WhatsAppProvider.ANDROID
+        date_parser = WhatsAppProvider.get_date_parser(_os)
 
         media_included = not file_path.endswith('.txt')
         file_name_suffix = file_path.split(WhatsAppProvider.WHATSAPP_ANDROID_FILE_NAME_PREFIX)[1]
 
         if media_included:
+            # The export folder, or the zip file as shared by the app
             folder_path = file_path
-            chat_name = file_name_suffix
+            chat_name = archives.strip_archive_extension(file_name_suffix)
             # In the folder, search for the file starting with WHATSAPP_ANDROID_FILE_NAME_PREFIX
-            prefixed = [entry for entry in os.listdir(folder_path) if
+            chat_folder = ChatFolder(folder_path)
+            prefixed = [entry for entry in chat_folder.names if
                         entry.startswith(WhatsAppProvider.WHATSAPP_ANDROID_FILE_NAME_PREFIX)]
             if len(prefixed) != 1:
                 print(
@@ -262,12 +417,13 @@ class WhatsAppProvider(MemoryProvider):
             chat_file_path = os.path.join(folder_path, prefixed[0])
         else:
             folder_path = ''
+            chat_folder = None
             chat_name = file_name_suffix.split('.txt')[0]
             chat_file_path = file_path
 
         try:
-            async with aiofiles.open(chat_file_path, "r", encoding="utf-8") as f:
-                lines = await f.readlines()
+            with archives.open_text(chat_file_path, encoding="utf-8") as f:
+                lines = f.readlines()
         except FileNotFoundError:
             print(f"File not found: {chat_file_path}")
             return []
@@ -276,7 +432,7 @@ class WhatsAppProvider(MemoryProvider):
         for i, line in enumerate(lines):
             match = WhatsAppProvider.ANDROID_MSG_START_RE.match(line)
             if match:
-                dt = WhatsAppProvider.try_parse_date(match.group(1), _os)
+                dt = date_parser.parse(match.group(1))
                 if dt:
                     index_datetime_pairs.append((i, dt.date()))
 
@@ -353,13 +509,12 @@ class WhatsAppProvider(MemoryProvider):
                 return
             if media_included and '(file attached)' in text:
                 media_file_name = text.split('(file attached)')[0].strip()
-                media_file_path = os.path.join(folder_path, media_file_name)
-                if os.path.exists(media_file_path):
+                if chat_folder.has_file(media_file_name):
+                    asset_id = WhatsAppProvider.generate_asset_id(_os, chat_name, media_file_name)
                     context["asset_name"] = media_file_name
-                    context["asset_id"] = WhatsAppProvider.generate_asset_id(_os, chat_name, media_file_name)
-                    context["mime_type"] = mimetypes.guess_type(media_file_path)[0]
-                    context[
-                        "new_tab_url"] = f'/asset/{WhatsAppProvider.NAME}/{WhatsAppProvider.generate_asset_id(_os, chat_name, media_file_name)}'
+                    context["asset_id"] = asset_id
+                    context["mime_type"] = guess_mime_type(media_file_name)
+                    context["new_tab_url"] = f'/asset/{WhatsAppProvider.NAME}/{asset_id}'
                 text = text.split('(file attached)')[1].strip()
                 # TODO: If text has (file attached) in it, the part before that is the file name and the part after is the actual message. Check Darakshan example
                 media_type = MediaType.NON_TEXT if not text else MediaType.MIXED
@@ -391,20 +546,18 @@ class WhatsAppProvider(MemoryProvider):
             if sender == MemoryProvider.SYSTEM and exclude_system_messages:
                 return
 
-            text, formatting = WhatsAppProvider.detect_formatting(text)
-
             chat_entries.append(
                 Message(
-                    current_datetime.astimezone(timezone.utc).replace(tzinfo=None),
+                    date_parser.to_utc(current_datetime),
                     message_type=MessageType.SENT if current_sender == WhatsAppProvider.USER else MessageType.RECEIVED,
                     media_type=media_type,
-                    message=text.strip(),
+                    message=text,
                     sender=sender,
                     provider=WhatsAppProvider.NAME,
                     chat_name=chat_name,
                     is_group=is_group,
                     context=context,
-                    formatting=formatting,
+                    formatter=WhatsAppProvider.format_message,
                 )
             )
 
@@ -418,7 +571,7 @@ class WhatsAppProvider(MemoryProvider):
             line = line.strip()
             match = WhatsAppProvider.ANDROID_MSG_START_RE.match(line)
             if match:
-                dt = WhatsAppProvider.try_parse_date(match.group(1), _os)
+                dt = date_parser.parse(match.group(1))
                 if on_date and dt.date() != on_date:
                     break
                 if start_date and dt.date() < start_date:
@@ -444,25 +597,30 @@ class WhatsAppProvider(MemoryProvider):
         return chat_entries
 
     @staticmethod
-    async def parse_ios_chat(folder_path: str,
-                             on_date: Optional[date] = None,
-                             start_date: Optional[date] = None,
-                             end_date: Optional[date] = None,
-                             ignore_groups: bool = False,
-                             exclude_system_messages: bool = True,
-                             sender_regexes: List[str] = None,
-                             pattern=None) -> List[Message]:
+    def parse_ios_chat(folder_path: str,
+                       on_date: Optional[date] = None,
+                       start_date: Optional[date] = None,
+                       end_date: Optional[date] = None,
+                       ignore_groups: bool = False,
+                       exclude_system_messages: bool = True,
+                       sender_regexes: List[str] = None,
+                       pattern=None) -> List[Message]:
         chat_entries = []
         _os = WhatsAppProvider.IOS
+        date_parser = WhatsAppProvider.get_date_parser(_os)
 
-        chat_name = folder_path.split(WhatsAppProvider.WHATSAPP_IOS_FOLDER_NAME_PREFIX)[1]
+        chat_name = archives.strip_archive_extension(folder_path.split(WhatsAppProvider.WHATSAPP_IOS_FOLDER_NAME_PREFIX)[1])
 
         chat_file_name = '_chat.txt'
         chat_file_path = os.path.join(folder_path, chat_file_name)
+        try:
+            chat_folder = ChatFolder(folder_path)
+        except FileNotFoundError:
+            return []
 
         try:
-            async with aiofiles.open(chat_file_path, "r", encoding="utf-8") as f:
-                lines = await f.readlines()
+            with archives.open_text(chat_file_path, encoding="utf-8") as f:
+                lines = f.readlines()
         except FileNotFoundError:
             return []
 
@@ -470,7 +628,7 @@ class WhatsAppProvider(MemoryProvider):
         for i, line in enumerate(lines):
             match = WhatsAppProvider.IOS_MSG_START_RE.match(line)
             if match:
-                dt = WhatsAppProvider.try_parse_date(match.group(1), _os=_os)
+                dt = date_parser.parse(match.group(1))
                 if dt:
                     index_datetime_pairs.append((i, dt.date()))
 
@@ -554,13 +712,12 @@ class WhatsAppProvider(MemoryProvider):
                 return
             if '‎<attached: ' in text:
                 media_file_name = text.split('‎<attached: ')[1].strip()[:-1]
-                media_file_path = os.path.join(folder_path, media_file_name)
-                if os.path.exists(media_file_path):
+                if chat_folder.has_file(media_file_name):
+                    asset_id = WhatsAppProvider.generate_asset_id(_os, chat_name, media_file_name)
                     context["asset_name"] = media_file_name
-                    context["asset_id"] = WhatsAppProvider.generate_asset_id(_os, chat_name, media_file_name)
-                    context["mime_type"] = mimetypes.guess_type(media_file_path)[0]
-                    context[
-                        "new_tab_url"] = f'/asset/{WhatsAppProvider.NAME}/{WhatsAppProvider.generate_asset_id(_os, chat_name, media_file_name)}'
+                    context["asset_id"] = asset_id
+                    context["mime_type"] = guess_mime_type(media_file_name)
+                    context["new_tab_url"] = f'/asset/{WhatsAppProvider.NAME}/{asset_id}'
                 text = ""  # iOS doesn't give picture captions
                 media_type = MediaType.NON_TEXT
             elif '‎image omitted' in text or 'sticker omitted' in text or 'video omitted' in text:
@@ -592,20 +749,18 @@ class WhatsAppProvider(MemoryProvider):
             if sender == MemoryProvider.SYSTEM and exclude_system_messages:
                 return
 
-            text, formatting = WhatsAppProvider.detect_formatting(text)
-
             chat_entries.append(
                 Message(
-                    current_datetime.astimezone(timezone.utc).replace(tzinfo=None),
+                    date_parser.to_utc(current_datetime),
                     message_type=MessageType.SENT if current_sender == WhatsAppProvider.USER else MessageType.RECEIVED,
                     media_type=media_type,
-                    message=text.strip(),
+                    message=text,
                     sender=sender,
                     provider=WhatsAppProvider.NAME,
                     chat_name=chat_name,
                     is_group=is_group,
                     context=context,
-                    formatting=formatting
+                    formatter=WhatsAppProvider.format_message
                 )
             )
 
@@ -619,7 +774,7 @@ class WhatsAppProvider(MemoryProvider):
             line = line.strip()
             match = WhatsAppProvider.IOS_MSG_START_RE.match(line)
             if match:
-                dt = WhatsAppProvider.try_parse_date(match.group(1), _os)
+                dt = date_parser.parse(match.group(1))
                 if on_date and dt.date() != on_date:
                     break
                 if start_date and dt.date() < start_date:
@@ -644,6 +799,199 @@ class WhatsAppProvider(MemoryProvider):
 
         return chat_entries
 
+    @staticmethod
+    def parse_chat_rows(_os: str, path: str, options: dict) -> List[tuple]:
+        """
+        Parse a chat in a parse worker.
+        :param _os: ANDROID or IOS
+        :param path: Chat file or folder
+        :param options: Keyword arguments of parse_android_chat / parse_ios_chat
+        :return: Messages as rows, see Message.to_row()
+        """
+        parse = WhatsAppProvider.parse_android_chat if _os == WhatsAppProvider.ANDROID else WhatsAppProvider.parse_ios_chat
+        return [message.to_row() for message in parse(path, **options)]
+
+    @staticmethod
+    def parse_chat_metadata(_os: str, path: str) -> dict:
+        """
+        Parse a whole chat in a parse worker and return its extents and participants only.
+        :return: Dict with start_date, end_date, message_count, chat_name, participants (senders) and is_group
+        """
+        parse = WhatsAppProvider.parse_android_chat if _os == WhatsAppProvider.ANDROID else WhatsAppProvider.parse_ios_chat
+        messages = parse(path, exclude_system_messages=False)
+        first_datetime = min((message.datetime for message in messages), default=None)
+        last_datetime = max((message.datetime for message in messages), default=None)
+        return {
+            "start_date": first_datetime.date() if messages else None,
+            "end_date": last_datetime.date() if messages else None,
+            "message_count": len(messages),
+            "chat_name": messages[0].chat_name if messages else None,
+            "participants": sorted({message.sender for message in messages}),
+            "is_group": messages[0].is_group if messages else False,
+            "start_datetime": first_datetime.isoformat() if messages else None,
+            "end_datetime": last_datetime.isoformat() if messages else None,
+            # To line up an older export of the chat with this one, see _plan_merges
+            "first_minute_keys": [WhatsAppProvider.message_key(message) for message in messages
+                                  if message.datetime == first_datetime],
+        }
+
+    @staticmethod
+    def message_key(message: Message) -> str:
+        """
+        Hash of the time, sender and text of a message, the same in every export of the chat.
+        """
+        key = f'{message.datetime.isoformat()}\x00{message.sender}\x00{message.message}'
+        return hashlib.md5(key.encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def get_chat_key(_os: str, chat_path: str) -> Tuple[str, str]:
+        """
+        The OS and the name of the chat an export is of, the same for every export of the chat.
+        """
+        name = os.path.basename(chat_path)
+        prefix = WhatsAppProvider.WHATSAPP_ANDROID_FILE_NAME_PREFIX if _os == WhatsAppProvider.ANDROID \
+            else WhatsAppProvider.WHATSAPP_IOS_FOLDER_NAME_PREFIX
+        name = archives.strip_archive_extension(name[len(prefix):])
+        if name.endswith('.txt'):
+            name = name[:-len('.txt')]
+        return _os, WhatsAppProvider.COPY_SUFFIX_RE.sub('', name)
+
+    def _plan_merges(self, chats: List[Tuple[str, str, str]]) -> Dict[str, dict]:
+        """
+        Line up the exports of the same chat, e.g. a chat exported again later, so that every message is read once.
+
+        The export with the latest messages is read as is. An older export only gives the messages before the first
+        message of the newer exports. In the minute of that first message, the messages of the older export whose
+        (time, sender, text) hash is among the newer export's are dropped. An older export entirely covered by newer
+        ones isn't read.
+        :param chats: From _get_chats
+        :return: Chat path of the exports of chats exported more than once to a dict with the chat_name of the merged
+        chat, and for older exports the `cutoff` datetime and the `keys` (Counter of hashes) of the newer export's first
+        minute, or `skip` if it isn't needed
+        """
+        exports = defaultdict(dict)
+        for _folder, chat_path, source_path in chats:
+            exports[self.get_chat_key(_folder, chat_path)][chat_path] = self.get_cached_source_metadata(source_path)
+
+        plans = {}
+        for (_, chat_name), chat_exports in exports.items():
+            if len(chat_exports) < 2:
+                continue
+            if any(not metadata or 'first_minute_keys' not in metadata for metadata in chat_exports.values()):
+                # Not indexed yet, read them all
+                continue
+            # Newest first. Exports without messages have nothing to merge
+            ordered = sorted(((metadata["end_datetime"], metadata["start_datetime"], chat_path)
+                              for chat_path, metadata in chat_exports.items() if metadata["start_datetime"]),
+                             reverse=True)
+            cutoff = None
+            keys = None
+            for end_datetime, start_datetime, chat_path in ordered:
+                start = datetime.fromisoformat(start_datetime)
+                plan = {"chat_name": chat_name, "cutoff": cutoff, "keys": keys, "skip": False}
+                if cutoff is not None and start > cutoff:
+                    plan["skip"] = True
+                plans[chat_path] = plan
+                if cutoff is None or start < cutoff:
+                    cutoff = start
+                    keys = Counter(chat_exports[chat_path]["first_minute_keys"])
+        return plans
+
+    @staticmethod
+    def _merge_options(options: dict, cutoff: datetime) -> Optional[dict]:
+        """
+        Parse options of an older export which only gives the messages up to the cutoff.
+        :return: The options, or None if nothing before the cutoff is in the range
+        """
+        # The parsers compare the local dates, which are up to a day apart from the UTC cutoff
+        last_date = cutoff.date() + timedelta(days=1)
+        if options["on_date"] and options["on_date"] > last_date:
+            return None
+        if options["start_date"] and options["start_date"] > last_date:
+            return None
+        if options["on_date"]:
+            return options
+        return {**options, "end_date": min(options["end_date"], last_date) if options["end_date"] else last_date}
+
+    @staticmethod
+    def _merge_messages(messages: List[Message], plan: dict) -> List[Message]:
+        """
+        Drop the messages of an older export which are in the newer export, see _plan_merges.
+        """
+        merged = []
+        cutoff, keys = plan["cutoff"], plan["keys"]
+        seen = Counter()
+        for message in messages:
+            message.chat_name = plan["chat_name"]
+            if cutoff is None or message.datetime < cutoff:
+                merged.append(message)
+            elif message.datetime == cutoff:
+                key = WhatsAppProvider.message_key(message)
+                seen[key] += 1
+                if seen[key] > keys[key]:
+                    merged.append(message)
+        return merged
+
+    def _get_chats(self) -> List[Tuple[str, str, str]]:
+        """
+        Find the exported chats.
+        :return: Tuples of the OS, the chat path passed to the parser and the text file of the chat
+        """
+        chats = []
+        for _folder in os.listdir(WhatsAppProvider.WHATSAPP_PATH):
+            if _folder not in self.SUPPORTED_OS:
+                continue
+
+            base_path = os.path.join(WhatsAppProvider.WHATSAPP_PATH, _folder)
+            found_entries = os.listdir(base_path)
+            for found in found_entries:
+                found_path = os.path.join(base_path, found)
+                if archives.is_archive(found_path) and archives.strip_archive_extension(found) in found_entries:
+                    # Already extracted, the folder is read instead
+                    continue
+                if _folder == self.ANDROID and found.startswith(WhatsAppProvider.WHATSAPP_ANDROID_FILE_NAME_PREFIX):
+                    if not archives.isdir(found_path):
+                        chats.append((_folder, found_path, found_path))
+                        continue
+                    chats.extend((_folder, found_path, os.path.join(found_path, entry))
+                                 for entry in archives.listdir(found_path)
+                                 if entry.startswith(WhatsAppProvider.WHATSAPP_ANDROID_FILE_NAME_PREFIX))
+                elif _folder == self.IOS and found.startswith(WhatsAppProvider.WHATSAPP_IOS_FOLDER_NAME_PREFIX):
+                    chats.append((_folder, found_path, os.path.join(found_path, '_chat.txt')))
+        return chats
+
+    @staticmethod
+    def _chat_in_range(extent: dict, on_date: Optional[date], start_date: Optional[date],
+                       end_date: Optional[date]) -> bool:
+        if extent["start_date"] is None:
+            return False
+        # Messages are filtered on local dates and the extents may be a day apart from them
+        first_date = extent["start_date"] - timedelta(days=1)
+        last_date = extent["end_date"] + timedelta(days=1)
+        if on_date and (on_date < first_date or on_date > last_date):
+            return False
+        if start_date and start_date > last_date:
+            return False
+        if end_date and end_date < first_date:
+            return False
+        return True
+
+    @staticmethod
+    def _chat_has_senders(chat: dict, ignore_groups: bool, sender_regexes: Optional[List[str]]) -> bool:
+        """
+        Whether a chat can have messages for the query, by the same checks as the parsers make, from its metadata.
+        """
+        if "participants" not in chat:
+            return True
+        if ignore_groups and chat["is_group"]:
+            return False
+        if not sender_regexes:
+            return True
+        if not chat["is_group"] and not MemoryProvider._sender_matched(chat["chat_name"], sender_regexes) \
+                and not MemoryProvider._sender_matched(WhatsAppProvider.USER, sender_regexes):
+            return False
+        return any(MemoryProvider._sender_matched(participant, sender_regexes) for participant in chat["participants"])
+
     async def fetch(self,
                     on_date: Optional[date] = None,
                     start_date: Optional[date] = None,
@@ -656,50 +1004,74 @@ class WhatsAppProvider(MemoryProvider):
         sender_regexes = [await get_regex_from_name(sender) for sender in senders] if senders else None
 
         memories = []
-        tasks = []
-        pattern = re.compile(search_regex) if search_regex else None
-        for _folder in os.listdir(WhatsAppProvider.WHATSAPP_PATH):
-            if _folder not in self.SUPPORTED_OS:
+        jobs = []
+        options = {
+            "on_date": on_date,
+            "start_date": start_date,
+            "end_date": end_date,
+            "ignore_groups": ignore_groups,
+            "exclude_system_messages": exclude_system_messages,
+            "sender_regexes": sender_regexes,
+            "pattern": re.compile(search_regex) if search_regex else None,
+        }
+        chats = self._get_chats()
+        exported_again = len({self.get_chat_key(_folder, chat_path) for _folder, chat_path, _ in chats}) < len(
+            {chat_path for _, chat_path, _ in chats})
+        if sender_regexes or ignore_groups or exported_again:
+            # Load the participants of the chats and line up the chats exported more than once, reading only the chats
+            # that changed since they were indexed
+            await self.get_metadata()
+        plans = self._plan_merges(chats) if exported_again else {}
+
+        read_paths = []
+        chat_paths = set()
+        job_plans = []
+        for _folder, chat_path, source_path in chats:
+            # Chats outside the range or without the senders are skipped when their metadata is known
+            chat = self.get_cached_source_metadata(source_path)
+            if chat and not self._chat_in_range(chat, on_date, start_date, end_date):
                 continue
+            if chat and not self._chat_has_senders(chat, ignore_groups, sender_regexes):
+                continue
+            plan = plans.get(chat_path)
+            chat_options = options
+            if plan and plan["skip"]:
+                continue
+            if plan and plan["cutoff"]:
+                chat_options = self._merge_options(options, plan["cutoff"])
+                if chat_options is None:
+                    continue
+            read_paths.append(source_path)
+            if chat_path not in chat_paths:
+                chat_paths.add(chat_path)
+                jobs.append((_folder, chat_path, chat_options))
+                job_plans.append(plan)
 
-            base_path = os.path.join(WhatsAppProvider.WHATSAPP_PATH, _folder)
-            for found in os.listdir(base_path):
-                if _folder == self.ANDROID:
-                    if not found.startswith(WhatsAppProvider.WHATSAPP_ANDROID_FILE_NAME_PREFIX):
-                        continue
-
-                    tasks.append(self.parse_android_chat(os.path.join(base_path, found),
-                                                         on_date=on_date,
-                                                         start_date=start_date,
-                                                         end_date=end_date,
-                                                         ignore_groups=ignore_groups,
-                                                         exclude_system_messages=exclude_system_messages,
-                                                         sender_regexes=sender_regexes,
-                                                         pattern=pattern))
-                else:
-                    if not found.startswith(WhatsAppProvider.WHATSAPP_IOS_FOLDER_NAME_PREFIX):
-                        continue
-
-                    tasks.append(self.parse_ios_chat(os.path.join(base_path, found),
-                                                     on_date=on_date,
-                                                     start_date=start_date,
-                                                     end_date=end_date,
-                                                     ignore_groups=ignore_groups,
-                                                     exclude_system_messages=exclude_system_messages,
-                                                     sender_regexes=sender_regexes,
-                                                     pattern=pattern))
-
-        # Run parsing concurrently
-        results = await asyncio.gather(*tasks)
+        # Parse the chats on all cores
+        results = await run_parse_jobs(WhatsAppProvider.parse_chat_rows, jobs)
+        metrics.add_files_read(self.NAME, read_paths)
 
-        for chat_list in results:
-            memories.extend(chat_list)
+        for chat_rows, plan in zip(results, job_plans):
+            messages = [Message.from_row(row) for row in chat_rows]
+            memories.extend(self._merge_messages(messages, plan) if plan else messages)
 
         memories.sort(key=lambda memory: memory.datetime)
 
         print("Done fetching from Whatsapp")
         return memories
 
+    def get_source_paths(self) -> List[str]:
+        return [source_path for _, _, source_path in self._get_chats()]
+
+    async def _compute_source_metadata(self, path: str) -> dict:
+        parent = os.path.dirname(path)
+        if os.path.basename(parent) in self.SUPPORTED_OS:
+            # Android chat exported without media
+            _folder, chat_path = os.path.basename(parent), path
+        else:
+            _folder, chat_path = os.path.basename(os.path.dirname(parent)), parent
+        return await run_parse_job(WhatsAppProvider.parse_chat_metadata, _folder, chat_path)
+
     @staticmethod
     def generate_asset_id(_os, chat_name, file_name) -> str:
         return f"{_os}___{chat_name}___{file_name}"
@@ -708,22 +1080,28 @@ class WhatsAppProvider(MemoryProvider):
     def get_user_name_file_name(asset_id: str) -> List[str]:
         return asset_id.split('___')
 
-    async def get_asset(self, asset_id: str) -> Tuple[bytes, str]:
+    async def get_asset(self, asset_id: str) -> Tuple[bytes | archives.MemberStream, str]:
         _os, user_name, file_name = WhatsAppProvider.get_user_name_file_name(asset_id)
         if _os == WhatsAppProvider.IOS:
-            media_file_path = os.path.join(WhatsAppProvider.WHATSAPP_PATH, _os,
-                                           f'{WhatsAppProvider.WHATSAPP_IOS_FOLDER_NAME_PREFIX}{user_name}', file_name)
+            folder_path = os.path.join(WhatsAppProvider.WHATSAPP_PATH, _os,
+                                       f'{WhatsAppProvider.WHATSAPP_IOS_FOLDER_NAME_PREFIX}{user_name}')
         else:
-            media_file_path = os.path.join(WhatsAppProvider.WHATSAPP_PATH, _os,
-                                           f'{WhatsAppProvider.WHATSAPP_ANDROID_FILE_NAME_PREFIX}{user_name}',
-                                           file_name)
-        if not os.path.exists(media_file_path):
+            folder_path = os.path.join(WhatsAppProvider.WHATSAPP_PATH, _os,
+                                       f'{WhatsAppProvider.WHATSAPP_ANDROID_FILE_NAME_PREFIX}{user_name}')
+        if not os.path.isdir(folder_path) and archives.is_archive(f'{folder_path}{archives.ARCHIVE_EXTENSION}'):
+            folder_path = f'{folder_path}{archives.ARCHIVE_EXTENSION}'
+        media_file_path = os.path.join(folder_path, file_name)
+        if not archives.exists(media_file_path):
             raise FileNotFoundError(f"{media_file_path} does not exist")
 
         mime_type, _ = mimetypes.guess_type(media_file_path)
         if mime_type is None:
             raise ValueError("Could not determine MIME type")
 
+        if archives.split_archive_path(media_file_path):
+            # Sent from the zip file while the response is written
+            return archives.stream(media_file_path), mime_type
+
         async with aiofiles.open(media_file_path, "rb") as media_file:
             media_data = await media_file.read()
         return media_data, mime_type
\ No newline at end of file
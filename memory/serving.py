@@ -0,0 +1,134 @@
+import asyncio
+import atexit
+import os
+import threading
+from contextlib import asynccontextmanager
+from typing import Callable, Awaitable, List, Optional, AsyncIterator
+
+import httpx
+from flask import Flask
+
+# 'persistent' runs every async view on one long-lived event loop, 'per_request' keeps Flask's default of a new loop
+# for each request
+SERVING_LOOP = os.getenv('SERVING_LOOP', 'persistent')
+
+_startup_hooks: List[Callable[[], Awaitable[None]]] = []
+_shutdown_hooks: List[Callable[[], Awaitable[None]]] = []
+
+# Shared by every request served on the persistent loop
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def on_startup(fn: Callable[[], Awaitable[None]]):
+    """
+    Register a coroutine function to run on the persistent loop once it starts, before it serves any request.
+    """
+    _startup_hooks.append(fn)
+    return fn
+
+
+def on_shutdown(fn: Callable[[], Awaitable[None]]):
+    """
+    Register a coroutine function to run on the persistent loop before it stops. Hooks run in reverse order.
+    """
+    _shutdown_hooks.append(fn)
+    return fn
+
+
+class EventLoopThread:
+    """
+    An event loop running forever in a daemon thread. Coroutines are submitted to it from other threads.
+    """
+
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def is_running(self) -> bool:
+        return self.loop is not None
+
+    def start(self):
+        with self._lock:
+            if self.loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=loop.run_forever, name='memory-event-loop', daemon=True)
+            self._thread.start()
+            print("Started the persistent event loop")
+            for hook in _startup_hooks:
+                asyncio.run_coroutine_threadsafe(hook(), loop).result()
+            self.loop = loop
+
+    def run(self, coro: Awaitable):
+        """
+        Run a coroutine on the loop and wait for its result. The context variables of the calling thread, like
+        Flask's request context, are copied to the coroutine.
+        """
+        if self.loop is None:
+            self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def stop(self):
+        with self._lock:
+            if self.loop is None:
+                return
+            loop, self.loop = self.loop, None
+            for hook in reversed(_shutdown_hooks):
+                try:
+                    asyncio.run_coroutine_threadsafe(hook(), loop).result(timeout=10)
+                except Exception as e:
+                    print(f"Shutdown hook failed: {e}")
+            loop.call_soon_threadsafe(loop.stop)
+            self._thread.join(timeout=10)
+            loop.close()
+            print("Stopped the persistent event loop")
+
+
+event_loop_thread = EventLoopThread()
+atexit.register(event_loop_thread.stop)
+
+
+class PersistentLoopFlask(Flask):
+    """
+    Flask app that runs its async views on the persistent event loop instead of a new loop per request, so clients,
+    caches and tasks bound to the loop live across requests.
+    """
+
+    def async_to_sync(self, func):
+        if SERVING_LOOP != 'persistent':
+            return super().async_to_sync(func)
+
+        def wrapper(*args, **kwargs):
+            return event_loop_thread.run(func(*args, **kwargs))
+
+        return wrapper
+
+
+@on_startup
+async def _open_http_client():
+    global _http_client
+    limits = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+    _http_client = httpx.AsyncClient(limits=limits)
+
+
+@on_shutdown
+async def _close_http_client():
+    global _http_client
+    client, _http_client = _http_client, None
+    if client is not None:
+        await client.aclose()
+
+
+@asynccontextmanager
+async def http_client(**kwargs) -> AsyncIterator[httpx.AsyncClient]:
+    """
+    Get an HTTP client. On the persistent loop this is the shared client, so connections are reused across requests,
+    and kwargs are ignored (pass the timeout per request instead). Anywhere else a client is created for this block.
+    :param kwargs: Arguments of httpx.AsyncClient
+    """
+    if _http_client is not None and asyncio.get_running_loop() is event_loop_thread.loop:
+        yield _http_client
+    else:
+        async with httpx.AsyncClient(**kwargs) as client:
+            yield client
@@ -1,11 +1,18 @@
 import asyncio
+import json
+import mimetypes
 import os
-from typing import List, Coroutine, Any
+import time
+import zipfile
+from typing import List, Any, Dict, Iterable, Optional, AsyncIterator
 
+import aiofiles
 import httpx
 from flask import Response, make_response
 
+import archives
 import init
+from serving import http_client
 
 
 async def post_with_retries(url, payload, headers, retries: int = 3, timeout: int = 30.0) -> httpx.Response or None:
@@ -13,8 +20,8 @@ async def post_with_retries(url, payload, headers, retries: int = 3, timeout: in
     limits = httpx.Limits(max_connections=100, max_keepalive_connections=20)
     for attempt in range(1, retries + 1):
         try:
-            async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
-                response = await client.post(url, json=payload, headers=headers)
+            async with http_client(timeout=timeout, limits=limits) as client:
+                response = await client.post(url, json=payload, headers=headers, timeout=timeout)
             response.raise_for_status()
             return response
         except httpx.ConnectTimeout:
@@ -26,26 +33,241 @@ async def post_with_retries(url, payload, headers, retries: int = 3, timeout: in
     return None
 
 
-class AsyncDownloadManager:
-    def __init__(self, max_concurrent: int = 10):
-        self.semaphore = asyncio.Semaphore(max_concurrent)
-        self.tasks: List[asyncio.Task] = []
+class DownloadJob:
+    def __init__(self, url: str, file_path: str, headers: Dict[str, str] = None):
+        self.url = url
+        self.file_path = file_path
+        self.headers = headers or {}
 
-    async def _wrap(self, coro: Coroutine) -> Any:
-        """Wrap coroutine with semaphore for concurrency control"""
-        async with self.semaphore:
-            return await coro
+    def __repr__(self):
+        return f"DownloadJob({self.url!r} -> {self.file_path!r})"
 
-    def add(self, coro: Coroutine) -> None:
-        """Add coroutine task to the manager"""
-        task = asyncio.create_task(self._wrap(coro))
-        self.tasks.append(task)
 
-    async def run(self) -> List[Any]:
-        """Run all scheduled tasks and wait for completion"""
-        results = await asyncio.gather(*self.tasks, return_exceptions=True)
-        self.tasks.clear()  # reset after run
-        return results
+class StreamingDownloadManager:
+    """
+    Producer/consumer download engine.
+
+    Jobs are pulled lazily from an iterable into a bounded queue and consumed by a fixed number of workers sharing
+    one connection pool. Bodies are streamed in chunks to a `.part` file which is atomically renamed once complete,
+    so memory use stays constant irrespective of the number or size of files. A left over `.part` file is resumed
+    with a `Range` request.
+    """
+    CHUNK_SIZE = 1024 * 1024
+    PART_SUFFIX = '.part'
+    MAX_REDIRECTS = 5
+    REDIRECT_CODES = (301, 302, 303, 307, 308)
+    PROGRESS_INTERVAL_SECONDS = 5
+
+    def __init__(self, max_concurrent: int = 10, queue_size: int = None, timeout: float = 30.0,
+                 chunk_size: int = CHUNK_SIZE):
+        self.max_concurrent = max_concurrent
+        self.queue_size = queue_size or max_concurrent * 2
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+
+        self.total_jobs = None
+        self.completed_jobs = 0
+        self.failed_jobs = 0
+        self.skipped_jobs = 0
+        self.bytes_downloaded = 0
+        self._started_at = None
+        self._last_report_at = 0.0
+
+    async def run(self, jobs: Iterable[DownloadJob], total: int = None) -> List[Any]:
+        """
+        Download all the jobs. Jobs can be a lazy iterable; at most `queue_size` of them are materialized at a time.
+        :param jobs: Iterable of DownloadJob
+        :param total: Number of jobs (for progress reporting), if known
+        :return: Result per job in input order. True if downloaded, False if skipped and the exception if it failed.
+        """
+        self.total_jobs = total
+        self._started_at = self._last_report_at = time.monotonic()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        results: Dict[int, Any] = {}
+
+        limits = httpx.Limits(max_connections=self.max_concurrent, max_keepalive_connections=self.max_concurrent)
+        async with httpx.AsyncClient(timeout=httpx.Timeout(self.timeout), limits=limits) as client:
+            workers = [asyncio.create_task(self._worker(client, queue, results)) for _ in range(self.max_concurrent)]
+            try:
+                count = 0
+                for index, job in enumerate(jobs):
+                    await queue.put((index, job))
+                    count += 1
+                for _ in workers:
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+            except BaseException:
+                for worker in workers:
+                    worker.cancel()
+                raise
+
+        self._report_progress(force=True)
+        return [results.get(index) for index in range(count)]
+
+    async def _worker(self, client: httpx.AsyncClient, queue: asyncio.Queue, results: Dict[int, Any]):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            index, job = item
+            try:
+                results[index] = await self.download(client, job)
+                if results[index]:
+                    self.completed_jobs += 1
+                else:
+                    self.skipped_jobs += 1
+            except Exception as e:
+                results[index] = e
+                self.failed_jobs += 1
+            self._report_progress()
+
+    async def download(self, client: httpx.AsyncClient, job: DownloadJob) -> bool:
+        if os.path.exists(job.file_path):
+            # The file is already downloaded
+            return False
+
+        part_path = job.file_path + self.PART_SUFFIX
+        resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+        headers = dict(job.headers)
+        if resume_from:
+            headers['Range'] = f'bytes={resume_from}-'
+
+        url = job.url
+        for _ in range(self.MAX_REDIRECTS + 1):
+            async with client.stream('GET', url, headers=headers) as response:
+                # Handle redirect manually so that the headers are sent to the redirected url as well
+                if response.status_code in self.REDIRECT_CODES:
+                    url = response.headers.get("Location")
+                    if not url:
+                        raise Exception("Redirect response but no Location header")
+                    continue
+
+                if response.status_code == 416 and resume_from:
+                    # The part file is already complete
+                    break
+
+                if response.status_code not in (200, 206):
+                    await response.aread()
+                    raise Exception(response.status_code, response.text)
+
+                # A server ignoring the Range header sends the whole body again
+                mode = 'ab' if response.status_code == 206 else 'wb'
+                async with aiofiles.open(part_path, mode) as f:
+                    async for chunk in response.aiter_bytes(self.chunk_size):
+                        await f.write(chunk)
+                        self.bytes_downloaded += len(chunk)
+                break
+        else:
+            raise Exception(f"Too many redirects for {job.url}")
+
+        os.replace(part_path, job.file_path)
+        return True
+
+    def _report_progress(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last_report_at < self.PROGRESS_INTERVAL_SECONDS:
+            return
+        self._last_report_at = now
+
+        elapsed = max(now - self._started_at, 1e-6)
+        done = self.completed_jobs + self.skipped_jobs + self.failed_jobs
+        total = f"/{self.total_jobs}" if self.total_jobs is not None else ''
+        print(f"Downloads: {done}{total} done ({self.completed_jobs} downloaded, {self.skipped_jobs} skipped, "
+              f"{self.failed_jobs} failed), {self.bytes_downloaded / (1024 * 1024):.1f} MB "
+              f"at {self.bytes_downloaded / (1024 * 1024) / elapsed:.2f} MB/s")
+
+
+async def stream_json_array(path: str, array_key: str, header: dict = None,
+                            chunk_size: int = 64 * 1024) -> AsyncIterator[Any]:
+    """
+    Incrementally read a JSON file with a top level object and yield the elements of the array under `array_key` one
+    at a time. Only a chunk of the file is held in memory and nothing is read past the point where the consumer stops
+    iterating, which makes early termination cheap for large files.
+    :param path: Path of the JSON file
+    :param array_key: Top level key of the array to stream
+    :param header: If given, the other top level values read so far (the ones before the array for an early exit)
+                   are added to it
+    :param chunk_size: Number of characters to read at a time
+    """
+    decoder = json.JSONDecoder()
+
+    async with aiofiles.open(path, mode='r', encoding='utf-8') as f:
+        buffer = ''
+        pos = 0
+        eof = False
+
+        async def fill() -> bool:
+            nonlocal buffer, pos, eof
+            if eof:
+                return False
+            chunk = await f.read(chunk_size)
+            if not chunk:
+                eof = True
+                return False
+            # Drop what is already consumed
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            return True
+
+        async def next_token() -> str:
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos] in ' \t\n\r':
+                    pos += 1
+                if pos < len(buffer):
+                    return buffer[pos]
+                if not await fill():
+                    raise ValueError(f"Unexpected end of JSON in {path}")
+
+        async def decode_value() -> Any:
+            nonlocal pos
+            await next_token()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                    # A number (or literal) at the end of the buffer could be truncated
+                    if end < len(buffer) or eof:
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                await fill()
+
+        async def expect(token: str):
+            nonlocal pos
+            if await next_token() != token:
+                raise ValueError(f"Expected {token!r} at {pos} in {path}")
+            pos += 1
+
+        await expect('{')
+        while True:
+            token = await next_token()
+            if token == '}':
+                return
+            if token == ',':
+                pos += 1
+                continue
+
+            key = await decode_value()
+            await expect(':')
+            if key != array_key:
+                value = await decode_value()
+                if header is not None:
+                    header[key] = value
+                continue
+
+            await expect('[')
+            while True:
+                token = await next_token()
+                if token == ']':
+                    pos += 1
+                    break
+                if token == ',':
+                    pos += 1
+                    continue
+                yield await decode_value()
 
 
 def add_caching_to_response(response: Any, ttl_prod: int = 3600, ttl_debug: int = 5) -> Response:
@@ -103,6 +325,37 @@ def is_valid_word(dictionary=None, word: str = None) -> bool:
     return word.strip().lower() in dictionary
 
 
+def file_fingerprint(path: str) -> Optional[List[int]]:
+    """
+    Cheap fingerprint of a file to detect changes without reading it.
+    :return: [mtime in ns, size] ([mtime in ns, size, CRC] for a file in a zip file) or None if the file doesn't exist
+    """
+    try:
+        stat = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        # The path may go through a zip file
+        try:
+            return archives.member_fingerprint(path)
+        except (OSError, zipfile.BadZipFile):
+            return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+_mime_types_by_extension: Dict[str, Optional[str]] = {}
+
+
+def guess_mime_type(path: str) -> Optional[str]:
+    """
+    Same as mimetypes.guess_type(path)[0], cached per extension. The type only depends on the last two extensions
+    (an encoding like .gz and the extension before it), so those are the key.
+    """
+    base, extension = os.path.splitext(os.path.basename(path))
+    extension = os.path.splitext(base)[1] + extension
+    if extension not in _mime_types_by_extension:
+        _mime_types_by_extension[extension] = mimetypes.guess_type(f'file{extension}')[0]
+    return _mime_types_by_extension[extension]
+
+
 def str_to_bool(value: str) -> bool:
     if not value:
         return False
@@ -0,0 +1,109 @@
+import asyncio
+import atexit
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from common import LazyProviders
+from serving import event_loop_thread, SERVING_LOOP
+from utils import file_fingerprint
+
+# Seconds between two scans of the providers' source files. Set WATCH_INTERVAL=0 to turn the watcher off
+WATCH_INTERVAL = float(os.getenv('WATCH_INTERVAL', 5))
+# A provider is refreshed once its files stopped changing for this many seconds, so a copy in progress is read once
+WATCH_DEBOUNCE = float(os.getenv('WATCH_DEBOUNCE', 3))
+
+
+class SourceWatcher:
+    """
+    Polls the source files of the loaded providers (see MemoryProvider.get_source_paths) and lets a provider re-ingest
+    the files that changed, so a new export shows up without waiting for a query to notice it.
+
+    Polling takes a stat() per source file and needs no platform specific dependency. Providers that weren't used yet
+    aren't watched, they read their files when they are first used anyway.
+    """
+
+    def __init__(self, providers: LazyProviders):
+        self._providers = providers
+        self._snapshots: Dict[str, Dict[str, Optional[List[int]]]] = {}
+        # Provider name to the paths that changed and the time of the last change
+        self._pending: Dict[str, tuple] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='memory-source-watcher', daemon=True)
+        self._thread.start()
+        print(f"Watching provider sources every {WATCH_INTERVAL}s")
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(WATCH_INTERVAL):
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Source watcher failed: {e}")
+
+    @staticmethod
+    def _run_refresh(coro):
+        """
+        Run a refresh on the persistent loop when the views do, so the providers' loop bound state stays on one loop.
+        Otherwise each refresh gets its own loop in the watcher thread, like each request does.
+        """
+        if SERVING_LOOP == 'persistent':
+            return event_loop_thread.run(coro)
+        return asyncio.run(coro)
+
+    def poll(self):
+        now = time.monotonic()
+        for name, provider in self._providers.loaded().items():
+            try:
+                snapshot = {path: file_fingerprint(path) for path in provider.get_source_paths()}
+            except OSError as e:
+                print(f"Could not list the sources of {name}: {e}")
+                continue
+            previous = self._snapshots.get(name)
+            self._snapshots[name] = snapshot
+            if previous is None:
+                provider.sources_watched_since = time.monotonic()
+                continue
+            if previous == snapshot:
+                continue
+
+            paths = {path for path in snapshot.keys() | previous.keys() if snapshot.get(path) != previous.get(path)}
+            pending_paths, _ = self._pending.get(name, (set(), now))
+            self._pending[name] = (pending_paths | paths, now)
+
+        for name, (paths, last_change) in list(self._pending.items()):
+            if now - last_change < WATCH_DEBOUNCE:
+                continue
+            del self._pending[name]
+            snapshot = self._snapshots[name]
+            changed = sorted(path for path in paths if snapshot.get(path))
+            removed = sorted(path for path in paths if not snapshot.get(path))
+            print(f"Refreshing {name}: {len(changed)} changed and {len(removed)} removed sources")
+            try:
+                self._run_refresh(self._providers[name].on_sources_changed(changed, removed))
+            except Exception as e:
+                print(f"Refreshing {name} failed: {e}")
+
+
+_watcher: Optional[SourceWatcher] = None
+_watcher_lock = threading.Lock()
+
+
+def start_source_watcher(providers: LazyProviders):
+    """
+    Start watching the sources of the providers, once per process.
+    """
+    global _watcher
+    if _watcher is not None or WATCH_INTERVAL <= 0:
+        return
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = SourceWatcher(providers)
+            _watcher.start()
+            atexit.register(_watcher.stop)